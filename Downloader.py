@@ -1,96 +1,750 @@
 import time
+import socket
 import threading
 import random
 import string
+import asyncio
+import contextlib
 
 from Torrent import Torrent
-from Tracker import Tracker
+from Tracker import TrackerManager
+from connections import ConnectionManager
 from peer import Peer
 from peice import PieceManager
+from async_engine import AsyncEngine
+from bufferpool import BufferPool
+from choker import Choker
+from picker import has_piece
+from pipelining import BLOCK_SIZE
+from ratelimit import RateLimits, allowance, consume, format_rate
+from metrics import TimedLock
+from magnet import METADATA_BLOCK, REQUEST, DATA, REJECT, metadata_message, parse_metadata_message
+from peer import EXTENSIONS
+from pex import MAX_PEX_PEERS, PEX_INTERVAL, SEED, REACHABLE, pex_message, parse_pex
+from stream import READAHEAD, TorrentFile
+
+def bind_listener(port, attempts=10, backlog=64):
+    """Returns a listening TCP socket on `port` or one of the next few (any free port for 0), or None."""
+    ports = [0] if port == 0 else range(port, port + attempts)
+    for port in ports:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', port))
+            sock.listen(backlog)
+            return sock
+        except OSError:
+            sock.close()
+    return None
 
 class Downloader:
     """Orchestrates the download process."""
-    def __init__(self, torrent_file_path, download_dir):
-        self.print_lock = threading.Lock()
+    def __init__(self, torrent_file_path, download_dir, min_requests=2, max_requests=250,
+                 engine='threads', max_connecting=50, strategy='rarest', endgame_copies=3,
+                 storage='pwrite', max_buffer_mb=256, target_peers=50, request_timeout=15, replace_interval=30,
+                 listen_port=6881, seed=False, upload_slots=4, print_lock=None, buffer_pool=None, disk=None,
+                 download_rate=0, upload_rate=0, peer_download_rate=0, peer_upload_rate=0, global_limits=None,
+                 max_upload_queue=256, metrics=None, dht=None, file_priorities=None):
+        self.print_lock = print_lock or threading.Lock()
         self.torrent = Torrent(torrent_file_path)
         self.peer_id = '-PY0001-' + ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-        self.piece_manager = PieceManager(self.torrent, download_dir, self.print_lock)
-        self.tracker = Tracker(self.torrent, self.peer_id, self.print_lock)
+        # A Session passes in the buffer pool (share) and disk pipeline it shares between torrents.
+        self.piece_manager = PieceManager(self.torrent, download_dir, self.print_lock, strategy, storage=storage,
+                                          buffer_pool=buffer_pool or BufferPool(max_buffer_mb * 1024 * 1024),
+                                          disk=disk)
+        if file_priorities is not None:
+            self.piece_manager.set_file_priorities(self.file_priority_list(file_priorities))
+        self.connections = ConnectionManager(target_peers, max_connecting)
+        self.piece_manager.on_verified = self.piece_verified
+        self.request_timeout = request_timeout  # seconds without a block before a peer counts as snubbing us
+        self.replace_interval = replace_interval  # how often the slowest peer may be swapped for a new one
+        self.last_replace = time.monotonic()
+        self.snubs = 0
+        self.start_downloaded = self.piece_manager.downloaded_size  # verified bytes we resumed with
+        self.was_complete = self.piece_manager.is_complete()
+        self.uploaded_bytes = 0
+        self.upload_rate = 0.0
+        self.rate_sample = (time.monotonic(), 0)  # (when, uploaded_bytes) for measuring upload_rate
+        # Rate limits in bytes/s, 0 for none: this torrent's, each peer's, and the session's if we are in one.
+        self.limits = RateLimits(download_rate, upload_rate)
+        self.peer_rates = (peer_download_rate, peer_upload_rate)
+        self.global_limits = global_limits
+        self.max_upload_queue = max_upload_queue  # requests a peer may have waiting for the upload limit
+        self.trackers = TrackerManager(self.torrent, self.peer_id, self.print_lock,
+                                       lambda peers: self.add_peers(peers, 'tracker'),
+                                       self.transfer_stats, self.connections.wants_peers)
+        self.listen_port = listen_port  # None: don't accept inbound peers
+        self.listen_sock = None
+        self.public_port = None  # the port peers can reach us on, once something listens on it
+        # Private torrents (BEP 27) get their peers from the trackers only.
+        self.dht = None if self.torrent.private else dht  # a dht.DHT shared by the process, or None
+        self.pex = not self.torrent.private
+        self.extensions = EXTENSIONS if self.pex else {k: v for k, v in EXTENSIONS.items() if k != b'ut_pex'}
+        self.last_pex = time.monotonic()
+        self.seed = seed  # keep running and uploading after the download completes
+        self.seeding = False
+        self.choker = Choker(upload_slots)
         self.peers = []
         self.is_running = True
+        self.closing = False
+        self.closed = threading.Event()  # set once the piece manager is closed; see close_storage()
+        self.close_lock = threading.Lock()
         self.data_lock = threading.Lock()
+        self.min_requests = min_requests
+        self.max_requests = max_requests
+        self.engine = engine
+        self.endgame_copies = endgame_copies  # peers asked for the same block in endgame
+        self.endgame_batch = 4  # duplicate requests a dry peer sends at once in endgame
+        self.endgame_holders = {}  # (piece, offset) -> peers asked for a block requested more than once
+        self.async_engine = None
+        self.name = self.torrent.name
+        self.metrics = metrics  # a metrics.Metrics, or None to record nothing
+        if engine == 'asyncio':
+            # Every piece manager call happens on the event loop thread.
+            self.data_lock = contextlib.nullcontext()
+            self.async_engine = AsyncEngine(self)
+        else:
+            self.piece_manager.disk.notify = self.process_disk_results
+            self.connect_wakeup = threading.Event()
+            self.connections.notify = self.connect_wakeup.set
+        if metrics:
+            if not self.async_engine:
+                self.data_lock = TimedLock(self.data_lock, metrics, 'bt_data_lock_wait_seconds')
+            self.piece_manager.disk.pipeline.metrics = metrics
+            self.trackers.on_announce = self.announced
+            metrics.add_collector(self.collect_metrics)
+
+    def start(self, loop=None):
+        """Starts announcing to the trackers and launches the connection and status threads.
 
-    def start(self):
-        """Starts the download by launching peer and status threads."""
+        With `loop` (a running event loop, asyncio engine only) the engine runs on that loop
+        instead of its own thread, and no status thread is started: the caller polls
+        check_complete() and summary() itself. Returns the engine's future in that case.
+        """
         with self.print_lock:
             print(f"Starting download for: {self.torrent}")
-        
-        peers_list = self.tracker.get_peers()
-        with self.print_lock:
-            print(f"Found {len(peers_list)} peers.")
-        
-        for ip, port in peers_list:
-            peer = Peer(ip, port, self.torrent, self.peer_id)
-            if peer.connect():
-                self.peers.append(peer)
-                with self.print_lock:
-                    print(f"Connected to peer: {ip}:{port}")
-                threading.Thread(target=self.peer_loop, args=(peer,), daemon=True).start()
-        
+        self.event('start', size=self.torrent.total_size, have=self.piece_manager.downloaded_size)
+
+        if self.listen_port is not None:
+            self.open_listener()
+        self.trackers.start()
+        if self.dht:
+            self.dht.add_torrent(self.torrent.info_hash, lambda peers: self.add_peers(peers, 'dht'),
+                                 self.connections.wants_peers, self.public_port)
+        if loop is not None:
+            self.async_engine.loop = loop  # so call_soon works before run() gets going
+            return asyncio.run_coroutine_threadsafe(self.async_engine.run(), loop)
+        if self.async_engine:
+            threading.Thread(target=asyncio.run, args=(self.async_engine.run(),), daemon=True).start()
+        else:
+            threading.Thread(target=self.connect_loop, daemon=True).start()
+            if self.listen_sock:
+                threading.Thread(target=self.listen_loop, daemon=True).start()
         threading.Thread(target=self.status_loop, daemon=True).start()
-        return
 
+    def open_listener(self):
+        """Binds the socket inbound peers connect to, trying the next few ports if ours is taken."""
+        self.listen_sock = bind_listener(self.listen_port)
+        if self.listen_sock is None:
+            with self.print_lock:
+                print(f"\nCould not listen on port {self.listen_port} or the next few; only outgoing connections will be made.")
+            return
+        self.trackers.tracker.port = self.public_port = self.listen_sock.getsockname()[1]
+        with self.print_lock:
+            print(f"Listening for peers on port {self.trackers.tracker.port}")
+
+    def add_peers(self, addresses, source):
+        """Adds peers from a tracker, the DHT or PEX to the connection pool."""
+        added = self.connections.add_peers(addresses)
+        if added and self.metrics:
+            self.metrics.inc('bt_peers_discovered_total', added, torrent=self.name, source=source)
+        return added
+
+    def file_priority_list(self, priorities):
+        """A priority per file from a list, or from a {file index: priority} dict with the rest at 1."""
+        if isinstance(priorities, dict):
+            result = [1] * len(self.torrent.files)
+            for index, priority in priorities.items():
+                if not 0 <= index < len(result):
+                    raise ValueError(f"no file {index}; the torrent has {len(result)}")
+                result[index] = priority
+            return result
+        return list(priorities)
+
+    def with_pieces(self, callback):
+        """Runs `callback` where piece state may be changed: on the loop thread with the asyncio
+        engine, under the data lock with threads. Safe to call from any thread."""
+        if self.async_engine and self.async_engine.loop is not None:
+            self.async_engine.call_soon(callback)
+        else:
+            with self.data_lock:
+                callback()
+
+    def set_file_priorities(self, priorities):
+        """Changes file priorities while running (0 = skip, 1 = normal, higher first); see file_priority_list."""
+        priorities = self.file_priority_list(priorities)
+        self.with_pieces(lambda: self.piece_manager.set_file_priorities(priorities))
+
+    def set_deadlines(self, deadlines, clear=()):
+        """Asks for pieces by time.monotonic() deadlines ({piece index: deadline}) and drops the
+        deadlines of the pieces in `clear`."""
+        def apply():
+            picker = self.piece_manager.picker
+            for piece_index in clear:
+                picker.clear_deadline(piece_index)
+            for piece_index, deadline in deadlines.items():
+                picker.set_deadline(piece_index, deadline)
+        self.with_pieces(apply)
+
+    def open_file(self, file, readahead=READAHEAD, timeout=None):
+        """Opens one of the torrent's files, by index or relative path, for reading while it downloads.
+
+        Returns a stream.TorrentFile: reads block until the data under them is verified.
+        """
+        paths = self.torrent.files.paths
+        if not isinstance(file, int):
+            if file not in paths:
+                raise FileNotFoundError(f"{file} is not in {self.torrent.name}")
+            file = paths.index(file)
+        if not 0 <= file < len(paths):
+            raise IndexError(f"no file {file}; the torrent has {len(paths)}")
+        return TorrentFile(self, file, readahead, timeout)
+
+    def transfer_stats(self):
+        """(uploaded, downloaded, left) bytes for tracker announces."""
+        downloaded = self.piece_manager.downloaded_size
+        return self.uploaded_bytes, downloaded - self.start_downloaded, self.torrent.total_size - downloaded
+
+    def connect_loop(self, interval=1.0):
+        """Starts a connection thread for each candidate the connection manager hands out."""
+        while self.is_running:
+            self.connect_wakeup.clear()
+            for ip, port in self.connections.take_candidates():
+                threading.Thread(target=self.connect_peer, args=(ip, port), daemon=True).start()
+            self.replace_slowest()
+            self.choke_round()
+            self.pex_round()
+            self.connect_wakeup.wait(interval)
+
+    def connect_peer(self, ip, port):
+        peer = Peer(ip, port, self.torrent, self.peer_id, self.min_requests, self.max_requests)
+        if not peer.connect() or not self.is_running:
+            peer.close()
+            self.peer_failed(ip, port)
+            return
+        self.peer_ready(peer)
+        self.peer_loop(peer)
+
+    def listen_loop(self):
+        """Accepts inbound peers on the listening socket."""
+        self.listen_sock.settimeout(1)
+        while self.is_running:
+            try:
+                sock, (ip, port) = self.listen_sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not self.connections.accept_inbound((ip, port)):
+                sock.close()
+                continue
+            threading.Thread(target=self.accept_peer, args=(sock, ip, port), daemon=True).start()
+        self.listen_sock.close()
+
+    def accept_peer(self, sock, ip, port):
+        peer = Peer(ip, port, self.torrent, self.peer_id, self.min_requests, self.max_requests)
+        if not peer.accept(sock) or not self.is_running:
+            peer.close()
+            self.peer_failed(ip, port)
+            return
+        self.peer_ready(peer, inbound=True)
+        self.peer_loop(peer)
+
+    def peer_failed(self, ip, port):
+        """Records a connect or handshake that didn't work out."""
+        self.connections.connect_failed((ip, port))
+        self.event('connect', peer=f"{ip}:{port}", result='failed')
+
+    def peer_ready(self, peer, inbound=False):
+        """Registers a peer that completed the handshake and tells it which pieces we have."""
+        self.connections.peer_connected((peer.ip, peer.port))
+        self.event('connect', peer=f"{peer.ip}:{peer.port}", result='inbound' if inbound else 'ok')
+        peer.connected_at = time.monotonic()
+        peer.limits.set(*self.peer_rates)
+        if not inbound:
+            peer.listen_port = peer.port
+        self.peers.append(peer)
+        with self.print_lock:
+            print(f"{'Accepted' if inbound else 'Connected to'} peer: {peer.ip}:{peer.port}")
+        if self.piece_manager.completed_pieces:
+            peer.send_bitfield(self.piece_manager.bitfield)
+        if peer.supports_extensions:
+            peer.send_extended_handshake(len(self.torrent.info_bytes), self.public_port, self.extensions)
 
     def peer_loop(self, peer):
+        active_pieces = []  # pieces this peer is currently filling
+        last_check = time.monotonic()
         while self.is_running and peer.sock:
             try:
                 msg = peer.receive_message()
-                if msg and msg[0] == 'piece':
-                    _, piece_index, block_offset, block_data = msg
-                    with self.data_lock:
-                        self.piece_manager.receive_block(piece_index, block_offset, block_data)
-
-                if not peer.peer_choking:
-                    peer.send_interested()
-                    if peer.bitfield:
-                        piece_to_download = None
-                        with self.data_lock:
-                            piece_to_download = self.piece_manager.get_piece_to_download(peer.bitfield)
-                        
-                        if piece_to_download:
-                            block_to_request = piece_to_download.get_block_to_request()
-                            if block_to_request:
-                                peer.send_request(piece_to_download.index, block_to_request['offset'], block_to_request['length'])
-                
-                time.sleep(0.01)
+                self.handle_peer_message(peer, msg, active_pieces)
+                if time.monotonic() - last_check >= 1.0:
+                    last_check = time.monotonic()
+                    self.check_timeouts(peer, active_pieces)
             except Exception as e:
                 with self.print_lock:
                     print(f"\nError in peer loop for {peer.ip}:{peer.port}: {e}")
                 break
         
+        self.drop_peer(peer, active_pieces)
+
+    def handle_peer_message(self, peer, msg, active_pieces):
+        """Acts on one received message and keeps the peer's request pipeline full."""
+        if peer.pending_haves:
+            self.flush_haves(peer)
+        if peer.upload_queue:
+            self.serve_queued(peer)
+        if msg and msg[0] == 'piece':
+            _, piece_index, block_offset, block_data = msg
+            cancel_peers = []
+            with self.data_lock:
+                requested = peer.pipeline.complete(piece_index, block_offset, len(block_data))
+                is_new = self.piece_manager.receive_block(piece_index, block_offset, block_data, (peer.ip, peer.port))
+                active_pieces[:] = [p for p in active_pieces if p.is_downloading]
+                holders = self.endgame_holders.pop((piece_index, block_offset), None)
+                if is_new and holders:
+                    # First copy arrived; everyone else who has it requested can stop sending it.
+                    cancel_peers = [p for p in holders if p is not peer]
+            for other in cancel_peers:
+                other.send_cancels([(piece_index, block_offset, len(block_data))])
+            if self.metrics:
+                self.metrics.inc('bt_received_bytes_total', len(block_data))
+                if requested:
+                    self.metrics.observe('bt_request_rtt_seconds', peer.pipeline.last_rtt)
+        elif msg and msg[0] == 'have':
+            with self.data_lock:
+                self.piece_manager.add_peer_have(msg[1])
+        elif msg and msg[0] == 'bitfield':
+            with self.data_lock:
+                self.piece_manager.add_peer_bitfield(peer, msg[1])
+        elif msg and msg[0] == 'choke':
+            # A choking peer discards our queued requests, so hand the blocks back.
+            self.release_requests(peer)
+            self.event('choke', peer=f"{peer.ip}:{peer.port}")
+        elif msg and msg[0] == 'request':
+            self.serve_request(peer, *msg[1:])
+        elif msg and msg[0] == 'extended' and msg[1] == b'ut_metadata':
+            self.serve_metadata(peer, msg[2])
+        elif msg and msg[0] == 'extended' and msg[1] == b'ut_pex':
+            self.receive_pex(peer, msg[2])
+
+        if self.seeding:
+            if peer in self.piece_manager.seed_peers:
+                peer.close()  # two seeds have nothing to trade
+            return
+        if peer.bitfield:
+            peer.send_interested()
+        if not peer.peer_choking and peer.bitfield:
+            self.fill_requests(peer, active_pieces)
+
+    def drop_peer(self, peer, active_pieces):
         peer.close()
+        self.event('disconnect', peer=f"{peer.ip}:{peer.port}", received=peer.pipeline.received_bytes,
+                   sent=peer.uploaded_bytes, seconds=round(time.monotonic() - peer.connected_at, 1))
+        self.connections.peer_disconnected((peer.ip, peer.port), peer.pipeline.received_bytes)
+        self.release_requests(peer)
+        with self.data_lock:
+            for piece in active_pieces:
+                self.piece_manager.release_piece(piece)
+            self.piece_manager.remove_peer(peer)
         if peer in self.peers:
             self.peers.remove(peer)
 
+    def buckets(self, peer, direction):
+        """The token buckets a transfer with this peer draws from: the peer's, ours and the session's."""
+        levels = [peer.limits, self.limits] + ([self.global_limits] if self.global_limits else [])
+        return [getattr(level, direction) for level in levels]
+
+    def set_limits(self, download=None, upload=None, peer_download=None, peer_upload=None):
+        """Changes rate limits (bytes/s, 0 for unlimited) while running; None leaves a limit as it is."""
+        self.limits.set(download, upload)
+        if peer_download is not None or peer_upload is not None:
+            self.peer_rates = (self.peer_rates[0] if peer_download is None else peer_download,
+                               self.peer_rates[1] if peer_upload is None else peer_upload)
+            for peer in list(self.peers):
+                peer.limits.set(*self.peer_rates)
+
+    def fill_requests(self, peer, active_pieces):
+        """Tops the peer's request pipeline up to its current window.
+
+        Download limits work by requesting less rather than by reading slower: blocks are only
+        requested while the token buckets allow, so under a limit the pipeline runs shallow
+        and refills as tokens come back.
+        """
+        blocks = []
+        buckets = self.buckets(peer, 'download')
+        budget = allowance(buckets)
+        if budget <= 0:
+            return
+        requested = 0
+        with self.data_lock:
+            while len(peer.pipeline) + len(blocks) < peer.pipeline.window and requested < budget:
+                block = None
+                for piece in active_pieces:
+                    block = piece.get_block_to_request()
+                    if block:
+                        blocks.append((piece.index,) + block)
+                        requested += block[1]
+                        break
+                if block is None:
+                    piece = self.piece_manager.get_piece_to_download(peer.bitfield)
+                    if not piece:
+                        break
+                    active_pieces.append(piece)
+            # Endgame: a peer that has run dry helps with blocks other peers are still fetching. Only
+            # a few at a time, so a large window doesn't turn into a flood of duplicates. Pieces a
+            # reader is waiting for past their deadline get the same help before endgame.
+            pieces = None if self.piece_manager.in_endgame() else self.piece_manager.overdue_pieces()
+            if not blocks and not len(peer.pipeline) and (pieces is None or pieces):
+                limit = min(peer.pipeline.window, self.endgame_batch)
+                if budget != float('inf'):
+                    limit = min(limit, max(int(budget) // BLOCK_SIZE, 1))
+                blocks = self.piece_manager.get_endgame_blocks(peer.bitfield, lambda i, o: self.skip_endgame_block(peer, i, o),
+                                                               limit, pieces)
+                for piece_index, block_offset, _ in blocks:
+                    key = (piece_index, block_offset)
+                    if key not in self.endgame_holders:
+                        self.endgame_holders[key] = {p for p in self.peers if key in p.pipeline}
+                    self.endgame_holders[key].add(peer)
+        consume(buckets, sum(length for _, _, length in blocks))
+        peer.send_requests(blocks)
+
+    def skip_endgame_block(self, peer, piece_index, block_offset):
+        key = (piece_index, block_offset)
+        if key in peer.pipeline:
+            return True
+        holders = self.endgame_holders.get(key)
+        return holders is not None and (peer in holders or len(holders) >= self.endgame_copies)
+
+    def serve_request(self, peer, piece_index, block_offset, length):
+        """Uploads a requested block if the peer is unchoked and we have the piece.
+
+        While the upload limits are used up, requests wait in the peer's upload queue and are
+        served as tokens come back.
+        """
+        if peer.is_choking or len(peer.upload_queue) >= self.max_upload_queue:
+            return
+        peer.upload_queue.append((piece_index, block_offset, length))
+        self.serve_queued(peer)
+
+    def serve_metadata(self, peer, payload):
+        """Answers a ut_metadata request (BEP 9) with a piece of our info dictionary."""
+        try:
+            msg_type, piece, _ = parse_metadata_message(payload)
+        except (ValueError, IndexError, KeyError, TypeError):
+            return
+        if msg_type != REQUEST:
+            return
+        info = self.torrent.info_bytes
+        start = piece * METADATA_BLOCK
+        if 0 <= start < len(info):
+            reply = metadata_message(DATA, piece, bytes(info[start:start + METADATA_BLOCK]), len(info))
+        else:
+            reply = metadata_message(REJECT, piece)
+        peer.send_extended(b'ut_metadata', reply)
+
+    def receive_pex(self, peer, payload):
+        """Adds the peers a ut_pex message tells us about; peers that send them too often are ignored."""
+        now = time.monotonic()
+        if not self.pex or (peer.pex_received_at is not None and now - peer.pex_received_at < PEX_INTERVAL / 2):
+            return
+        peer.pex_received_at = now
+        try:
+            added = parse_pex(payload)
+        except (ValueError, IndexError, KeyError, TypeError, AttributeError):
+            return
+        self.add_peers(added, 'pex')
+
+    def pex_round(self):
+        """Tells every peer that speaks ut_pex (BEP 11) which peers we connected to and lost since the last time.
+
+        Only peers we know a listening port for are passed on. Runs every PEX_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if not self.pex or now - self.last_pex < PEX_INTERVAL:
+            return
+        self.last_pex = now
+        peers = [p for p in list(self.peers) if p.is_connected()]
+        flags = {}
+        for p in peers:
+            if p.listen_port:
+                flags[(p.ip, p.listen_port)] = (SEED if p in self.piece_manager.seed_peers else 0) | \
+                                               (REACHABLE if p.listen_port == p.port else 0)
+        for peer in peers:
+            if b'ut_pex' not in peer.extensions:
+                continue
+            current = set(flags) - {(peer.ip, peer.listen_port)}
+            added = list(current - peer.pex_sent)[:MAX_PEX_PEERS]
+            dropped = list(peer.pex_sent - current)[:MAX_PEX_PEERS]
+            if not added and not dropped:
+                continue
+            try:
+                peer.send_extended(b'ut_pex', pex_message(added, dropped, flags))
+            except OSError:
+                peer.close()
+                continue
+            peer.pex_sent = (peer.pex_sent - set(dropped)) | set(added)
+
+    def serve_queued(self, peer):
+        """Sends the peer's queued blocks while the upload limits allow."""
+        buckets = self.buckets(peer, 'upload')
+        while peer.upload_queue and allowance(buckets) > 0:
+            piece_index, block_offset, length = peer.upload_queue.popleft()
+            data = self.piece_manager.read_block(piece_index, block_offset, length)
+            if data is not None:
+                peer.send_piece(piece_index, block_offset, data)
+                self.uploaded_bytes += length
+                consume(buckets, length)
+                if self.metrics:
+                    self.metrics.inc('bt_sent_bytes_total', length)
+
+    def choke_round(self):
+        """Applies the choker's decisions. Called about once a second."""
+        unchoke, choke = self.choker.rechoke(list(self.peers), self.seeding)
+        for peer in choke:
+            peer.upload_queue.clear()  # choking discards the requests it has pending
+        for peer, send in [(p, p.send_choke) for p in choke] + [(p, p.send_unchoke) for p in unchoke]:
+            try:
+                send()
+            except OSError:
+                peer.close()
+
+    def start_seeding(self):
+        """Switches to seeding: lose interest in every peer and drop the ones that are seeds too."""
+        self.seeding = True
+        for peer in list(self.peers):
+            try:
+                peer.send_not_interested()
+            except OSError:
+                peer.close()
+            if peer in self.piece_manager.seed_peers:
+                peer.close()
+
+    def check_timeouts(self, peer, active_pieces):
+        """Takes requests back from a peer that is sitting on them so other peers can fetch the blocks.
+
+        A peer that has delivered nothing for request_timeout seconds is snubbing us: all of its
+        requests are cancelled, its pieces go back to the picker and it may only keep one
+        request in flight until it sends a block again. Single requests left unanswered for
+        twice as long, while other blocks do arrive, are cancelled and requested again.
+        """
+        pipeline = peer.pipeline
+        snubbed = pipeline.stalled(self.request_timeout)
+        expired = pipeline.expired(0 if snubbed else 2 * self.request_timeout)
+        if not expired:
+            return
+        peer.send_cancels(expired)
+        with self.data_lock:
+            for piece_index, block_offset, _ in expired:
+                self.piece_manager.pieces[piece_index].release_block(block_offset)
+            if snubbed:
+                pipeline.snub()
+                self.snubs += 1
+                for piece in active_pieces:
+                    self.piece_manager.release_piece(piece)
+                active_pieces.clear()
+        if snubbed:
+            self.event('snub', peer=f"{peer.ip}:{peer.port}", requests=len(expired))
+            with self.print_lock:
+                print(f"\nPeer {peer.ip}:{peer.port} sent nothing for {self.request_timeout}s; "
+                      f"reassigning {len(expired)} requests.")
+
+    def replace_slowest(self):
+        """Disconnects the slowest peer now and then, so a fresh candidate can take its slot.
+
+        Only peers connected for at least replace_interval are considered, and only when we are
+        at the peer target with candidates waiting and the slowest peer downloads at less than
+        half the average rate. The rates decay while a peer sends nothing, so one that went
+        silent counts as the slowest.
+        """
+        now = time.monotonic()
+        if now - self.last_replace < self.replace_interval:
+            return
+        self.last_replace = now
+        if len(self.peers) < self.connections.target_peers or not self.connections.has_candidates():
+            return
+        veterans = [p for p in self.peers if p.is_connected() and now - p.connected_at >= self.replace_interval]
+        if len(veterans) < 2:
+            return
+        rates = {p: p.pipeline.rate for p in veterans}
+        slowest = min(veterans, key=rates.get)
+        average = sum(rates.values()) / len(veterans)
+        if rates[slowest] < average / 2:
+            with self.print_lock:
+                print(f"\nReplacing slow peer {slowest.ip}:{slowest.port} "
+                      f"({rates[slowest] / 1024:.0f} KiB/s vs {average / 1024:.0f} KiB/s average)")
+            slowest.close()
+
+    def piece_verified(self, piece_index, contributors, ok):
+        """Called by the piece manager after every hash check.
+
+        Disconnects peers that the check gets banned and announces a new piece to the peers
+        that don't have it yet. With threads this runs on a disk worker holding the data lock, so
+        the haves are only queued; each peer's loop sends its own (see flush_haves).
+        """
+        banned = self.connections.piece_verified(contributors, ok)
+        self.event('piece', index=piece_index, ok=ok, peers=len(contributors))
+        for peer in list(self.peers):
+            if (peer.ip, peer.port) in banned:
+                self.event('ban', peer=f"{peer.ip}:{peer.port}")
+                with self.print_lock:
+                    print(f"\nBanning peer {peer.ip}:{peer.port} for sending corrupt data.")
+                peer.close()
+            elif ok and not (peer.bitfield and has_piece(peer.bitfield, piece_index)):
+                peer.queue_have(piece_index)
+                if self.async_engine:
+                    self.flush_haves(peer)  # on the loop thread; writes don't block
+
+    def flush_haves(self, peer):
+        try:
+            peer.flush_haves()
+        except OSError:
+            peer.close()
+
+    def release_requests(self, peer):
+        with self.data_lock:
+            for piece_index, block_offset in peer.pipeline.clear():
+                self.piece_manager.pieces[piece_index].release_block(block_offset)
+
+    def process_disk_results(self):
+        with self.data_lock:
+            self.piece_manager.process_completed()
+
+    def check_complete(self):
+        """Tells the trackers once the download completes and switches to seeding if asked to.
+
+        Returns False when the download is complete and there is nothing left to do, i.e. it
+        is time to stop.
+        """
+        if not self.piece_manager.is_done() or self.seeding:
+            return True
+        complete = self.piece_manager.is_complete()
+        with self.print_lock:
+            print(f"\n{'Download' if complete else 'Selected files'} complete: {self.torrent.name}." +
+                  (" Seeding until you quit." if self.seed else ""))
+        self.event('complete', size=self.torrent.total_size, uploaded=self.uploaded_bytes)
+        if complete and not self.was_complete:
+            self.was_complete = True
+            self.trackers.completed()
+        if not self.seed:
+            return False
+        self.seeding = True
+        if self.async_engine:
+            self.async_engine.call_soon(self.start_seeding)
+        else:
+            self.start_seeding()
+        return True
+
+    def event(self, name, **fields):
+        """Records an event (and the counters it feeds) if metrics are on."""
+        if self.metrics:
+            self.metrics.record(name, torrent=self.name, **fields)
+
+    def announced(self, url, event, ok, seconds, peers, error):
+        self.event('announce', url=url, announce_event=event, ok=ok, seconds=round(seconds, 3), peers=peers, error=error)
+
+    def collect_metrics(self):
+        """Gauges for the metrics endpoint, read each time it is scraped."""
+        torrent = {'torrent': self.name}
+        peers = list(self.peers)
+        connections = self.connections.stats()
+        disk = self.piece_manager.disk.stats()
+        samples = [
+            ('bt_peers', torrent, len(peers)),
+            ('bt_peers_connecting', torrent, connections['connecting']),
+            ('bt_peers_known', torrent, connections['known']),
+            ('bt_peers_unchoked', torrent, sum(1 for p in peers if not p.is_choking)),
+            ('bt_outstanding_requests', torrent, sum(len(p.pipeline) for p in peers)),
+            ('bt_upload_queue', torrent, sum(len(p.upload_queue) for p in peers)),
+            ('bt_downloaded_bytes', torrent, self.piece_manager.downloaded_size),
+            ('bt_size_bytes', torrent, self.torrent.total_size),
+            ('bt_buffer_bytes', torrent, self.piece_manager.pool.stats()['in_use_bytes']),
+            ('bt_hash_queue', {}, disk['hash_queue']),
+            ('bt_write_queue', {}, disk['write_queue']),
+            ('bt_disk_pending_bytes', {}, disk['pending_bytes']),
+        ]
+        if self.dht:
+            samples.append(('bt_dht_nodes', {}, len(self.dht.table)))
+        for p in peers:
+            labels = dict(torrent, peer=f"{p.ip}:{p.port}")
+            samples += [('bt_peer_received_bytes', labels, p.pipeline.received_bytes),
+                        ('bt_peer_sent_bytes', labels, p.uploaded_bytes),
+                        ('bt_peer_rate_bytes', labels, round(p.pipeline.rate)),
+                        ('bt_peer_window', labels, p.pipeline.window)]
+        return samples
+
+    def summary(self):
+        """Progress and transfer numbers, e.g. for a session's control interface.
+
+        The rates are bytes/s over the last few seconds, and fall to zero once transfers stop.
+        """
+        now = time.monotonic()
+        if now - self.rate_sample[0] >= 1.0:
+            self.upload_rate = (self.uploaded_bytes - self.rate_sample[1]) / (now - self.rate_sample[0])
+            self.rate_sample = (now, self.uploaded_bytes)
+        return {
+            'downloaded': self.piece_manager.downloaded_size,
+            'size': self.torrent.total_size,
+            'progress': self.piece_manager.downloaded_size / self.torrent.total_size if self.torrent.total_size else 1.0,
+            'peers': len(self.peers),
+            'download_rate': sum(p.pipeline.rate for p in list(self.peers)),
+            'uploaded': self.uploaded_bytes,
+            'upload_rate': self.upload_rate,
+            'download_limit': self.limits.download.rate,
+            'upload_limit': self.limits.upload.rate,
+            'unchoked': sum(1 for p in list(self.peers) if not p.is_choking),
+            'seeding': self.seeding,
+            'buffered': self.piece_manager.pool.stats()['in_use_bytes'],
+        }
+
     def status_loop(self):
         while self.is_running:
-            if self.piece_manager.is_complete():
-                with self.print_lock:
-                    print("\nDownload complete!")
+            if not self.check_complete():
                 self.stop()
                 break
 
             try:
-                with self.data_lock:
-                    needed_pieces_count = len(self.piece_manager.needed_pieces)
+                needed_pieces_count = self.piece_manager.needed_count()
+                connections = self.connections.stats()
+                trackers_ok, trackers_total = self.trackers.status()
                 
                 progress = (self.piece_manager.downloaded_size / self.torrent.total_size) * 100 if self.torrent.total_size > 0 else 0
                 dl_mb = self.piece_manager.downloaded_size / 1024 / 1024
                 total_mb = self.torrent.total_size / 1024 / 1024
                 status_line = (f"Progress: {progress:.2f}% | "
                                f"Downloaded: {dl_mb:.2f}/{total_mb:.2f} MB | "
-                               f"Peers: {len(self.peers)} | "
-                               f"Needed Pieces: {needed_pieces_count}   ")
+                               f"Peers: {len(self.peers)} ({connections['connecting']} connecting, {connections['known']} known, "
+                               f"{connections['banned']} banned, {self.snubs} snubs) | "
+                               f"Trackers: {trackers_ok}/{trackers_total} | "
+                               f"Needed Pieces: {needed_pieces_count} | "
+                               f"Uploaded: {self.uploaded_bytes / 1024 / 1024:.2f} MB "
+                               f"({sum(1 for p in self.peers if not p.is_choking)} unchoked)")
+                if self.piece_manager.in_endgame() or self.piece_manager.duplicate_bytes:
+                    status_line += (f" | Endgame: {self.piece_manager.endgame_requests} reqs, "
+                                    f"dup {self.piece_manager.duplicate_bytes / 1024 / 1024:.2f} MB")
+                if self.dht:
+                    status_line += f" | DHT: {len(self.dht.table)} nodes"
+                disk = self.piece_manager.disk.stats()
+                status_line += (f" | Disk queue: {disk['hash_queue']} hash/{disk['write_queue']} write, "
+                                f"{disk['hash_mb_s']:.0f}/{disk['write_mb_s']:.0f} MB/s")
+                buffers = self.piece_manager.pool.stats()
+                status_line += (f" | Buffers: {buffers['in_use_bytes'] / 1024 / 1024:.0f}"
+                                f"/{buffers['peak_in_use_bytes'] / 1024 / 1024:.0f} MB (now/peak)")
+                rates = self.summary()
+                status_line += (f" | Rate: down {rates['download_rate'] / 1024:.0f} KiB/s "
+                                f"(limit {format_rate(self.limits.download.rate)}), "
+                                f"up {rates['upload_rate'] / 1024:.0f} KiB/s (limit {format_rate(self.limits.upload.rate)})")
+                status_line += "   "
                 with self.print_lock:
                     print(status_line, end='\r')
             except ZeroDivisionError:
@@ -102,6 +756,36 @@ class Downloader:
     def stop(self):
         if self.is_running:
             self.is_running = False
+            if self.metrics:
+                self.metrics.remove_collector(self.collect_metrics)
+                self.event('stop', downloaded=self.piece_manager.downloaded_size, uploaded=self.uploaded_bytes)
             # No need to print here, main will handle final messages
-            for peer in self.peers:
-                peer.close()
+            if self.dht:
+                self.dht.remove_torrent(self.torrent.info_hash)
+            self.trackers.stop()
+            # The asyncio engine closes the piece manager itself, on its loop once its peers are gone.
+            if self.async_engine and self.async_engine.stop():
+                if not self.async_engine.on_loop_thread():
+                    self.closed.wait(60)  # so the caller may exit once we return
+            else:
+                for peer in self.peers:
+                    peer.close()
+                self.piece_manager.disk.stop()
+                self.close_storage()
+            with self.piece_manager.verified:
+                self.piece_manager.verified.notify_all()  # readers waiting on pieces give up
+
+    def close_storage(self):
+        """Applies the last disk results, closes the files and saves resume data, once.
+
+        Stop the disk pipeline first. With the asyncio engine, call it on the loop thread.
+        """
+        with self.close_lock:
+            if self.closing:
+                return
+            self.closing = True
+        try:
+            with self.data_lock:
+                self.piece_manager.close()
+        finally:
+            self.closed.set()
@@ -1,33 +1,225 @@
-import bencodepy
 import hashlib
 import os
+from array import array
+from itertools import accumulate
+
+INT, LIST, DICT, END = b'ilde'
+MAX_DEPTH = 64  # lists and dictionaries nested deeper than this are refused
+
+class FileTable:
+    """The files of a torrent as parallel tables instead of one dict per file.
+
+    `paths` are relative paths, `lengths` the file sizes and `offsets` the start of each file
+    in the torrent's byte stream, with the total size as a final extra entry. Indexing and
+    iterating still give {'path', 'length'} dicts for code that wants them.
+    """
+    def __init__(self, paths, lengths):
+        self.paths = paths
+        self.lengths = array('q', lengths)
+        self.offsets = array('q', accumulate(self.lengths, initial=0))
+
+    @property
+    def total_size(self):
+        return self.offsets[-1]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return {'path': self.paths[index], 'length': self.lengths[index]}
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.paths)))
 
 class Torrent:
-    """Represents and parses a .torrent file."""
+    """Represents and parses a .torrent file.
+
+    The file is read in one pass without building the whole info dictionary: the info hash is
+    taken over the dictionary's raw bytes, the files go into a FileTable and `pieces` is a
+    memoryview of the concatenated SHA-1 hashes. `info` decodes the full dictionary only when
+    something asks for it.
+    """
     def __init__(self, torrent_file_path):
         with open(torrent_file_path, 'rb') as f:
-            meta_info = bencodepy.decode(f.read())
-
-        self.info = meta_info[b'info']
-        self.info_hash = hashlib.sha1(bencodepy.encode(self.info)).digest()
-        self.announce_list = meta_info.get(b'announce-list', [[meta_info[b'announce']]])
-        self.piece_length = self.info[b'piece length']
-        self.pieces = self.info[b'pieces']
-        self.total_size = 0
-
-        if b'files' in self.info:
-            # Multi-file torrent
-            self.files = []
-            for file_info in self.info[b'files']:
-                self.files.append({
-                    'path': os.path.join(*[p.decode('utf-8') for p in file_info[b'path']]),
-                    'length': file_info[b'length']
-                })
-                self.total_size += file_info[b'length']
-        else:
-            # Single-file torrent
-            self.files = [{
-                'path': self.info[b'name'].decode('utf-8'),
-                'length': self.info[b'length']
-            }]
-            self.total_size = self.info[b'length']
+            data = f.read()
+        try:
+            self.load(data)
+        except (ValueError, IndexError, KeyError, TypeError) as e:
+            raise ValueError(f"{torrent_file_path} is not a valid .torrent file ({e})") from None
+
+    @classmethod
+    def from_metadata(cls, info_bytes, announce_list=()):
+        """A Torrent for an info dictionary on its own, e.g. one fetched from peers for a magnet link."""
+        torrent = cls.__new__(cls)
+        data = bytes(info_bytes)
+        if torrent.load_info(data, 0) != len(data):
+            raise ValueError("trailing data after the info dictionary")
+        torrent.info_bytes = memoryview(data)
+        torrent.announce_list = list(announce_list)
+        torrent.info_hash = hashlib.sha1(data).digest()
+        torrent._info = None
+        return torrent
+
+    def load(self, data):
+        announce = None
+        self.announce_list = []
+        self.info_bytes = None
+        pos = expect(data, 0, b'd')
+        while data[pos] != END:
+            key, pos = decode_string(data, pos)
+            if key == b'info':
+                start, pos = pos, self.load_info(data, pos)
+                self.info_bytes = memoryview(data)[start:pos]
+            elif key == b'announce':
+                announce, pos = decode(data, pos)
+            elif key == b'announce-list':
+                self.announce_list, pos = decode(data, pos)
+            else:
+                pos = skip(data, pos)
+        if self.info_bytes is None:
+            raise KeyError('info')
+        if not self.announce_list and announce:
+            self.announce_list = [[announce]]
+        self.info_hash = hashlib.sha1(self.info_bytes).digest()
+        self._info = None
+
+    def load_info(self, data, pos):
+        """Reads the info dictionary at data[pos] and returns where it ends."""
+        fields = {}
+        files = self.pieces = None
+        pos = expect(data, pos, b'd')
+        while data[pos] != END:
+            key, pos = decode_string(data, pos)
+            if key == b'files':
+                files, pos = decode_files(data, pos)
+            elif key == b'pieces':
+                start, pos = string_span(data, pos)
+                self.pieces = memoryview(data)[start:pos]
+            else:
+                fields[key], pos = decode(data, pos)
+        self.name = fields[b'name'].decode('utf-8', 'replace')
+        self.piece_length = fields[b'piece length']
+        self.private = fields.get(b'private') == 1  # BEP 27: peers only from the trackers, no DHT or PEX
+        if files is None:
+            files = FileTable([self.name], [fields[b'length']])
+        self.files = files
+        self.total_size = files.total_size
+        self.num_pieces = len(self.pieces) // 20
+        if self.piece_length <= 0 or len(self.pieces) % 20 or \
+                self.num_pieces != (self.total_size + self.piece_length - 1) // self.piece_length:
+            raise ValueError("piece hashes don't match the size")
+        return pos + 1
+
+    @property
+    def info(self):
+        """The whole info dictionary, decoded on first use."""
+        if self._info is None:
+            self._info = decode(bytes(self.info_bytes), 0)[0]
+        return self._info
+
+    def piece_size(self, index):
+        if index < self.num_pieces - 1:
+            return self.piece_length
+        return self.total_size - index * self.piece_length
+
+    def piece_hash(self, index):
+        return self.pieces[index * 20:(index + 1) * 20]
+
+def decode_files(data, pos):
+    """Reads an info dictionary's file list straight into a FileTable. Returns (table, end)."""
+    paths, lengths = [], []
+    pos = expect(data, pos, b'l')
+    while data[pos] != END:
+        length = None
+        parts = []
+        pos = expect(data, pos, b'd')
+        while data[pos] != END:
+            key, pos = decode_string(data, pos)
+            if key == b'length':
+                length, pos = decode_int(data, pos)
+                if length < 0:
+                    raise ValueError("negative file length")
+            elif key == b'path':
+                pos = expect(data, pos, b'l')
+                while data[pos] != END:
+                    start, pos = string_span(data, pos)
+                    parts.append(bytes(data[start:pos]).decode('utf-8'))
+                pos += 1
+            else:
+                pos = skip(data, pos)
+        if length is None or not parts or pos >= len(data):
+            raise ValueError("file entry without a length or path")
+        paths.append(os.sep.join(parts))
+        lengths.append(length)
+        pos += 1
+    return FileTable(paths, lengths), pos + 1
+
+def decode(data, pos, depth=0):
+    """Decodes the bencoded value at data[pos]. Returns (value, end).
+
+    Malformed input raises ValueError (or IndexError when it stops short), never loops or
+    recurses without bound: it may come straight from a peer or a UDP packet.
+    """
+    if depth > MAX_DEPTH:
+        raise ValueError("bencoded value nested too deeply")
+    kind = data[pos]
+    if kind == INT:
+        return decode_int(data, pos)
+    if kind == LIST:
+        items = []
+        pos += 1
+        while data[pos] != END:
+            item, pos = decode(data, pos, depth + 1)
+            items.append(item)
+        return items, pos + 1
+    if kind == DICT:
+        items = {}
+        pos += 1
+        while data[pos] != END:
+            key, pos = decode_string(data, pos)
+            items[key], pos = decode(data, pos, depth + 1)
+        return items, pos + 1
+    return decode_string(data, pos)
+
+def decode_int(data, pos):
+    pos = expect(data, pos, b'i')
+    end = data.index(b'e', pos)
+    digits = bytes(data[pos:end])
+    if not digits.removeprefix(b'-').isdigit():
+        raise ValueError(f"bad integer at byte {pos}")
+    return int(digits), end + 1
+
+def decode_string(data, pos):
+    start, end = string_span(data, pos)
+    return bytes(data[start:end]), end
+
+def string_span(data, pos):
+    """(start, end) of the bencoded string at data[pos]."""
+    colon = data.index(b':', pos)
+    digits = bytes(data[pos:colon])
+    if not digits.isdigit():  # ASCII digits only, so the length can't be negative or empty
+        raise ValueError(f"bad string length at byte {pos}")
+    start = colon + 1
+    end = start + int(digits)
+    if end > len(data):
+        raise ValueError("string runs past the end")
+    return start, end
+
+def skip(data, pos, depth=0):
+    """Returns where the bencoded value at data[pos] ends, without decoding it."""
+    if depth > MAX_DEPTH:
+        raise ValueError("bencoded value nested too deeply")
+    kind = data[pos]
+    if kind == INT:
+        return decode_int(data, pos)[1]
+    if kind == LIST or kind == DICT:
+        pos += 1
+        while data[pos] != END:
+            pos = skip(data, pos, depth + 1)  # dictionary keys are strings, skipped like any value
+        return pos + 1
+    return string_span(data, pos)[1]
+
+def expect(data, pos, marker):
+    if data[pos] != marker[0]:
+        raise ValueError(f"expected {marker!r} at byte {pos}")
+    return pos + 1
@@ -1,112 +1,275 @@
 import socket
 import struct
 import random
+import threading
+import time
 import requests
 import bencodepy
+from concurrent.futures import ThreadPoolExecutor, wait
 from urllib.parse import urlparse
 
+UDP_EVENTS = {'': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+def parse_compact_peers(data):
+    """[(ip, port)] from the compact format: 4 bytes of IPv4 address and 2 of port per peer."""
+    peers = []
+    for i in range(0, len(data) - 5, 6):
+        port = struct.unpack('!H', data[i + 4:i + 6])[0]
+        if port:
+            peers.append((socket.inet_ntoa(data[i:i + 4]), port))
+    return peers
+
+def compact_peers(addresses):
+    """The compact format of (ip, port) addresses; anything that isn't IPv4 is left out."""
+    packed = []
+    for ip, port in addresses:
+        try:
+            packed.append(socket.inet_aton(ip) + struct.pack('!H', port))
+        except (OSError, struct.error):
+            continue
+    return b''.join(packed)
+
 class Tracker:
     """Handles communication with a tracker."""
-    def __init__(self, torrent, peer_id, print_lock):
+    def __init__(self, torrent, peer_id, print_lock, port=6881):
         self.torrent = torrent
         self.peer_id = peer_id
         self.print_lock = print_lock
+        self.port = port
+        self.key = random.randint(0, 2**32 - 1)
+        self.udp_connections = {}  # (host, port) -> (connection_id, obtained_at)
 
-    def get_peers(self):
-        """Gets a list of peers from the tracker."""
-        peers = set()
-        for tier in self.torrent.announce_list:
-            for announce_url in tier:
-                try:
-                    url = announce_url.decode('utf-8')
-                    if url.startswith('udp'):
-                        new_peers = self.get_peers_udp(url)
-                    else:
-                        new_peers = self.get_peers_http(url)
-                    
-                    peers.update(new_peers)
-                    if peers:
-                        return list(peers) # Return as soon as we get some peers
-                except Exception as e:
-                    with self.print_lock:
-                        print(f"\nError getting peers from {announce_url.decode('utf-8')}: {e}")
-        return list(peers)
-
-    def get_peers_http(self, announce_url):
-        """Gets peers from an HTTP tracker."""
+    def announce(self, url, event='started', uploaded=0, downloaded=0, left=None, numwant=200, timeout=None):
+        """Announces to one tracker URL.
+
+        Returns {'peers': [(ip, port)], 'interval': seconds, 'min_interval': seconds or None}.
+        Raises on network errors and tracker failures.
+        """
+        left = self.torrent.total_size if left is None else left
+        if url.startswith('udp'):
+            return self.announce_udp(url, event, uploaded, downloaded, left, numwant, timeout or 8)
+        return self.announce_http(url, event, uploaded, downloaded, left, numwant, timeout or 10)
+
+    def announce_http(self, announce_url, event, uploaded, downloaded, left, numwant, timeout):
+        """Announces to an HTTP tracker."""
         params = {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6881,
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': self.torrent.total_size,
+            'port': self.port,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
             'compact': 1,
-            'event': 'started'
+            'numwant': numwant,
+            'key': '%08x' % self.key,
         }
-        
-        try:
-            response = requests.get(announce_url, params=params, timeout=10)
-            response.raise_for_status()
-            tracker_response = bencodepy.decode(response.content)
-            
+        if event:
+            params['event'] = event
+
+        response = requests.get(announce_url, params=params, timeout=timeout)
+        response.raise_for_status()
+        tracker_response = bencodepy.decode(response.content)
+        if not isinstance(tracker_response, dict):
+            raise ValueError("tracker response is not a dictionary")
+        if b'failure reason' in tracker_response:
+            raise Exception(tracker_response[b'failure reason'].decode('utf-8', 'replace'))
+
+        raw_peers = tracker_response.get(b'peers', b'')
+        if isinstance(raw_peers, bytes):
+            peers = parse_compact_peers(raw_peers)
+        else:
             peers = []
-            if isinstance(tracker_response[b'peers'], bytes):
-                for i in range(0, len(tracker_response[b'peers']), 6):
-                    ip = socket.inet_ntoa(tracker_response[b'peers'][i:i+4])
-                    port = struct.unpack('!H', tracker_response[b'peers'][i+4:i+6])[0]
-                    peers.append((ip, port))
-            else:
-                for peer_info in tracker_response[b'peers']:
-                    peers.append((peer_info[b'ip'].decode('utf-8'), peer_info[b'port']))
-            return peers
-        except requests.RequestException as e:
-            with self.print_lock:
-                print(f"\nHTTP tracker request failed: {e}")
-            return []
+            for peer_info in raw_peers:
+                peers.append((peer_info[b'ip'].decode('utf-8'), peer_info[b'port']))
+        interval, min_interval = tracker_response.get(b'interval', 1800), tracker_response.get(b'min interval')
+        if not isinstance(interval, int) or not isinstance(min_interval, (int, type(None))):
+            raise ValueError("tracker sent a non-numeric interval")
+        return {'peers': peers, 'interval': interval, 'min_interval': min_interval}
 
-    def get_peers_udp(self, announce_url):
-        """Gets peers from a UDP tracker."""
+    def announce_udp(self, announce_url, event, uploaded, downloaded, left, numwant, timeout):
+        """Announces to a UDP tracker (BEP 15)."""
         parsed_url = urlparse(announce_url)
+        address = (parsed_url.hostname, parsed_url.port)
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(8)
+        sock.settimeout(timeout)
 
         try:
-            conn_id = 0x41727101980
+            conn_id = self.udp_connection_id(sock, address)
             transaction_id = random.randint(0, 2**32 - 1)
-            
-            packet = struct.pack('!QII', conn_id, 0, transaction_id)
-            sock.sendto(packet, (parsed_url.hostname, parsed_url.port))
-            
-            res, _ = sock.recvfrom(16)
-            action, res_transaction_id, conn_id = struct.unpack('!IIQ', res)
-            
-            if action != 0 or transaction_id != res_transaction_id:
-                raise Exception("UDP tracker connection failed")
-
-            transaction_id = random.randint(0, 2**32 - 1)
-            packet = struct.pack('!QII20s20sQQQIIIIH',
+            packet = struct.pack('!QII20s20sQQQIIIiH',
                                  conn_id, 1, transaction_id,
                                  self.torrent.info_hash, self.peer_id.encode('utf-8'),
-                                 0, self.torrent.total_size, 0,
-                                 2, 0, random.randint(0, 2**32-1), -1, 6881)
-            sock.sendto(packet, (parsed_url.hostname, parsed_url.port))
-            
-            res, _ = sock.recvfrom(2048)
+                                 downloaded, left, uploaded,
+                                 UDP_EVENTS[event], 0, self.key, numwant, self.port)
+            sock.sendto(packet, address)
+
+            res, _ = sock.recvfrom(4096)
             action, res_transaction_id = struct.unpack('!II', res[:8])
-            
+
             if action != 1 or transaction_id != res_transaction_id:
+                self.udp_connections.pop(address, None)
                 raise Exception("UDP tracker announce failed")
-            
-            peers = []
-            for i in range(20, len(res), 6):
-                ip, port = struct.unpack('!IH', res[i:i+6])
-                peers.append((socket.inet_ntoa(struct.pack('!I', ip)), port))
+            interval = struct.unpack('!I', res[8:12])[0]
 
-            return peers
-        except Exception as e:
-            with self.print_lock:
-                print(f"\nUDP tracker error: {e}")
-            return []
+            return {'peers': parse_compact_peers(res[20:]), 'interval': interval, 'min_interval': None}
         finally:
             sock.close()
+
+    def udp_connection_id(self, sock, address):
+        """Returns a connection id for the tracker, reusing one obtained in the last minute."""
+        cached = self.udp_connections.get(address)
+        if cached and time.monotonic() - cached[1] < 60:
+            return cached[0]
+        transaction_id = random.randint(0, 2**32 - 1)
+        sock.sendto(struct.pack('!QII', 0x41727101980, 0, transaction_id), address)
+
+        res, _ = sock.recvfrom(16)
+        action, res_transaction_id, conn_id = struct.unpack('!IIQ', res)
+
+        if action != 0 or transaction_id != res_transaction_id:
+            raise Exception("UDP tracker connection failed")
+        self.udp_connections[address] = (conn_id, time.monotonic())
+        return conn_id
+
+class TrackerState:
+    """Announce schedule of one tracker URL."""
+    def __init__(self, url, tier):
+        self.url = url
+        self.tier = tier
+        self.started = False     # a 'started' event has been accepted
+        self.pending_event = 'started'
+        self.busy = False        # an announce is in flight
+        self.next_announce = 0.0
+        self.earliest_announce = 0.0  # min interval: no announce before this, even when short of peers
+        self.failures = 0
+        self.last_peers = 0
+        self.last_error = None
+
+class TrackerManager:
+    """Announces to every tracker of a torrent at once and keeps re-announcing.
+
+    Each URL has its own schedule: the next regular announce is `interval` seconds after the
+    last one, or earlier (but never before `min interval`) when `wants_peers()` says the swarm
+    is running dry. Failed trackers are retried with exponential backoff. Peers go to
+    `on_peers` as they arrive. `stats()` supplies the (uploaded, downloaded, left) counts.
+    `on_announce(url, event, ok, seconds, peers, error)`, if set, hears about every announce.
+    """
+    def __init__(self, torrent, peer_id, print_lock, on_peers, stats, wants_peers=None, port=6881,
+                 max_workers=32, default_min_interval=60, stop_timeout=5):
+        self.tracker = Tracker(torrent, peer_id, print_lock, port)
+        self.print_lock = print_lock
+        self.on_peers = on_peers
+        self.stats = stats
+        self.wants_peers = wants_peers or (lambda: False)
+        self.default_min_interval = default_min_interval
+        self.stop_timeout = stop_timeout
+        self.states = []
+        seen = set()
+        for tier_index, tier in enumerate(torrent.announce_list):
+            for announce_url in tier:
+                url = announce_url.decode('utf-8')
+                if url not in seen and url.startswith(('http', 'udp')):
+                    seen.add(url)
+                    self.states.append(TrackerState(url, tier_index))
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(self.states))))
+        self.thread = None
+        self.on_announce = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            short_of_peers = self.wants_peers()
+            with self.lock:
+                due = [s for s in self.states if not s.busy and
+                       (now >= s.next_announce or (short_of_peers and now >= s.earliest_announce))]
+                for state in due:
+                    state.busy = True
+            for state in due:
+                self.pool.submit(self.announce, state)
+            self.stopping.wait(1.0)
+
+    def announce(self, state, event=None):
+        event = state.pending_event if event is None else event
+        uploaded, downloaded, left = self.stats()
+        start = time.monotonic()
+        try:
+            result = self.tracker.announce(state.url, event, uploaded, downloaded, left)
+        except Exception as e:
+            if self.stopping.is_set():
+                return
+            if self.on_announce:
+                self.on_announce(state.url, event, False, time.monotonic() - start, 0, str(e))
+            with self.lock:
+                state.busy = False
+                state.failures += 1
+                state.last_error = str(e)
+                retry = min(15 * 2 ** state.failures, 1800)
+                state.next_announce = state.earliest_announce = time.monotonic() + retry
+            with self.print_lock:
+                print(f"\nTracker {state.url} failed ({e}); retrying in {retry}s")
+            return
+        now = time.monotonic()
+        if self.on_announce:
+            self.on_announce(state.url, event, True, now - start, len(result['peers']), None)
+        with self.lock:
+            state.busy = False
+            state.failures = 0
+            state.last_error = None
+            state.last_peers = len(result['peers'])
+            if event == 'started':
+                state.started = True
+            if state.pending_event == event:
+                state.pending_event = ''
+            interval = max(result['interval'], 1)
+            min_interval = result['min_interval'] or min(interval, self.default_min_interval)
+            if state.pending_event:
+                state.next_announce = now  # an event (e.g. completed) was raised while this one was in flight
+            else:
+                state.next_announce = now + interval
+            state.earliest_announce = now + min_interval
+        if not self.stopping.is_set():
+            self.on_peers(result['peers'])
+
+    def completed(self):
+        """Sends a 'completed' event to every tracker that saw our 'started'."""
+        with self.lock:
+            for state in self.states:
+                if state.started:
+                    state.pending_event = 'completed'
+                    state.next_announce = 0.0
+
+    def status(self):
+        """(trackers that answered their last announce, total trackers)."""
+        with self.lock:
+            return sum(1 for s in self.states if s.started and s.failures == 0), len(self.states)
+
+    def stop(self):
+        """Stops re-announcing and tells the trackers we are leaving, waiting at most stop_timeout."""
+        self.stopping.set()
+        if self.thread:
+            self.thread.join(2)
+        self.pool.shutdown(wait=False)
+        with self.lock:
+            started = [s for s in self.states if s.started]
+        if not started:
+            return
+        farewell = ThreadPoolExecutor(max_workers=len(started))
+        futures = [farewell.submit(self.farewell, state) for state in started]
+        wait(futures, self.stop_timeout)
+        farewell.shutdown(wait=False)
+
+    def farewell(self, state):
+        uploaded, downloaded, left = self.stats()
+        timeout = self.stop_timeout
+        try:
+            if state.pending_event == 'completed':
+                self.tracker.announce(state.url, 'completed', uploaded, downloaded, left, 0, timeout)
+            self.tracker.announce(state.url, 'stopped', uploaded, downloaded, left, 0, timeout)
+        except Exception:
+            pass  # we are leaving either way
@@ -0,0 +1,235 @@
+import asyncio
+import struct
+import time
+
+from peer import Peer
+
+class AsyncPeer(Peer):
+    """A Peer whose connection is an asyncio stream pair instead of a blocking socket."""
+    def __init__(self, ip, port, torrent, peer_id, min_requests=2, max_requests=250):
+        super().__init__(ip, port, torrent, peer_id, min_requests, max_requests)
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, timeout=5):
+        """Connects to the peer and performs the handshake."""
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), timeout)
+            self.writer.write(self.handshake_message())
+            response = await asyncio.wait_for(self.reader.readexactly(68), timeout)
+            self.check_handshake(response)
+            return True
+        except Exception:
+            self.close()
+            return False
+
+    async def accept(self, reader, writer, timeout=5, handshake=None):
+        """Takes over an inbound connection and answers the remote peer's handshake.
+
+        `handshake` is the peer's handshake if the caller already read it (e.g. to pick the torrent).
+        """
+        self.reader, self.writer = reader, writer
+        try:
+            self.check_handshake(handshake or await asyncio.wait_for(reader.readexactly(68), timeout))
+            self.writer.write(self.handshake_message())
+            return True
+        except Exception:
+            self.close()
+            return False
+
+    def send(self, msg):
+        self.writer.write(msg)
+
+    async def drain(self):
+        if self.writer:
+            await self.writer.drain()
+
+    async def receive_message(self):
+        """Waits for the next message and processes it."""
+        msg_len = struct.unpack('!I', await self.reader.readexactly(4))[0]
+        self.last_message_time = time.time()
+        if msg_len == 0:
+            return None
+        if msg_len > self.max_message:
+            raise ValueError(f"peer sent a {msg_len}-byte message (limit {self.max_message})")
+        packet = memoryview(await self.reader.readexactly(msg_len))
+        return self.handle_message(packet[0], packet[1:])
+
+    def is_connected(self):
+        return self.writer is not None
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+
+class AsyncEngine:
+    """Drives every peer connection of a Downloader from a single asyncio event loop.
+
+    All PieceManager calls happen on the loop thread, so no lock is needed around them.
+    """
+    def __init__(self, downloader):
+        self.downloader = downloader
+        self.loop = None
+        self.stopped = None
+        self.active_pieces = {}  # peer -> pieces that peer is filling
+        self.tasks = set()
+
+    async def run(self):
+        """Connects to peers handed out by the connection manager and runs them until stopped."""
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.connect_wakeup = asyncio.Event()
+        self.downloader.piece_manager.disk.notify = self.process_disk_results
+        self.downloader.connections.notify = self.wake_connect
+        if self.downloader.is_running:
+            server = None
+            if self.downloader.listen_sock:
+                server = await asyncio.start_server(self.accept, sock=self.downloader.listen_sock, backlog=64)
+            self.track(asyncio.create_task(self.tick()))
+            self.track(asyncio.create_task(self.maintain()))
+            await self.stopped.wait()
+            if server:
+                server.close()
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # Nothing on the loop touches the pieces any more: let the disk finish (its results
+        # are applied here, on the loop), then close the piece manager.
+        await self.loop.run_in_executor(None, self.downloader.piece_manager.disk.stop)
+        self.downloader.close_storage()
+
+    def track(self, task):
+        """Keeps a task in self.tasks until it finishes, so stopping can cancel it."""
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def wake_connect(self):
+        """Called from any thread when the connection manager may have new candidates."""
+        self.call_soon(self.connect_wakeup.set)
+
+    async def maintain(self, interval=1.0):
+        """Starts a connection task for each candidate the connection manager hands out."""
+        d = self.downloader
+        while d.is_running:
+            self.connect_wakeup.clear()
+            for ip, port in d.connections.take_candidates():
+                self.track(asyncio.create_task(self.connect_and_run(ip, port)))
+            d.replace_slowest()
+            d.choke_round()
+            d.pex_round()
+            try:
+                await asyncio.wait_for(self.connect_wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        """Stops the engine; safe to call from any thread.
+
+        Returns True if the loop will close the piece manager once the engine is done, False if
+        there is no loop to do it (the engine never ran, or has finished) and the caller must.
+        """
+        if self.loop is None or self.loop.is_closed():
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.set_stopped)
+        except RuntimeError:
+            return False  # the loop has already shut down
+        return True
+
+    def on_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def set_stopped(self):
+        if self.stopped:
+            self.stopped.set()  # otherwise run() hasn't started and returns as soon as it does
+
+    def call_soon(self, callback):
+        """Runs `callback` on the loop thread; safe to call from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass  # the loop has already shut down
+
+    def process_disk_results(self):
+        """Called from disk worker threads; applies their results on the loop thread."""
+        self.call_soon(self.downloader.piece_manager.process_completed)
+
+    async def connect_and_run(self, ip, port):
+        d = self.downloader
+        peer = AsyncPeer(ip, port, d.torrent, d.peer_id, d.min_requests, d.max_requests)
+        if not await peer.connect() or not d.is_running:
+            peer.close()
+            d.peer_failed(ip, port)
+            return
+        d.peer_ready(peer)
+        await self.peer_loop(peer)
+
+    async def accept(self, reader, writer, handshake=None):
+        """Serves an inbound peer connection."""
+        d = self.downloader
+        self.track(asyncio.current_task())
+        ip, port = writer.get_extra_info('peername')[:2]
+        if not d.is_running or not d.connections.accept_inbound((ip, port)):
+            writer.close()
+            return
+        peer = AsyncPeer(ip, port, d.torrent, d.peer_id, d.min_requests, d.max_requests)
+        if not await peer.accept(reader, writer, handshake=handshake) or not d.is_running:
+            peer.close()
+            d.peer_failed(ip, port)
+            return
+        d.peer_ready(peer, inbound=True)
+        try:
+            await self.peer_loop(peer)
+        except asyncio.CancelledError:
+            pass  # stopping; asyncio's stream server would log a cancelled handler as an error
+
+    async def tick(self, interval=1.0):
+        """Checks request timeouts and gives idle peers a chance to request work, like the socket
+        timeout does for peer threads.
+
+        Without it a peer with an empty pipeline would wait forever for a message, e.g. once
+        endgame blocks or released pieces become available.
+        """
+        d = self.downloader
+        while d.is_running:
+            before = self.loop.time()
+            await asyncio.sleep(interval)
+            if d.metrics:
+                d.metrics.observe('bt_loop_lag_seconds', max(self.loop.time() - before - interval, 0.0))
+            for peer, active_pieces in list(self.active_pieces.items()):
+                if not peer.is_connected():
+                    continue
+                d.check_timeouts(peer, active_pieces)
+                if not len(peer.pipeline):
+                    d.handle_peer_message(peer, None, active_pieces)
+
+    async def warm_read_cache(self, piece_index):
+        """Reads a requested piece on a worker thread so serving it doesn't block the loop on disk."""
+        pm = self.downloader.piece_manager
+        if pm.has(piece_index) and not pm.read_cache.contains(piece_index):
+            await self.loop.run_in_executor(None, pm.read_cache.load, piece_index)
+
+    async def peer_loop(self, peer):
+        d = self.downloader
+        active_pieces = self.active_pieces[peer] = []
+        try:
+            while d.is_running and peer.is_connected():
+                msg = await peer.receive_message()
+                if msg and msg[0] == 'request':
+                    await self.warm_read_cache(msg[1])
+                d.handle_peer_message(peer, msg, active_pieces)
+                await peer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            with d.print_lock:
+                print(f"\nError in peer loop for {peer.ip}:{peer.port}: {e}")
+        finally:
+            self.active_pieces.pop(peer, None)
+            d.drop_peer(peer, active_pieces)
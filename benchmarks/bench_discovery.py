@@ -0,0 +1,78 @@
+"""Benchmarks peer discovery without trackers: DHT lookups on a loopback cluster, then whole
+downloads that find their seeders through the tracker, peer exchange or the DHT only.
+
+    python -m benchmarks.bench_discovery
+    python -m benchmarks.bench_discovery --nodes 100 500 --lookups 20 --discovery dht
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import time
+
+from benchmarks.dht_cluster import DHTCluster
+from benchmarks.swarm import Swarm, run_download
+from dht import DHT, K
+
+def bench_lookups(size, lookups, peers_per_hash):
+    """Times get_peers from a fresh node against a cluster of `size` nodes. Returns medians."""
+    cluster = DHTCluster(size).start()
+    try:
+        hashes = {}
+        for i in range(lookups):
+            info_hash = os.urandom(20)
+            hashes[info_hash] = [('127.0.0.%d' % (j + 1), 10000 + i) for j in range(peers_per_hash)]
+            cluster.announce(info_hash, hashes[info_hash])
+        with contextlib.redirect_stdout(io.StringIO()):
+            node = DHT(port=0, bootstrap=[cluster.bootstrap], query_timeout=1.0).start()
+        start = time.perf_counter()
+        while node.table.good() < K and time.perf_counter() - start < 30:
+            time.sleep(0.05)
+        joined = time.perf_counter() - start
+        seconds, queries, found = [], [], []
+        for info_hash, peers in hashes.items():
+            before = node.stats()['queries_sent']
+            start = time.perf_counter()
+            result = node.get_peers(info_hash)
+            seconds.append(time.perf_counter() - start)
+            queries.append(node.stats()['queries_sent'] - before)
+            found.append(len(set(result) & set(peers)) / len(peers))
+        node.stop()
+        return {'join': joined, 'seconds': statistics.median(seconds), 'queries': statistics.median(queries),
+                'found': statistics.mean(found)}
+    finally:
+        cluster.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[50, 200], help='DHT cluster sizes for the lookups.')
+    parser.add_argument('--lookups', type=int, default=10, help='Info hashes looked up per cluster size.')
+    parser.add_argument('--peers-per-hash', type=int, default=5)
+    parser.add_argument('--discovery', nargs='+', choices=['tracker', 'pex', 'dht'], default=['tracker', 'pex', 'dht'])
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--seeders', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    if args.nodes:
+        print(f"{'nodes':>6} {'join s':>7} {'lookup ms':>10} {'queries':>8} {'found':>6}")
+        for size in args.nodes:
+            result = bench_lookups(size, args.lookups, args.peers_per_hash)
+            print(f"{size:>6} {result['join']:>7.2f} {result['seconds'] * 1000:>10.1f} {result['queries']:>8.0f} "
+                  f"{result['found']:>6.0%}", flush=True)
+        print()
+    print(f"{'discovery':>9} {'known':>6} {'connected':>10} {'first piece s':>14} {'download s':>11}")
+    for discovery in args.discovery:
+        swarm = Swarm(size=args.size_mb * 2**20, seeders=args.seeders, latency=args.latency, discovery=discovery).start()
+        try:
+            result = run_download(swarm, 'asyncio', args.timeout)
+        finally:
+            swarm.close()
+        print(f"{discovery:>9} {result['known']:>6} {result['connected']:>10} "
+              f"{result['first_piece'] if result['first_piece'] is not None else float('nan'):>14.2f} "
+              f"{result['seconds'] if result['complete'] else float('nan'):>11.2f}", flush=True)
+
+if __name__ == '__main__':
+    main()
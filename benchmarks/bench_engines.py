@@ -0,0 +1,33 @@
+"""Compares the thread-per-peer and asyncio peer engines against a loopback seeder.
+
+    python -m benchmarks.bench_engines --peers 50 200 500 --size-mb 256 --latency 0.02
+"""
+import argparse
+
+from benchmarks.swarm import Swarm, run_download
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--peers', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--engines', nargs='+', default=['threads', 'asyncio'])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--piece-kb', type=int, default=256)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every handshake and block.')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    swarm = Swarm(args.size_mb * 1024 * 1024, args.piece_kb * 1024, seeders=max(args.peers), latency=args.latency).start()
+
+    print(f"{'engine':<8} {'peers':>5} {'conn':>5} {'done':>5} {'secs':>7} {'1st pc':>7} {'cpu s':>7} {'threads':>7} {'MB/s':>7}")
+    try:
+        for num_peers in args.peers:
+            for engine in args.engines:
+                r = run_download(swarm, engine, args.timeout, target_peers=num_peers)
+                first = f"{r['first_piece']:.2f}" if r['first_piece'] is not None else '-'
+                print(f"{r['engine']:<8} {r['peers']:>5} {r['connected']:>5} {str(r['complete']):>5} {r['seconds']:>7.2f} "
+                      f"{first:>7} {r['cpu']:>7.2f} {r['threads']:>7} {r['mb_s']:>7.1f}", flush=True)
+    finally:
+        swarm.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Benchmarks magnet links: time to fetch the metadata from loopback seeders, then to download.
+
+The seeders serve the info dictionary over ut_metadata, so a larger --files count means
+more metadata pieces to spread over the peers. --corrupt makes some seeders lie.
+
+    python -m benchmarks.bench_magnet
+    python -m benchmarks.bench_magnet --files 5000 --seeders 20 --corrupt 5
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from benchmarks.swarm import Swarm, run_download
+from magnet import Magnet, MetadataFetcher
+
+def fetch(swarm, timeout):
+    """Fetches the swarm's metadata once. Returns (seconds, metadata bytes, peers it came from)."""
+    fetcher = MetadataFetcher(Magnet(swarm.magnet), port=0)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        torrent = fetcher.fetch(timeout)
+    return time.perf_counter() - start, len(torrent.info_bytes), len(set(fetcher.contributors.values()))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--files', type=int, nargs='+', default=[1, 1000, 10000])
+    parser.add_argument('--seeders', type=int, default=10)
+    parser.add_argument('--corrupt', type=int, default=0, help='Seeders that send corrupt metadata and blocks.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every reply.')
+    parser.add_argument('--repeat', type=int, default=3, help='Metadata fetches per case; the median is reported.')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    print(f"{'files':>6} {'metadata KB':>12} {'peers used':>11} {'fetch s':>8} {'download s':>11}")
+    for num_files in args.files:
+        swarm = Swarm(size=args.size_mb * 2**20, num_files=num_files, seeders=args.seeders, latency=args.latency,
+                      corrupt=args.corrupt).start()
+        try:
+            runs = sorted(fetch(swarm, args.timeout) for _ in range(args.repeat))
+            seconds, size, peers = runs[len(runs) // 2]
+            download = run_download(swarm, 'asyncio', args.timeout)
+            print(f"{num_files:>6} {size / 1024:>12.0f} {peers:>11} {seconds:>8.2f} "
+                  f"{download['seconds'] if download['complete'] else float('nan'):>11.2f}", flush=True)
+        finally:
+            swarm.close()
+
+if __name__ == '__main__':
+    main()
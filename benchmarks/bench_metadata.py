@@ -0,0 +1,121 @@
+"""Benchmarks startup: loading a .torrent and setting up its piece table, old way versus new.
+
+The old way decodes the whole file with bencodepy, re-encodes the info dictionary to hash
+it, builds a dict per file and then a Piece for every piece up front. The new Torrent hashes
+the raw info bytes, keeps files in arrays and piece hashes in a memoryview, and PieceTable
+makes Pieces on demand.
+
+    python -m benchmarks.bench_metadata                     # everything in Test Files
+    python -m benchmarks.bench_metadata --files 50000       # plus a synthetic many-file torrent
+"""
+import argparse
+import gc
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import bencodepy
+
+from Torrent import Torrent
+from peice import Piece, PieceTable
+
+class LegacyTorrent:
+    """The previous Torrent, with the piece helpers Piece needs."""
+    def __init__(self, torrent_file_path):
+        with open(torrent_file_path, 'rb') as f:
+            meta_info = bencodepy.decode(f.read())
+        self.info = meta_info[b'info']
+        self.info_hash = hashlib.sha1(bencodepy.encode(self.info)).digest()
+        self.piece_length = self.info[b'piece length']
+        self.pieces = self.info[b'pieces']
+        self.total_size = 0
+        if b'files' in self.info:
+            self.files = []
+            for file_info in self.info[b'files']:
+                self.files.append({
+                    'path': os.path.join(*[p.decode('utf-8') for p in file_info[b'path']]),
+                    'length': file_info[b'length']
+                })
+                self.total_size += file_info[b'length']
+        else:
+            self.files = [{'path': self.info[b'name'].decode('utf-8'), 'length': self.info[b'length']}]
+            self.total_size = self.info[b'length']
+
+    def piece_size(self, index):
+        length = self.piece_length if index < (len(self.pieces) // 20 - 1) else self.total_size % self.piece_length
+        return length or self.piece_length
+
+    def piece_hash(self, index):
+        return self.pieces[index*20 : (index+1)*20]
+
+def legacy_startup(path):
+    torrent = LegacyTorrent(path)
+    return torrent, [Piece(i, torrent) for i in range(len(torrent.pieces) // 20)]
+
+def startup(path):
+    torrent = Torrent(path)
+    return torrent, PieceTable(torrent, bytearray((torrent.num_pieces + 7) // 8))
+
+def measure(load, path, repeat):
+    """Best time of `repeat` loads and the memory the result holds on to."""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = load(path)
+        times.append(time.perf_counter() - start)
+        del result
+    gc.collect()
+    tracemalloc.start()
+    result = load(path)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return min(times), memory
+
+def synthetic_torrent(directory, num_files, piece_length):
+    lengths = [100_000 + i for i in range(num_files)]
+    num_pieces = (sum(lengths) + piece_length - 1) // piece_length
+    info = {b'name': b'synthetic', b'piece length': piece_length, b'pieces': os.urandom(20 * num_pieces),
+            b'files': [{b'length': length, b'path': [b'dir%d' % (i % 100), b'file%06d.bin' % i]}
+                       for i, length in enumerate(lengths)]}
+    path = os.path.join(directory, f'synthetic-{num_files}-files.torrent')
+    with open(path, 'wb') as f:
+        f.write(bencodepy.encode({b'announce': b'http://127.0.0.1:1/announce', b'info': info}))
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('torrents', nargs='*', help='.torrent files (default: everything in Test Files)')
+    parser.add_argument('--files', type=int, default=0, help='Also time a synthetic torrent with this many files.')
+    parser.add_argument('--piece-kb', type=int, default=64, help='Piece size of the synthetic torrent.')
+    parser.add_argument('--repeat', type=int, default=3, help='Loads per torrent; the best time is reported.')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench-metadata-')
+    try:
+        paths = args.torrents or sorted(glob.glob('Test Files/*.torrent'))
+        if args.files:
+            paths.append(synthetic_torrent(work_dir, args.files, args.piece_kb * 1024))
+        print(f"{'torrent':<32} {'files':>6} {'pieces':>8} {'legacy ms':>10} {'new ms':>8} {'speedup':>8} "
+              f"{'legacy MB':>10} {'new MB':>7}")
+        for path in paths:
+            try:
+                torrent = Torrent(path)
+            except ValueError as e:
+                print(e)
+                continue
+            old_seconds, old_memory = measure(legacy_startup, path, args.repeat)
+            new_seconds, new_memory = measure(startup, path, args.repeat)
+            print(f"{os.path.basename(path)[:32]:<32} {len(torrent.files):>6} {torrent.num_pieces:>8} "
+                  f"{old_seconds * 1000:>10.1f} {new_seconds * 1000:>8.1f} {old_seconds / new_seconds:>7.1f}x "
+                  f"{old_memory / 1e6:>10.1f} {new_memory / 1e6:>7.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Benchmarks building the Piece list: the old per-block dicts versus compact block state.
+
+Measures the time and traced memory to construct one Piece per piece of each torrent, as
+PieceManager does at startup, and the cost of requesting and receiving every block of a
+sample of pieces.
+
+    python -m benchmarks.bench_pieces "Test Files/Grand Theft Auto V [FitGirl Repack].torrent"
+"""
+import argparse
+import gc
+import glob
+import os
+import time
+import tracemalloc
+
+from Torrent import Torrent
+from peice import Piece
+
+class LegacyPiece:
+    """The original Piece, with a dict per block."""
+    def __init__(self, index, torrent):
+        self.index = index
+        self.torrent = torrent
+        self.length = torrent.piece_length if index < (len(torrent.pieces) // 20 - 1) else torrent.total_size % torrent.piece_length
+        if self.length == 0: self.length = torrent.piece_length
+        self.hash = torrent.pieces[index*20 : (index+1)*20]
+        self.data = None
+        self.blocks = []
+        self.is_complete = False
+        self.is_downloading = False
+        self.init_blocks()
+
+    def init_blocks(self):
+        self.blocks = []
+        num_blocks = (self.length + 16383) // 16384
+        for i in range(num_blocks):
+            offset = i * 16384
+            length = min(16384, self.length - offset)
+            self.blocks.append({'offset': offset, 'length': length, 'status': 'needed'})
+
+    def add_block(self, offset, data):
+        for block in self.blocks:
+            if block['offset'] == offset:
+                if block['status'] == 'downloaded':
+                    return False
+                block['status'] = 'downloaded'
+                break
+        self.data[offset:offset+len(data)] = data
+        if all(b['status'] == 'downloaded' for b in self.blocks):
+            self.is_complete = True
+        return True
+
+    def get_block_to_request(self):
+        for block in self.blocks:
+            if block['status'] == 'needed':
+                block['status'] = 'requested'
+                return block['offset'], block['length']
+        return None
+
+def construct(cls, torrent):
+    num_pieces = len(torrent.pieces) // 20
+    gc.collect()
+    start = time.perf_counter()
+    pieces = [cls(i, torrent) for i in range(num_pieces)]
+    elapsed = time.perf_counter() - start
+    del pieces
+    gc.collect()
+    tracemalloc.start()
+    pieces = [cls(i, torrent) for i in range(num_pieces)]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return pieces, elapsed, memory
+
+def download(pieces, sample):
+    """Requests and receives every block of `sample` pieces, in request order."""
+    block = bytes(16384)
+    start = time.perf_counter()
+    for piece in pieces[:sample]:
+        piece.data = bytearray(piece.length)
+        while True:
+            request = piece.get_block_to_request()
+            if request is None:
+                break
+            offset, length = request
+            piece.add_block(offset, block[:length])
+        piece.data = None
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('torrents', nargs='*', help='.torrent files (default: everything in Test Files)')
+    parser.add_argument('--sample', type=int, default=200, help='pieces to fully download per torrent')
+    args = parser.parse_args()
+
+    print(f"{'torrent':<32} {'pieces':>7} {'blocks':>9} {'impl':<8} {'build s':>8} {'MB':>8} {'us/block':>9}")
+    for path in args.torrents or sorted(glob.glob('Test Files/*.torrent')):
+        try:
+            torrent = Torrent(path)
+        except Exception as e:
+            print(f"{path}: could not load ({e})")
+            continue
+        num_pieces = len(torrent.pieces) // 20
+        num_blocks = (torrent.total_size + 16383) // 16384
+        name = os.path.basename(path)[:32]
+        for impl, cls in (('legacy', LegacyPiece), ('compact', Piece)):
+            pieces, elapsed, memory = construct(cls, torrent)
+            sample_blocks = sum((p.length + 16383) // 16384 for p in pieces[:args.sample])
+            per_block = download(pieces, args.sample) * 1e6 / sample_blocks
+            print(f"{name:<32} {num_pieces:>7} {num_blocks:>9} {impl:<8} {elapsed:>8.3f} {memory / 1e6:>8.1f} {per_block:>9.2f}")
+            del pieces
+
+if __name__ == '__main__':
+    main()
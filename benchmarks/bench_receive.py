@@ -0,0 +1,110 @@
+"""Micro-benchmark of the peer receive path: bytes copied and CPU per MB received.
+
+Streams piece messages through a socketpair and compares the old bytes-concatenating
+framing with Peer's preallocated recv_into buffer.
+
+    python -m benchmarks.bench_receive --mb 256
+"""
+import argparse
+import socket
+import struct
+import threading
+import time
+
+from peer import Peer
+
+BLOCK = 16384
+
+def build_stream(total_mb, piece_length=262144):
+    """Piece messages for `total_mb` of data, with a `have` after every piece."""
+    block = bytes(range(256)) * (BLOCK // 256)
+    blocks_per_piece = piece_length // BLOCK
+    messages = []
+    for n in range(total_mb * 1024 * 1024 // BLOCK):
+        index, offset = divmod(n, blocks_per_piece)
+        messages.append(struct.pack('!IBII', 9 + BLOCK, 7, index, offset * BLOCK) + block)
+        if offset == blocks_per_piece - 1:
+            messages.append(struct.pack('!IBI', 5, 4, index))
+    return b''.join(messages)
+
+class LegacyReceiver:
+    """The original Peer.receive_message framing, instrumented to count copied bytes."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.bytes_copied = 0
+
+    def receive_message(self):
+        data = self.sock.recv(4096)
+        if not data:
+            return 'eof'
+        self.buffer += data
+        self.bytes_copied += len(self.buffer)
+        while len(self.buffer) >= 4:
+            msg_len = struct.unpack('!I', self.buffer[:4])[0]
+            if len(self.buffer) < 4 + msg_len:
+                break
+            packet = self.buffer[4:4+msg_len]
+            self.buffer = self.buffer[4+msg_len:]
+            self.bytes_copied += msg_len + len(self.buffer)
+            if msg_len == 0: continue
+            msg_id = packet[0]
+            payload = packet[1:]
+            self.bytes_copied += len(payload)
+            if msg_id == 7:
+                piece_index, block_offset = struct.unpack('!II', payload[:8])
+                block_data = payload[8:]
+                self.bytes_copied += len(block_data)
+                return ('piece', piece_index, block_offset, block_data)
+        return None
+
+def sender(sock, stream):
+    sock.sendall(stream)
+    sock.shutdown(socket.SHUT_WR)
+
+def run(kind, stream):
+    a, b = socket.socketpair()
+    b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    if kind == 'legacy':
+        receiver = LegacyReceiver(b)
+        copied = lambda: receiver.bytes_copied
+    else:
+        receiver = Peer('127.0.0.1', 0, None, '-BENCH0-000000000000')
+        receiver.sock = b
+        copied = lambda: receiver.buffer.bytes_copied
+    piece = bytearray(262144)  # stands in for Piece.data
+    block_copies = 0
+    received = 0
+
+    threading.Thread(target=sender, args=(a, stream), daemon=True).start()
+    cpu_start = time.thread_time()
+    wall_start = time.perf_counter()
+    while True:
+        msg = receiver.receive_message()
+        if msg == 'eof' or (msg is None and kind == 'peer' and receiver.sock is None):
+            break
+        if msg and msg[0] == 'piece':
+            _, _, offset, data = msg
+            piece[offset:offset+len(data)] = data
+            block_copies += len(data)
+            received += len(data)
+    cpu = time.thread_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    a.close()
+    b.close()
+    mb = received / 1024 / 1024
+    return {'kind': kind, 'mb': mb, 'cpu_ms_per_mb': cpu * 1000 / mb, 'mb_s': mb / wall,
+            'copied_per_byte': (copied() + block_copies) / received}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mb', type=int, default=256)
+    args = parser.parse_args()
+    stream = build_stream(args.mb)
+    print(f"{'path':<7} {'MB':>6} {'CPU ms/MB':>10} {'MB/s':>8} {'bytes copied per byte':>22}")
+    for kind in ('legacy', 'peer'):
+        r = run(kind, stream)
+        print(f"{r['kind']:<7} {r['mb']:>6.0f} {r['cpu_ms_per_mb']:>10.2f} {r['mb_s']:>8.1f} {r['copied_per_byte']:>22.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmarks piece writes: the old per-piece file scan + open/seek/write/close versus Storage.
+
+Uses the layout of a torrent in Test Files (or a synthetic one with --files) and writes a
+sample of its pieces into sparse files under a temporary directory.
+
+    python -m benchmarks.bench_storage "Test Files/Grand Theft Auto V [FitGirl Repack].torrent"
+    python -m benchmarks.bench_storage --files 5000 --pieces 2000
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+from Torrent import Torrent, FileTable
+from storage import Storage, MmapStorage
+
+def legacy_write(torrent, download_dir, index, data):
+    """The original PieceManager.write_piece_to_disk."""
+    piece_offset = index * torrent.piece_length
+    current_pos = 0
+    for file_info in torrent.files:
+        file_start = current_pos
+        file_end = file_start + file_info['length']
+        if piece_offset < file_end and (piece_offset + len(data)) > file_start:
+            write_start = max(piece_offset, file_start)
+            write_end = min(piece_offset + len(data), file_end)
+            path = os.path.join(download_dir, file_info['path'])
+            with open(path, 'r+b') as f:
+                f.seek(write_start - file_start)
+                f.write(data[write_start - piece_offset:write_end - piece_offset])
+        current_pos = file_end
+
+def synthetic_layout(num_files, piece_length, file_size):
+    files = FileTable([os.path.join('dir%d' % (i % 50), 'file%05d.bin' % i) for i in range(num_files)], [file_size] * num_files)
+    return SimpleNamespace(files=files, piece_length=piece_length, total_size=files.total_size)
+
+def run(name, torrent, download_dir, indices, write):
+    num_pieces = (torrent.total_size + torrent.piece_length - 1) // torrent.piece_length
+    buffers = {}
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for index in indices:
+        length = min(torrent.piece_length, torrent.total_size - index * torrent.piece_length)
+        data = buffers.get(length) or buffers.setdefault(length, os.urandom(length))
+        write(index, data)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    mb = sum(min(torrent.piece_length, torrent.total_size - i * torrent.piece_length) for i in indices) / 1e6
+    print(f"{name:<8} {len(indices):>7} {num_pieces:>8} {len(torrent.files):>6} {elapsed * 1e6 / len(indices):>11.1f} "
+          f"{cpu * 1e6 / len(indices):>11.1f} {mb / elapsed:>8.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('torrent', nargs='?', help='.torrent whose file layout to use')
+    parser.add_argument('--files', type=int, default=2000, help='synthetic layout: number of files')
+    parser.add_argument('--file-kb', type=int, default=700, help='synthetic layout: size of each file')
+    parser.add_argument('--piece-kb', type=int, default=256, help='synthetic layout: piece length')
+    parser.add_argument('--pieces', type=int, default=1000, help='pieces to write per backend')
+    args = parser.parse_args()
+
+    if args.torrent:
+        torrent = Torrent(args.torrent)
+    else:
+        torrent = synthetic_layout(args.files, args.piece_kb * 1024, args.file_kb * 1024)
+    num_pieces = (torrent.total_size + torrent.piece_length - 1) // torrent.piece_length
+    indices = random.Random(1).sample(range(num_pieces), min(args.pieces, num_pieces))
+
+    work_dir = tempfile.mkdtemp(prefix='bench-storage-')
+    try:
+        storage = Storage(torrent, work_dir)
+        storage.allocate()
+        print(f"{'backend':<8} {'pieces':>7} {'total':>8} {'files':>6} {'us/piece':>11} {'cpu us/pc':>11} {'MB/s':>8}")
+        run('legacy', torrent, work_dir, indices, lambda i, d: legacy_write(torrent, work_dir, i, d))
+        run('pwrite', torrent, work_dir, indices, lambda i, d: storage.write(i * torrent.piece_length, d))
+        storage.close()
+        if len(torrent.files) == 1:
+            mapped = MmapStorage(torrent, work_dir)
+            run('mmap', torrent, work_dir, indices, lambda i, d: mapped.write(i * torrent.piece_length, d))
+            mapped.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
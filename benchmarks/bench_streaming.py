@@ -0,0 +1,98 @@
+"""Benchmarks reading the first file of a multi-file torrent while it downloads: time to the
+first byte and to the whole file, by piece strategy, with and without a reader and file priorities.
+
+The seeders are bandwidth-limited so the whole download takes a while and the order pieces
+arrive in matters.
+
+    python -m benchmarks.bench_streaming
+    python -m benchmarks.bench_streaming --files 64 --size-mb 128 --bandwidth-kb 256
+"""
+import argparse
+import contextlib
+import io
+import shutil
+import tempfile
+import threading
+import time
+
+from benchmarks.swarm import Swarm
+from Downloader import Downloader
+
+CASES = {
+    # name: (strategy, read file 0 through open_file, file priorities)
+    'rarest': ('rarest', False, None),
+    'sequential': ('sequential', False, None),
+    'rarest+reader': ('rarest', True, None),
+    'priority+reader': ('rarest', True, {0: 7}),
+    'only-first': ('rarest', True, 'only-first'),  # every other file at priority 0
+}
+
+def run_case(swarm, strategy, reader, priorities, engine, timeout):
+    """Downloads the swarm's torrent once. Returns seconds to file 0's first byte, to all of file 0,
+    and to the end of the download (None for what didn't happen in time)."""
+    download_dir = tempfile.mkdtemp(prefix='bench-stream-')
+    result = {'first_byte': None, 'file': None, 'done': None}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            dl = Downloader(swarm.torrent_path, download_dir, engine=engine, strategy=strategy,
+                            target_peers=swarm.seeders, listen_port=None,
+                            file_priorities=[1] + [0] * (swarm.num_files - 1) if priorities == 'only-first' else priorities)
+            files = dl.torrent.files
+            pl = dl.torrent.piece_length
+            file_pieces = range(files.offsets[0] // pl, (files.offsets[1] - 1) // pl + 1)
+            start = time.perf_counter()
+            threading.Thread(target=dl.start, daemon=True).start()
+
+            def read_file():
+                with dl.open_file(0, timeout=timeout) as f:
+                    while f.read(1 << 20):
+                        if result['first_byte'] is None:
+                            result['first_byte'] = time.perf_counter() - start
+                result['file'] = time.perf_counter() - start
+
+            if reader:
+                thread = threading.Thread(target=read_file, daemon=True)
+                thread.start()
+            while time.perf_counter() - start < timeout and not dl.piece_manager.is_done():
+                if not reader:
+                    if result['first_byte'] is None and dl.piece_manager.has(file_pieces[0]):
+                        result['first_byte'] = time.perf_counter() - start
+                    if result['file'] is None and all(dl.piece_manager.has(i) for i in file_pieces):
+                        result['file'] = time.perf_counter() - start
+                time.sleep(0.01)
+            if dl.piece_manager.is_done():
+                result['done'] = time.perf_counter() - start
+            if reader:
+                thread.join(timeout)
+            elif result['file'] is None and all(dl.piece_manager.has(i) for i in file_pieces):
+                result['file'] = result['done']
+            dl.stop()
+        return result
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--files', type=int, default=16)
+    parser.add_argument('--seeders', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--bandwidth-kb', type=int, default=512, help='Upload limit of each seeder connection in KiB/s.')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='asyncio')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    swarm = Swarm(size=args.size_mb * 2**20, num_files=args.files, seeders=args.seeders, latency=args.latency,
+                  bandwidth=args.bandwidth_kb * 1024).start()
+    try:
+        print(f"{'case':>16} {'first byte s':>13} {'file 0 s':>9} {'done s':>7}")
+        for name in args.cases:
+            result = run_case(swarm, *CASES[name], args.engine, args.timeout)
+            print(f"{name:>16} " + " ".join(f"{result[k] if result[k] is not None else float('nan'):>{w}.2f}"
+                                            for k, w in (('first_byte', 13), ('file', 9), ('done', 7))), flush=True)
+    finally:
+        swarm.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""End-to-end download benchmarks against a local swarm, for catching performance regressions.
+
+Each scenario is a synthetic torrent served by loopback seeders with a given latency,
+bandwidth and loss. The downloader is run against it and the table shows throughput, time
+to first piece and to completion, CPU time, peak RSS and lock contention (waits / takes of
+the most contended lock).
+
+    python -m benchmarks.bench_swarm                              # every scenario, both engines
+    python -m benchmarks.bench_swarm --scenarios quick lossy --engines asyncio
+    python -m benchmarks.bench_swarm --size-mb 512 --seeders 100 --latency 0.05 --loss 0.01
+    python -m benchmarks.bench_swarm --save baseline.json         # before a change
+    python -m benchmarks.bench_swarm --compare baseline.json      # after it; exits 1 on a regression
+"""
+import argparse
+import json
+import statistics
+import sys
+
+from benchmarks.swarm import Swarm, run_download
+
+# name -> Swarm arguments
+SCENARIOS = {
+    'quick': dict(size=32 * 2**20, seeders=10),
+    'latency': dict(size=64 * 2**20, seeders=50, latency=0.05),
+    'bandwidth': dict(size=32 * 2**20, seeders=20, bandwidth=512 * 1024),
+    'lossy': dict(size=32 * 2**20, seeders=20, latency=0.02, loss=0.02),
+    'many-files': dict(size=64 * 2**20, seeders=20, num_files=2000),
+    'small-pieces': dict(size=32 * 2**20, seeders=20, piece_length=32 * 1024),
+}
+
+def custom_scenario(args):
+    return dict(size=args.size_mb * 2**20, piece_length=args.piece_kb * 1024, num_files=args.files, seeders=args.seeders,
+                latency=args.latency, bandwidth=args.bandwidth_kb * 1024, loss=args.loss)
+
+def run_scenario(name, swarm_args, engines, repeat, timeout, processes):
+    """Runs every engine `repeat` times; returns one result per engine with the median of each measure."""
+    swarm = Swarm(processes=processes, **swarm_args).start()
+    results = []
+    try:
+        for engine in engines:
+            runs = [run_download(swarm, engine, timeout) for _ in range(repeat)]
+            result = dict(runs[len(runs) // 2], scenario=name, runs=len(runs),
+                          complete=all(r['complete'] for r in runs))
+            for key in ('seconds', 'mb_s', 'cpu', 'peak_rss_mb', 'rss_growth_mb'):
+                values = [r[key] for r in runs if r[key] is not None]
+                result[key] = statistics.median(values) if values else None
+            firsts = [r['first_piece'] for r in runs if r['first_piece'] is not None]
+            result['first_piece'] = statistics.median(firsts) if firsts else None
+            results.append(result)
+            print_result(result)
+    finally:
+        swarm.close()
+    return results
+
+def print_header():
+    print(f"{'scenario':<13} {'engine':<8} {'done':>5} {'MB/s':>7} {'1st pc':>7} {'secs':>7} {'cpu s':>7} "
+          f"{'RSS MB':>7} {'+RSS':>6}  lock contention")
+
+def print_result(r):
+    first = f"{r['first_piece']:.2f}" if r['first_piece'] is not None else '-'
+    rss = f"{r['peak_rss_mb']:.0f}" if r['peak_rss_mb'] is not None else '-'
+    growth = f"{r['rss_growth_mb']:.0f}" if r['rss_growth_mb'] is not None else '-'
+    name, lock = max(r['locks'].items(), key=lambda item: item[1]['wait_ms'])
+    contention = f"{name} {lock['contended']}/{lock['acquisitions']} ({lock['wait_ms']:.0f} ms)"
+    print(f"{r['scenario']:<13} {r['engine']:<8} {str(r['complete']):>5} {r['mb_s']:>7.1f} {first:>7} "
+          f"{r['seconds']:>7.2f} {r['cpu']:>7.2f} {rss:>7} {growth:>6}  {contention}", flush=True)
+
+def compare(results, baseline, tolerance):
+    """Prints throughput and CPU changes against a saved run. Returns the regressions found."""
+    previous = {(r['scenario'], r['engine']): r for r in baseline}
+    regressions = []
+    print(f"\nAgainst the baseline (regression: more than {tolerance:.0%} slower or more CPU):")
+    for r in results:
+        old = previous.get((r['scenario'], r['engine']))
+        if old is None:
+            continue
+        speed = r['mb_s'] / old['mb_s'] - 1 if old['mb_s'] else 0.0
+        cpu = r['cpu'] / old['cpu'] - 1 if old['cpu'] else 0.0
+        regressed = not r['complete'] or speed < -tolerance or cpu > tolerance
+        if regressed:
+            regressions.append(r)
+        print(f"  {r['scenario']:<13} {r['engine']:<8} MB/s {speed:+7.1%}  cpu {cpu:+7.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), help='Named scenarios to run (default: all).')
+    parser.add_argument('--engines', nargs='+', default=['threads', 'asyncio'])
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per engine; the median is reported.')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seeder-processes', type=int, default=1, help='Processes serving the loopback seeders.')
+    custom = parser.add_argument_group('custom scenario (any of these replaces the named scenarios)')
+    custom.add_argument('--size-mb', type=int, default=64)
+    custom.add_argument('--piece-kb', type=int, default=256)
+    custom.add_argument('--files', type=int, default=1)
+    custom.add_argument('--seeders', type=int, default=20)
+    custom.add_argument('--latency', type=float, default=0.0, help='Seconds added to every block.')
+    custom.add_argument('--bandwidth-kb', type=int, default=0, help='KiB/s per seeder connection, 0 for no limit.')
+    custom.add_argument('--loss', type=float, default=0.0, help='Fraction of blocks delayed by a retransmission.')
+    parser.add_argument('--save', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Compare with results saved by --save; exit 1 on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed slowdown before --compare fails.')
+    args = parser.parse_args()
+
+    custom_flags = ('--size-mb', '--piece-kb', '--files', '--seeders', '--latency', '--bandwidth-kb', '--loss')
+    if any(arg.split('=')[0] in custom_flags for arg in sys.argv[1:]):
+        scenarios = {'custom': custom_scenario(args)}
+    else:
+        scenarios = {name: SCENARIOS[name] for name in args.scenarios or SCENARIOS}
+
+    print_header()
+    results = []
+    for name, swarm_args in scenarios.items():
+        results += run_scenario(name, swarm_args, args.engines, args.repeat, args.timeout, args.seeder_processes)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Exercises TrackerManager against local HTTP and UDP tracker stand-ins.
+
+Compares time to first peers with the old one-tier-at-a-time announce when the first tier is
+dead and the second is slow, then checks the started/completed/stopped events and their
+counts, and the interval / min interval re-announce schedule.
+
+    python -m benchmarks.bench_trackers
+"""
+import argparse
+import threading
+import time
+from types import SimpleNamespace
+
+from Tracker import Tracker, TrackerManager
+from benchmarks.tracker import TrackerStandIn, blackhole_udp
+
+INFO_HASH = bytes(range(20))
+PEER_ID = '-PY0001-benchmark000'
+
+def fake_torrent(announce_list, total_size=100 * 2**20):
+    return SimpleNamespace(info_hash=INFO_HASH, total_size=total_size,
+                           announce_list=[[url.encode('utf-8') for url in tier] for tier in announce_list])
+
+def fake_peers(tier, count):
+    return [('10.0.%d.%d' % (tier, i + 1), 6881) for i in range(count)]
+
+def legacy_get_peers(torrent):
+    """The original Tracker.get_peers: tiers in order, stop at the first tracker with peers."""
+    tracker = Tracker(torrent, PEER_ID, threading.Lock())
+    for tier in torrent.announce_list:
+        for announce_url in tier:
+            try:
+                peers = tracker.announce(announce_url.decode('utf-8'))['peers']
+                if peers:
+                    return peers
+            except Exception:
+                pass
+    return []
+
+def discovery(args):
+    dead_url, dead_sock = blackhole_udp()
+    slow, fast = TrackerStandIn(delay=args.slow_delay), TrackerStandIn()
+    tiers = [[dead_url], [slow.start_http()], [fast.start_http()], [fast.start_udp()]]
+    slow.preload(INFO_HASH, fake_peers(1, 30))
+    fast.preload(INFO_HASH, fake_peers(2, 40))
+    torrent = fake_torrent(tiers)
+    print(f"Discovery: tier 0 never answers, tier 1 answers after {args.slow_delay}s, tiers 2-3 at once")
+    try:
+        start = time.perf_counter()
+        peers = legacy_get_peers(torrent)
+        print(f"  {'sequential':<12} first peers {time.perf_counter() - start:6.2f}s, {len(set(peers)):>3} peers")
+
+        found, first = set(), []
+        def on_peers(new):
+            if new and not first:
+                first.append(time.perf_counter() - start)
+            found.update(new)
+        manager = TrackerManager(torrent, PEER_ID, threading.Lock(), on_peers, lambda: (0, 0, torrent.total_size))
+        start = time.perf_counter()
+        manager.start()
+        while time.perf_counter() - start < args.slow_delay + 1:
+            time.sleep(0.05)
+        manager.stop()
+        print(f"  {'concurrent':<12} first peers {first[0] if first else float('nan'):6.2f}s, {len(found):>3} peers "
+              f"after {args.slow_delay + 1:.0f}s")
+    finally:
+        slow.close()
+        fast.close()
+        dead_sock.close()
+
+def events():
+    tracker = TrackerStandIn()
+    tiers = [[tracker.start_http()], [tracker.start_udp()]]
+    torrent = fake_torrent(tiers)
+    counts = {'uploaded': 0, 'downloaded': 0, 'left': torrent.total_size}
+    manager = TrackerManager(torrent, PEER_ID, threading.Lock(), lambda peers: None,
+                             lambda: (counts['uploaded'], counts['downloaded'], counts['left']))
+    manager.start()
+    time.sleep(0.5)
+    counts.update(uploaded=5 * 2**20, downloaded=torrent.total_size, left=0)
+    manager.completed()
+    time.sleep(1.5)
+    manager.stop()
+    print("Events (protocol event uploaded downloaded left):")
+    for a in tracker.announces:
+        print(f"  {a['protocol']:<5} {a['event'] or '-':<10} {a['uploaded']:>10} {a['downloaded']:>10} {a['left']:>10}")
+    tracker.close()
+
+def schedule():
+    print("Re-announce schedule over 5s:")
+    for label, interval, min_interval, short in (('interval 2s', 2, None, False),
+                                                  ('interval 1800s', 1800, 1, False),
+                                                  ('min interval 1s, short of peers', 1800, 1, True)):
+        tracker = TrackerStandIn(interval=interval, min_interval=min_interval)
+        torrent = fake_torrent([[tracker.start_http()]])
+        manager = TrackerManager(torrent, PEER_ID, threading.Lock(), lambda peers: None,
+                                 lambda: (0, 0, torrent.total_size), wants_peers=lambda: short)
+        manager.start()
+        time.sleep(5)
+        manager.stop()
+        announces = [a for a in tracker.announces if a['event'] != 'stopped']
+        print(f"  {label:<32} {len(announces)} announces")
+        tracker.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--slow-delay', type=float, default=2.0, help='seconds the slow tracker takes to answer')
+    args = parser.parse_args()
+    discovery(args)
+    events()
+    schedule()
+
+if __name__ == '__main__':
+    main()
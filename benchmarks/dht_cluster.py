@@ -0,0 +1,59 @@
+"""A cluster of DHT nodes on loopback addresses, for testing lookups and DHT-only downloads offline.
+
+    cluster = DHTCluster(200).start()
+    cluster.announce(info_hash, [('127.0.0.1', 6881)])
+    node = DHT(port=0, bootstrap=[cluster.bootstrap]).start()
+"""
+import contextlib
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dht import DHT, K
+
+class DHTCluster:
+    """`size` DHT nodes, each on its own 127.1.x.y address, joined through the first one.
+
+    `announce` makes peers findable: a node bound to each peer's IP announces the peer's port,
+    so the stored address is the peer's own, as if it ran a DHT node itself.
+    """
+    def __init__(self, size=100, query_timeout=1.0):
+        self.size = size
+        self.query_timeout = query_timeout
+        self.nodes = []
+        self.announcers = {}  # ip -> DHT bound to it
+        self.bootstrap = None
+
+    def node(self, host):
+        with contextlib.redirect_stdout(io.StringIO()):
+            node = DHT(port=0, host=host, bootstrap=[self.bootstrap] if self.bootstrap else [],
+                       query_timeout=self.query_timeout).start()
+        self.nodes.append(node)
+        if self.bootstrap is None:
+            self.bootstrap = (host, node.port)
+        return node
+
+    def start(self, timeout=60):
+        """Starts the nodes and waits until each knows K others (or `timeout` runs out)."""
+        for i in range(self.size):
+            self.node('127.1.%d.%d' % (i // 250, i % 250 + 1))
+        self.settle(timeout)
+        return self
+
+    def settle(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and min(n.table.good() for n in self.nodes) < min(K, len(self.nodes) - 1):
+            time.sleep(0.2)
+
+    def announce(self, info_hash, peers):
+        """Announces (ip, port) peers for an info hash from nodes on those IPs."""
+        for ip, _ in peers:
+            if ip not in self.announcers:
+                self.announcers[ip] = self.node(ip)
+        self.settle(30)
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(lambda peer: self.announcers[peer[0]].get_peers(info_hash, port=peer[1]), peers))
+
+    def close(self):
+        for node in self.nodes:
+            node.stop()
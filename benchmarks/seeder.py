@@ -0,0 +1,154 @@
+import asyncio
+import random
+import socket
+import struct
+
+import bencodepy
+
+UT_METADATA = 3  # the ids we give ut_metadata and ut_pex in our extension handshake
+UT_PEX = 4
+
+class Seeder:
+    """A loopback seeder that holds the whole payload in memory and serves every piece.
+
+    `latency` delays the handshake and every block response, emulating a network round trip
+    without limiting how many requests can be in flight. `bandwidth` (bytes/s, 0 for none)
+    is the uplink of each connection: blocks queue behind each other at that rate. `loss` is
+    the chance that a block needs a retransmission; TCP never loses data outright, so a lost
+    block arrives `rto` seconds late instead. A misbehaving seeder can be emulated with
+    `behavior`: 'corrupt' flips a byte in every block, 'stall' accepts requests and never
+    answers them, 'reject' rejects every metadata request.
+
+    With `metadata` (the raw info dictionary) it also speaks the extension protocol and hands
+    out the metadata over ut_metadata (BEP 9), as magnet links need; 'corrupt' corrupts that
+    too. With `pex_peers`, a list of (ip, port), it tells clients that speak ut_pex (BEP 11)
+    about those peers, leaving out the address they connected to.
+    """
+    def __init__(self, payload, info_hash, piece_length, latency=0.0, behavior=None, bandwidth=0, loss=0.0, rto=0.2,
+                 metadata=None, pex_peers=None):
+        self.payload = payload
+        self.info_hash = info_hash
+        self.piece_length = piece_length
+        self.latency = latency
+        self.behavior = behavior
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.rto = rto
+        self.metadata = metadata
+        self.pex_peers = pex_peers
+        num_pieces = (len(payload) + piece_length - 1) // piece_length
+        self.bitfield = bytearray((num_pieces + 7) // 8)
+        for i in range(num_pieces):
+            self.bitfield[i // 8] |= 1 << (7 - i % 8)
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != self.info_hash:
+                return
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            extensions = (self.metadata is not None or self.pex_peers) and handshake[25] & 0x10
+            reserved = bytes([0, 0, 0, 0, 0, 0x10, 0, 0]) if extensions else bytes(8)
+            writer.write(struct.pack('!B19s8s20s20s', 19, b'BitTorrent protocol', reserved, self.info_hash,
+                                     b'-BENCH0-000000000000'))
+            writer.write(struct.pack('!IB', len(self.bitfield) + 1, 5) + self.bitfield)
+            if extensions:
+                ext_handshake = {b'm': {b'ut_metadata': UT_METADATA, b'ut_pex': UT_PEX}}
+                if self.metadata is not None:
+                    ext_handshake[b'metadata_size'] = len(self.metadata)
+                self.write_extended(writer, 0, bencodepy.encode(ext_handshake))
+            remote_ut_metadata = None
+            loop = asyncio.get_running_loop()
+            link_free_at = loop.time()  # when this connection's uplink has sent everything queued so far
+            while True:
+                msg_len = struct.unpack('!I', await reader.readexactly(4))[0]
+                if msg_len == 0:
+                    continue
+                msg = await reader.readexactly(msg_len)
+                if msg[0] == 2:
+                    writer.write(struct.pack('!IB', 1, 1))
+                elif msg[0] == 20 and extensions and msg[1] == 0:
+                    remote_extensions = bencodepy.decode(msg[2:]).get(b'm', {})
+                    remote_ut_metadata = remote_extensions.get(b'ut_metadata')
+                    if self.pex_peers and remote_extensions.get(b'ut_pex'):
+                        own_ip = writer.get_extra_info('sockname')[0]
+                        added = [(ip, port) for ip, port in self.pex_peers if ip != own_ip][:50]
+                        compact = b''.join(socket.inet_aton(ip) + struct.pack('!H', port) for ip, port in added)
+                        self.write_extended(writer, remote_extensions[b'ut_pex'],
+                                            bencodepy.encode({b'added': compact, b'added.f': bytes(len(added))}))
+                elif msg[0] == 20 and self.metadata is not None and msg[1] == UT_METADATA and remote_ut_metadata:
+                    request = bencodepy.decode(msg[2:])
+                    piece = request[b'piece']
+                    if request[b'msg_type'] != 0 or self.behavior == 'stall':
+                        continue
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    data = self.metadata[piece * 16384:(piece + 1) * 16384]
+                    if not data or self.behavior == 'reject':
+                        self.write_extended(writer, remote_ut_metadata, bencodepy.encode({b'msg_type': 2, b'piece': piece}))
+                        continue
+                    if self.behavior == 'corrupt':
+                        data = bytes([data[0] ^ 0xff]) + data[1:]
+                    header = {b'msg_type': 1, b'piece': piece, b'total_size': len(self.metadata)}
+                    self.write_extended(writer, remote_ut_metadata, bencodepy.encode(header) + data)
+                elif msg[0] == 6:
+                    if self.behavior == 'stall':
+                        continue
+                    index, offset, length = struct.unpack('!III', msg[1:13])
+                    start = index * self.piece_length + offset
+                    data = self.payload[start:start + length]
+                    if self.behavior == 'corrupt':
+                        data = bytes([data[0] ^ 0xff]) + data[1:]
+                    block = struct.pack('!IBII', 9 + length, 7, index, offset) + data
+                    delay = self.latency
+                    if self.bandwidth:
+                        link_free_at = max(link_free_at, loop.time()) + len(block) / self.bandwidth
+                        delay += link_free_at - loop.time()
+                    if self.loss and random.random() < self.loss:
+                        delay += self.rto
+                    if delay:
+                        loop.call_later(delay, self._write, writer, block)
+                    else:
+                        writer.write(block)
+                        await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    @staticmethod
+    def write_extended(writer, number, payload):
+        writer.write(struct.pack('!IBB', len(payload) + 2, 20, number) + payload)
+
+    @staticmethod
+    def _write(writer, data):
+        if not writer.is_closing():
+            writer.write(data)
+
+    async def serve(self, host='0.0.0.0', port=0):
+        """Starts listening; returns the asyncio server."""
+        return await asyncio.start_server(self.handle, host, port, backlog=1024)
+
+def run_seeder(torrent_path, payload, port_queue, latency=0.0, behavior=None, bandwidth=0, loss=0.0, pex_queue=None):
+    """Process entry point: serves the payload on an ephemeral port and reports the port.
+
+    With `pex_queue`, the peers to hand out over PEX are read from it once the port is reported.
+    """
+    from Torrent import Torrent
+
+    torrent = Torrent(torrent_path)
+
+    async def main():
+        seeder = Seeder(payload, torrent.info_hash, torrent.piece_length, latency, behavior, bandwidth, loss,
+                        metadata=bytes(torrent.info_bytes))
+        server = await seeder.serve()
+        port_queue.put(server.sockets[0].getsockname()[1])
+        if pex_queue is not None:
+            seeder.pex_peers = pex_queue.get()
+        await server.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,225 @@
+"""A local swarm for end-to-end benchmarks: a synthetic torrent, an in-process tracker and
+loopback seeders in worker processes, plus a runner that downloads from it and measures.
+
+    swarm = Swarm(size=64 * 2**20, seeders=50, latency=0.02)
+    swarm.start()
+    result = run_download(swarm, engine='asyncio')
+    swarm.close()
+"""
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from benchmarks.synthetic import make_torrent, info_hash
+from benchmarks.seeder import run_seeder
+from benchmarks.tracker import TrackerStandIn
+from benchmarks.dht_cluster import DHTCluster
+from Downloader import Downloader
+from dht import DHT
+
+def loopback_peers(port, count):
+    # Distinct 127.x.y.z addresses so every peer is a separate connection identity.
+    return [('127.0.%d.%d' % (i // 250, i % 250 + 1), port) for i in range(count)]
+
+class Swarm:
+    """One synthetic torrent served by `seeders` loopback seeders.
+
+    Every seeder is a separate address (127.0.x.y) answered by one of `processes` seeder
+    processes, so their CPU time never counts against the downloader. Each seeder connection
+    adds `latency` seconds per block, sends at most `bandwidth` bytes/s (0 for no limit) and
+    delays a `loss` fraction of blocks by a retransmission timeout. The first `corrupt` seeders
+    send corrupt blocks and metadata from a process of their own.
+
+    Seeders also serve the metadata, so `magnet` (set by start()) can be downloaded too.
+
+    `discovery` is how the downloader finds the seeders: 'tracker' hands out all of them,
+    with 'pex' the tracker only knows the first and the seeders tell the client about the
+    rest over peer exchange, and with 'dht' the tracker knows none and the seeders are
+    announced into a DHTCluster of `dht_nodes` nodes (whose magnet has no tracker either).
+    """
+    def __init__(self, size=64 * 2**20, piece_length=256 * 1024, num_files=1, seeders=20, latency=0.0, bandwidth=0,
+                 loss=0.0, processes=1, corrupt=0, discovery='tracker', dht_nodes=50):
+        self.size = size
+        self.piece_length = piece_length
+        self.num_files = num_files
+        self.seeders = seeders
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.processes = processes
+        self.corrupt = corrupt
+        self.discovery = discovery
+        self.dht_nodes = dht_nodes
+        self.dht = None
+        self.pex_queues = []
+        self.magnet = None
+        self.work_dir = None
+        self.torrent_path = None
+        self.tracker = None
+        self.workers = []
+
+    def start(self):
+        self.work_dir = tempfile.mkdtemp(prefix='bench-swarm-')
+        self.tracker = TrackerStandIn(max_peers=self.seeders)
+        self.tracker_url = self.tracker.start_http()
+        self.torrent_path, payload = make_torrent(self.work_dir, self.size, self.piece_length, self.num_files,
+                                                  announce=self.tracker_url)
+        seeder_ports = [self.start_seeder(payload, None) for _ in range(self.processes)]
+        addresses = loopback_peers(0, self.seeders)
+        peers = [(ip, seeder_ports[i % len(seeder_ports)]) for i, (ip, _) in enumerate(addresses)]
+        if self.corrupt:
+            corrupt_port = self.start_seeder(payload, 'corrupt')
+            peers[:self.corrupt] = [(ip, corrupt_port) for ip, _ in peers[:self.corrupt]]
+        for pex_queue in self.pex_queues:
+            pex_queue.put(peers)
+        if self.discovery == 'dht':
+            self.dht = DHTCluster(self.dht_nodes).start()
+            self.dht.announce(info_hash(self.torrent_path), peers)
+        else:
+            self.tracker.preload(info_hash(self.torrent_path), peers if self.discovery == 'tracker' else peers[:1])
+        self.magnet = f"magnet:?xt=urn:btih:{info_hash(self.torrent_path).hex()}&dn={quote(os.path.basename(self.torrent_path))}"
+        if self.discovery != 'dht':
+            self.magnet += f"&tr={quote(self.tracker_url, safe='')}"
+        return self
+
+    def start_seeder(self, payload, behavior):
+        """Starts a seeder process and returns its port."""
+        ports = multiprocessing.Queue()
+        pex_queue = None
+        if self.discovery == 'pex':
+            pex_queue = multiprocessing.Queue()
+            self.pex_queues.append(pex_queue)
+        worker = multiprocessing.Process(target=run_seeder, daemon=True,
+                                         args=(self.torrent_path, payload, ports, self.latency, behavior,
+                                               self.bandwidth, self.loss, pex_queue))
+        worker.start()
+        self.workers.append(worker)
+        return ports.get(timeout=30)
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        if self.tracker:
+            self.tracker.close()
+        if self.dht:
+            self.dht.close()
+        if self.work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+class LockProbe:
+    """Wraps a lock and counts how often it was taken and how long callers waited for it."""
+    def __init__(self, lock):
+        self.lock = lock
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.acquisitions += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        if not self.lock.acquire(True, timeout):
+            return False
+        self.acquisitions += 1
+        self.contended += 1
+        self.wait_seconds += time.perf_counter() - start
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def stats(self):
+        return {'acquisitions': self.acquisitions, 'contended': self.contended, 'wait_ms': self.wait_seconds * 1000}
+
+def probe_locks(dl):
+    """Replaces the downloader's shared locks with LockProbes. Returns {name: probe}."""
+    probes = {}
+    if hasattr(dl.data_lock, 'acquire'):  # the asyncio engine needs no data lock
+        probes['data'] = dl.data_lock = LockProbe(dl.data_lock)
+    pm = dl.piece_manager
+    probes['buffers'] = pm.pool.lock = LockProbe(pm.pool.lock)
+    probes['disk'] = pm.disk.pipeline.counter_lock = LockProbe(pm.disk.pipeline.counter_lock)
+    probes['connections'] = dl.connections.lock = LockProbe(dl.connections.lock)
+    probes['print'] = LockProbe(dl.print_lock)
+    dl.print_lock = pm.print_lock = dl.trackers.print_lock = dl.trackers.tracker.print_lock = probes['print']
+    return probes
+
+def rss_bytes():
+    """Resident set size of this process, or None where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def run_download(swarm, engine='threads', timeout=120, **options):
+    """Downloads the swarm's torrent once and returns the measurements as a dict.
+
+    `options` go to Downloader (e.g. strategy, max_requests, storage). For a 'dht' swarm the
+    downloader gets a DHT node of its own that joins the swarm's cluster. The time to the first
+    piece and to completion are measured from start(); CPU time is this process only, so it
+    excludes the seeders. Peak RSS and the thread count are sampled every 10 ms.
+    """
+    download_dir = tempfile.mkdtemp(prefix='bench-dl-')
+    baseline_threads = threading.active_count()
+    options.setdefault('target_peers', swarm.seeders)
+    options.setdefault('listen_port', None)
+    node = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if swarm.dht and 'dht' not in options:
+                node = options['dht'] = DHT(port=0, bootstrap=[swarm.dht.bootstrap], query_timeout=1.0).start()
+            dl = Downloader(swarm.torrent_path, download_dir, engine=engine, **options)
+            probes = probe_locks(dl)
+            rss_start = rss_bytes()
+            peak_rss = rss_start or 0
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            starter = threading.Thread(target=dl.start, daemon=True)
+            starter.start()
+            max_threads = 0
+            first_piece = None
+            while time.perf_counter() - start < timeout and not dl.piece_manager.is_complete():
+                max_threads = max(max_threads, threading.active_count())
+                peak_rss = max(peak_rss, rss_bytes() or 0)
+                if first_piece is None and dl.piece_manager.completed_pieces:
+                    first_piece = time.perf_counter() - start
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+            complete = dl.piece_manager.is_complete()
+            peers = len(dl.peers)
+            known = dl.connections.stats()['known']
+            dl.stop()
+            starter.join(timeout)
+            # Let the previous run's peer threads exit so runs don't overlap.
+            while threading.active_count() > baseline_threads and time.perf_counter() - start < timeout + 10:
+                time.sleep(0.1)
+        return {
+            'engine': engine, 'peers': options['target_peers'], 'connected': peers, 'known': known, 'complete': complete,
+            'seconds': elapsed, 'first_piece': first_piece, 'cpu': cpu, 'threads': max_threads,
+            'mb_s': swarm.size / elapsed / 1e6 if complete else 0.0,
+            'peak_rss_mb': peak_rss / 2**20 if rss_start else None,
+            'rss_growth_mb': (peak_rss - rss_start) / 2**20 if rss_start else None,
+            'locks': {name: probe.stats() for name, probe in probes.items()},
+        }
+    finally:
+        if node:
+            node.stop()
+        shutil.rmtree(download_dir, ignore_errors=True)
@@ -0,0 +1,37 @@
+import hashlib
+import os
+import random
+
+import bencodepy
+
+def make_torrent(directory, total_size, piece_length=262144, num_files=1, announce='http://127.0.0.1:1/announce', seed=0,
+                 announce_list=None):
+    """Writes random content and a matching .torrent into `directory`.
+
+    Returns (torrent_path, payload) where payload is the concatenated content of all files.
+    `announce_list` is an optional list of tiers of tracker URLs.
+    """
+    rng = random.Random(seed)
+    payload = b''.join(rng.randbytes(min(1 << 20, total_size - i)) for i in range(0, total_size, 1 << 20))
+    pieces = b''.join(hashlib.sha1(payload[i:i+piece_length]).digest() for i in range(0, total_size, piece_length))
+
+    info = {b'name': b'synthetic', b'piece length': piece_length, b'pieces': pieces}
+    if num_files == 1:
+        info[b'name'] = b'synthetic.bin'
+        info[b'length'] = total_size
+    else:
+        base, extra = divmod(total_size, num_files)
+        info[b'files'] = [{b'length': base + (1 if i < extra else 0), b'path': [b'dir%d' % (i % 10), b'file%05d.bin' % i]}
+                          for i in range(num_files)]
+
+    torrent_path = os.path.join(directory, 'synthetic.torrent')
+    meta_info = {b'announce': announce.encode('utf-8'), b'info': info}
+    if announce_list:
+        meta_info[b'announce-list'] = [[url.encode('utf-8') for url in tier] for tier in announce_list]
+    with open(torrent_path, 'wb') as f:
+        f.write(bencodepy.encode(meta_info))
+    return torrent_path, payload
+
+def info_hash(torrent_path):
+    with open(torrent_path, 'rb') as f:
+        return hashlib.sha1(bencodepy.encode(bencodepy.decode(f.read())[b'info'])).digest()
@@ -0,0 +1,134 @@
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import bencodepy
+
+UDP_EVENTS = {0: '', 1: 'completed', 2: 'started', 3: 'stopped'}
+
+class TrackerStandIn:
+    """A local tracker that answers HTTP and UDP (BEP 15) announces from background threads.
+
+    Announcing peers join their swarm and get the other members back, at most `max_peers` per
+    response. `preload` adds peers that never announce, such as loopback seeders. Every
+    announce is recorded in `announces` so callers can check events and counts. `delay`
+    holds each answer back to emulate a slow tracker.
+    """
+    def __init__(self, interval=1800, min_interval=None, max_peers=200, delay=0.0):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_peers = max_peers
+        self.delay = delay
+        self.swarms = {}  # info_hash -> {(ip, port): left}
+        self.announces = []  # dicts: protocol, event, uploaded, downloaded, left, numwant, time
+        self.lock = threading.Lock()
+        self.servers = []
+
+    def preload(self, info_hash, peers):
+        with self.lock:
+            swarm = self.swarms.setdefault(info_hash, {})
+            for address in peers:
+                swarm[address] = 0
+
+    def events(self, protocol=None):
+        with self.lock:
+            return [a['event'] for a in self.announces if protocol in (None, a['protocol'])]
+
+    def handle_announce(self, protocol, info_hash, address, event, uploaded, downloaded, left, numwant):
+        """Records the announce and returns the peers to hand back."""
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.announces.append({'protocol': protocol, 'event': event, 'uploaded': uploaded, 'downloaded': downloaded,
+                                   'left': left, 'numwant': numwant, 'time': time.monotonic()})
+            swarm = self.swarms.setdefault(info_hash, {})
+            if event == 'stopped':
+                swarm.pop(address, None)
+                return []
+            others = [a for a in swarm if a != address]
+            swarm[address] = left
+        wanted = self.max_peers if numwant < 0 else min(numwant, self.max_peers)
+        return random.sample(others, min(wanted, len(others)))
+
+    def start_http(self, host='127.0.0.1'):
+        """Starts the HTTP tracker and returns its announce URL."""
+        tracker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query, encoding='latin-1')
+                arg = lambda name, default='0': query.get(name, [default])[0]
+                peers = tracker.handle_announce('http', arg('info_hash').encode('latin-1'),
+                                                (self.client_address[0], int(arg('port'))), arg('event', ''),
+                                                int(arg('uploaded')), int(arg('downloaded')), int(arg('left')),
+                                                int(arg('numwant', '50')))
+                response = {b'interval': tracker.interval,
+                            b'peers': b''.join(socket.inet_aton(ip) + struct.pack('!H', port) for ip, port in peers)}
+                if tracker.min_interval is not None:
+                    response[b'min interval'] = tracker.min_interval
+                body = bencodepy.encode(response)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, 0), Handler)
+        self.serve(server)
+        return 'http://%s:%d/announce' % (host, server.server_address[1])
+
+    def start_udp(self, host='127.0.0.1'):
+        """Starts the UDP tracker and returns its announce URL."""
+        tracker = self
+        connection_ids = set()
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                if len(data) == 16:
+                    protocol_id, action, transaction_id = struct.unpack('!QII', data)
+                    if protocol_id == 0x41727101980 and action == 0:
+                        conn_id = random.getrandbits(64)
+                        connection_ids.add(conn_id)
+                        sock.sendto(struct.pack('!IIQ', 0, transaction_id, conn_id), self.client_address)
+                elif len(data) >= 98:
+                    (conn_id, action, transaction_id, info_hash, _, downloaded, left, uploaded,
+                     event, _, _, numwant, port) = struct.unpack('!QII20s20sQQQIIIiH', data[:98])
+                    if action != 1 or conn_id not in connection_ids:
+                        sock.sendto(struct.pack('!II', 3, transaction_id) + b'bad connection id', self.client_address)
+                        return
+                    peers = tracker.handle_announce('udp', info_hash, (self.client_address[0], port), UDP_EVENTS[event],
+                                                    uploaded, downloaded, left, numwant)
+                    with tracker.lock:
+                        swarm = tracker.swarms.get(info_hash, {})
+                        seeders = sum(1 for l in swarm.values() if l == 0)
+                    packet = struct.pack('!IIIII', 1, transaction_id, tracker.interval, len(swarm) - seeders, seeders)
+                    packet += b''.join(socket.inet_aton(ip) + struct.pack('!H', p) for ip, p in peers)
+                    sock.sendto(packet, self.client_address)
+
+        server = socketserver.ThreadingUDPServer((host, 0), Handler)
+        self.serve(server)
+        return 'udp://%s:%d/announce' % (host, server.server_address[1])
+
+    def serve(self, server):
+        server.daemon_threads = True
+        self.servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+def blackhole_udp(host='127.0.0.1'):
+    """A UDP tracker URL that never answers. Returns (url, socket); close the socket when done."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, 0))
+    return 'udp://%s:%d/announce' % (host, sock.getsockname()[1]), sock
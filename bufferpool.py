@@ -0,0 +1,82 @@
+import threading
+
+class BufferPool:
+    """Reusable piece buffers under a fixed memory budget.
+
+    Buffers are recycled by size instead of being allocated per piece. `acquire` returns
+    None once the budget is used up, so callers can hold off starting new pieces. Free
+    buffers of another size are dropped when their memory is needed.
+    """
+    def __init__(self, budget=256 * 1024 * 1024):
+        self.budget = budget
+        self.free = {}  # size -> [bytearray]
+        self.lock = threading.Lock()
+        self.allocated_bytes = 0  # in use + free
+        self.in_use_bytes = 0
+        self.peak_in_use_bytes = 0
+
+    def acquire(self, size):
+        """Returns a bytearray of `size` bytes, or None if the budget is exhausted."""
+        with self.lock:
+            free = self.free.get(size)
+            if free:
+                buf = free.pop()
+            else:
+                if self.allocated_bytes + size > self.budget:
+                    self._drop_free(self.allocated_bytes + size - self.budget)
+                    if self.allocated_bytes + size > self.budget:
+                        return None
+                buf = bytearray(size)
+                self.allocated_bytes += size
+            self.in_use_bytes += size
+            self.peak_in_use_bytes = max(self.peak_in_use_bytes, self.in_use_bytes)
+            return buf
+
+    def release(self, buf):
+        with self.lock:
+            self.in_use_bytes -= len(buf)
+            self.free.setdefault(len(buf), []).append(buf)
+
+    def stats(self):
+        return {'in_use_bytes': self.in_use_bytes, 'peak_in_use_bytes': self.peak_in_use_bytes,
+                'allocated_bytes': self.allocated_bytes, 'budget': self.budget}
+
+    def _drop_free(self, needed):
+        for size, bufs in self.free.items():
+            while bufs and needed > 0:
+                bufs.pop()
+                self.allocated_bytes -= size
+                needed -= size
+
+class BufferShare:
+    """One torrent's slice of a BufferPool that several torrents draw from.
+
+    Works like the pool itself, but `acquire` also returns None once this share holds `limit`
+    bytes, so one busy torrent can't take every buffer. A share holding nothing may always
+    try the pool, so no torrent is starved outright. The owner may change `limit` at any time.
+    """
+    def __init__(self, pool, limit=None):
+        self.pool = pool
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.in_use_bytes = 0
+        self.peak_in_use_bytes = 0
+
+    def acquire(self, size):
+        with self.lock:
+            if self.limit is not None and self.in_use_bytes and self.in_use_bytes + size > self.limit:
+                return None
+            buf = self.pool.acquire(size)
+            if buf is not None:
+                self.in_use_bytes += size
+                self.peak_in_use_bytes = max(self.peak_in_use_bytes, self.in_use_bytes)
+            return buf
+
+    def release(self, buf):
+        with self.lock:
+            self.in_use_bytes -= len(buf)
+        self.pool.release(buf)
+
+    def stats(self):
+        return {'in_use_bytes': self.in_use_bytes, 'peak_in_use_bytes': self.peak_in_use_bytes,
+                'allocated_bytes': self.pool.allocated_bytes, 'budget': self.limit or self.pool.budget}
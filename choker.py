@@ -0,0 +1,63 @@
+import random
+import time
+
+class Choker:
+    """Chooses the peers we upload to: tit-for-tat plus an optimistic unchoke.
+
+    Every `round_interval` seconds the `upload_slots - 1` interested peers that sent us the most
+    since the previous round (or, once we are seeding, took the most from us) are unchoked and
+    everyone else is choked.
+    The last slot goes to a random interested peer and only moves every `optimistic_rounds`
+    rounds, so a newcomer gets long enough to prove itself. Peers connected for less than a
+    minute are three times as likely to get it. Between rounds, free slots are filled at once
+    so new peers don't wait for the next round.
+    """
+    def __init__(self, upload_slots=4, round_interval=10.0, optimistic_rounds=3):
+        self.upload_slots = upload_slots
+        self.round_interval = round_interval
+        self.optimistic_rounds = optimistic_rounds
+        self.rounds = 0
+        self.last_round = time.monotonic()
+        self.optimistic = None
+        self.uploaded_at_round = {}  # peer -> peer.uploaded_bytes at the previous round
+        self.received_at_round = {}  # peer -> peer.pipeline.received_bytes at the previous round
+
+    def rechoke(self, peers, seeding):
+        """Returns (unchoke, choke): the peers whose choke state should change now."""
+        now = time.monotonic()
+        interested = [p for p in peers if p.is_connected() and p.peer_interested]
+        if now - self.last_round < self.round_interval:
+            return self.fill_free_slots(peers, interested), []
+
+        self.last_round = now
+        self.rounds += 1
+        if seeding:
+            sent = lambda p: p.uploaded_bytes - self.uploaded_at_round.get(p, 0)
+        else:
+            sent = lambda p: p.pipeline.received_bytes - self.received_at_round.get(p, 0)
+        regular = sorted(interested, key=sent, reverse=True)[:max(self.upload_slots - 1, 0)]
+        self.uploaded_at_round = {p: p.uploaded_bytes for p in peers}
+        self.received_at_round = {p: p.pipeline.received_bytes for p in peers}
+
+        if self.optimistic not in interested or self.rounds % self.optimistic_rounds == 0:
+            self.optimistic = self.pick_optimistic([p for p in interested if p not in regular], now)
+        unchoked = set(regular)
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        unchoke = [p for p in unchoked if p.is_choking]
+        choke = [p for p in peers if not p.is_choking and p not in unchoked]
+        return unchoke, choke
+
+    def fill_free_slots(self, peers, interested):
+        unchoked = sum(1 for p in peers if not p.is_choking and p.peer_interested)
+        waiting = [p for p in interested if p.is_choking]
+        free = self.upload_slots - unchoked
+        if free <= 0 or not waiting:
+            return []
+        return random.sample(waiting, min(free, len(waiting)))
+
+    def pick_optimistic(self, candidates, now):
+        if not candidates:
+            return None
+        weights = [3 if p.connected_at is not None and now - p.connected_at < 60 else 1 for p in candidates]
+        return random.choices(candidates, weights)[0]
@@ -0,0 +1,158 @@
+import threading
+import time
+
+class PeerRecord:
+    """What we know about one peer address across connections."""
+    def __init__(self, address):
+        self.address = address
+        self.attempts = 0
+        self.failures = 0        # consecutive failed connects or useless connections
+        self.next_attempt = 0.0  # monotonic time before which we don't reconnect
+        self.trust = 0           # +1 per verified piece it helped with, -2 per failed one
+        self.banned = False
+        self.received_bytes = 0
+        self.inbound = False     # it connected to us; its port is not one we can dial
+
+class ConnectionManager:
+    """Keeps the downloader connected to a target number of peers.
+
+    Addresses from trackers go into a pool of known peers. Whenever fewer than `target_peers`
+    are connected or connecting, `take_candidates` hands out addresses to try, never more
+    than `max_connecting` attempts at once. A failed connect (or a connection that never
+    delivered any data) pushes the next attempt back exponentially, from `retry_after` up to
+    `max_retry_after`. `notify` is called when new candidates may be available, so the owner
+    can connect without waiting for its next poll.
+
+    Peers that send corrupt data are banned: every peer that contributed to a piece loses
+    trust when its hash fails and regains some when a piece passes. The sole contributor of a
+    bad piece, or a peer whose trust falls to `ban_trust`, is never connected again.
+    """
+    def __init__(self, target_peers=50, max_connecting=50, retry_after=30.0, max_retry_after=1800.0, ban_trust=-7,
+                 max_peers=None):
+        self.target_peers = target_peers
+        self.max_peers = max_peers or 2 * target_peers  # inbound connections are accepted up to this
+        self.max_connecting = max_connecting
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+        self.ban_trust = ban_trust
+        self.known = {}  # (ip, port) -> PeerRecord
+        self.banned_ips = set()
+        self.connecting = set()
+        self.connected = set()
+        self.lock = threading.Lock()
+        self.notify = None
+
+    def add_peers(self, addresses):
+        """Adds addresses (e.g. from a tracker) to the pool. Returns how many were new."""
+        added = 0
+        with self.lock:
+            for address in addresses:
+                if address not in self.known:
+                    self.known[address] = PeerRecord(address)
+                    added += 1
+        if added and self.notify:
+            self.notify()
+        return added
+
+    def eligible(self, now):
+        """Known peers we could connect to right now, never-tried ones first. Call with the lock held."""
+        records = [r for r in self.known.values()
+                   if not r.banned and not r.inbound and r.next_attempt <= now
+                   and r.address not in self.connecting and r.address not in self.connected]
+        records.sort(key=lambda r: (r.attempts > 0, r.failures))
+        return records
+
+    def take_candidates(self):
+        """Returns addresses to connect to now and counts them as connecting."""
+        with self.lock:
+            room = min(self.target_peers - len(self.connected) - len(self.connecting),
+                       self.max_connecting - len(self.connecting))
+            if room <= 0:
+                return []
+            candidates = [r.address for r in self.eligible(time.monotonic())[:room]]
+            for address in candidates:
+                self.known[address].attempts += 1
+                self.connecting.add(address)
+            return candidates
+
+    def connect_failed(self, address):
+        with self.lock:
+            self.connecting.discard(address)
+            self.backoff(self.known[address])
+        if self.notify:
+            self.notify()
+
+    def peer_connected(self, address):
+        with self.lock:
+            self.connecting.discard(address)
+            self.connected.add(address)
+        if self.notify:
+            self.notify()
+
+    def peer_disconnected(self, address, received_bytes=0):
+        """Records a closed connection and when the peer may be tried again."""
+        with self.lock:
+            self.connected.discard(address)
+            record = self.known.get(address)
+            if record:
+                record.received_bytes += received_bytes
+                if received_bytes:
+                    record.failures = 0
+                    record.next_attempt = time.monotonic() + self.retry_after
+                else:
+                    self.backoff(record)
+        if self.notify:
+            self.notify()
+
+    def backoff(self, record):
+        record.failures += 1
+        delay = min(self.retry_after * 2 ** (record.failures - 1), self.max_retry_after)
+        record.next_attempt = time.monotonic() + delay
+
+    def piece_verified(self, contributors, ok):
+        """Updates the trust of the peers that sent a piece's blocks. Returns addresses banned by it."""
+        banned = set()
+        with self.lock:
+            for address in contributors:
+                record = self.known.get(address)
+                if record is None or record.banned:
+                    continue
+                if ok:
+                    record.trust = min(record.trust + 1, 8)
+                    continue
+                record.trust -= 2
+                if len(contributors) == 1 or record.trust <= self.ban_trust:
+                    record.banned = True
+                    banned.add(address)
+                    self.banned_ips.add(address[0])
+        return banned
+
+    def accept_inbound(self, address):
+        """Registers a peer that connected to us. Returns False if it is banned or we are full."""
+        with self.lock:
+            if address[0] in self.banned_ips or address in self.connected or address in self.connecting \
+                    or len(self.connected) + len(self.connecting) >= self.max_peers:
+                return False
+            record = self.known.get(address)
+            if record is None:
+                record = self.known[address] = PeerRecord(address)
+                record.inbound = True
+            self.connecting.add(address)
+            return True
+
+    def has_candidates(self):
+        """True if a peer we haven't tried (or may retry) is waiting for a slot."""
+        with self.lock:
+            return bool(self.eligible(time.monotonic()))
+
+    def wants_peers(self):
+        """True if we are below the target and have nobody left to try."""
+        with self.lock:
+            if len(self.connected) + len(self.connecting) >= self.target_peers:
+                return False
+            return not self.eligible(time.monotonic())
+
+    def stats(self):
+        with self.lock:
+            return {'known': len(self.known), 'connecting': len(self.connecting), 'connected': len(self.connected),
+                    'banned': sum(1 for r in self.known.values() if r.banned)}
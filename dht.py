@@ -0,0 +1,564 @@
+"""A Mainline DHT node (BEP 5): finds peers for an info hash without a tracker."""
+import hashlib
+import json
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bencodepy
+
+from Torrent import decode
+from Tracker import compact_peers, parse_compact_peers
+
+K = 8  # nodes per bucket, and how many of the closest nodes a lookup asks
+BOOTSTRAP_NODES = [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881), ('router.utorrent.com', 6881)]
+STALE_AFTER = 15 * 60  # a node we haven't heard from for this long gets pinged
+SECRET_LIFETIME = 5 * 60  # tokens are valid for one or two of these
+PEER_LIFETIME = 30 * 60  # announced peers are forgotten after this
+MAX_STORED_TORRENTS = 2000
+MAX_STORED_PEERS = 500  # per info hash
+MAX_VALUES = 50  # peers in one get_peers reply
+
+def distance(a, b):
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+def compact_nodes(nodes):
+    """The compact node info of [(node_id, (ip, port))]: 26 bytes per node."""
+    packed = []
+    for node_id, address in nodes:
+        peer = compact_peers([address])
+        if peer:
+            packed.append(node_id + peer)
+    return b''.join(packed)
+
+def parse_compact_nodes(data):
+    if not isinstance(data, bytes):
+        return []
+    nodes = []
+    for i in range(0, len(data) - 25, 26):
+        peers = parse_compact_peers(data[i + 20:i + 26])
+        if peers:
+            nodes.append((bytes(data[i:i + 20]), peers[0]))
+    return nodes
+
+class Node:
+    """A node in the routing table."""
+    def __init__(self, node_id, address):
+        self.id = node_id
+        self.address = address
+        self.last_seen = 0.0  # monotonic time of its last reply or query; 0 for nodes loaded from disk
+        self.failures = 0     # queries in a row it didn't answer
+        self.last_ping = 0.0
+
+    @property
+    def bad(self):
+        return self.failures >= 2
+
+class RoutingTable:
+    """Known nodes in 160 buckets of up to K, by the highest bit in which their id differs from ours.
+
+    A full bucket only takes a new node in place of a bad one (one that stopped answering), so
+    long-lived nodes are kept, as Kademlia prefers. Not thread-safe; the DHT locks around it.
+    """
+    def __init__(self, own_id, k=K):
+        self.own_id = own_id
+        self.k = k
+        self.buckets = [[] for _ in range(160)]
+        self.by_address = {}  # (ip, port) -> Node
+
+    def bucket(self, node_id):
+        return self.buckets[distance(self.own_id, node_id).bit_length() - 1]
+
+    def add(self, node_id, address, now):
+        """Records that a node answered or queried us. Returns False if its bucket had no room."""
+        if node_id == self.own_id or len(node_id) != 20:
+            return False
+        node = self.by_address.get(address)
+        if node is not None and node.id != node_id:
+            self.remove(node)  # the node restarted with a new id
+            node = None
+        if node is None:
+            bucket = self.bucket(node_id)
+            if len(bucket) >= self.k:
+                worst = max(bucket, key=lambda n: n.failures)
+                if not worst.bad:
+                    return False
+                self.remove(worst)
+            node = Node(node_id, address)
+            bucket.append(node)
+            self.by_address[address] = node
+        node.last_seen = now
+        node.failures = 0
+        return True
+
+    def failed(self, address):
+        """Records a query the node at `address` didn't answer; nodes loaded from disk go at the first miss."""
+        node = self.by_address.get(address)
+        if node is not None:
+            node.failures += 1
+            if node.failures >= 5 or not node.last_seen:
+                self.remove(node)
+
+    def remove(self, node):
+        self.bucket(node.id).remove(node)
+        del self.by_address[node.address]
+
+    def closest(self, target, count=K):
+        """The `count` nodes closest to `target`, leaving out bad ones."""
+        nodes = [n for n in self.by_address.values() if not n.bad]
+        nodes.sort(key=lambda n: distance(n.id, target))
+        return nodes[:count]
+
+    def stale(self, now):
+        """Nodes not heard from for STALE_AFTER and not pinged in the last minute."""
+        return [n for n in self.by_address.values() if now - n.last_seen > STALE_AFTER and now - n.last_ping > 60]
+
+    def good(self):
+        return sum(1 for n in self.by_address.values() if n.last_seen and not n.bad)
+
+    def __len__(self):
+        return len(self.by_address)
+
+class DHTTorrent:
+    """Lookup schedule of one info hash, like TrackerState is for a tracker."""
+    def __init__(self, info_hash, on_peers, wants_peers, port):
+        self.info_hash = info_hash
+        self.on_peers = on_peers
+        self.wants_peers = wants_peers or (lambda: False)
+        self.port = port  # announced to the closest nodes; None to only look for peers
+        self.busy = False
+        self.next_lookup = 0.0
+        self.earliest_lookup = 0.0
+        self.last_peers = 0
+
+class DHT:
+    """A DHT node on UDP `port`, shared by every torrent of the process.
+
+    Torrents register with add_torrent(). Each one is looked up (get_peers, at most `alpha`
+    queries in flight) when it starts, every `interval` seconds after that and, no more often
+    than `min_interval`, whenever its `wants_peers()` says the swarm is running dry. Peers go
+    to `on_peers` as the replies arrive, and the torrent's port is announced to the closest
+    nodes that replied. The node answers other nodes' queries too, and stores the peers they
+    announce.
+
+    The node id and the routing table are saved to `state_path` (if given) on stop, and the
+    saved nodes are the first ones asked on the next start; `bootstrap` addresses are only
+    asked while the table is nearly empty.
+    """
+    def __init__(self, port=6881, state_path=None, bootstrap=BOOTSTRAP_NODES, print_lock=None, host='0.0.0.0',
+                 alpha=3, query_timeout=2.0, interval=15 * 60, min_interval=60, max_workers=8):
+        self.port = port
+        self.host = host
+        self.state_path = state_path
+        self.bootstrap_nodes = list(bootstrap)
+        self.print_lock = print_lock or threading.Lock()
+        self.alpha = alpha
+        self.query_timeout = query_timeout
+        self.interval = interval
+        self.min_interval = min_interval
+        self.node_id = os.urandom(20)
+        self.table = RoutingTable(self.node_id)
+        self.lock = threading.Lock()
+        self.sock = None
+        self.transactions = {}  # transaction id -> (callback, deadline, address)
+        self.next_transaction = random.randrange(2**16)
+        self.secrets = [os.urandom(8), os.urandom(8)]  # current and previous token secret
+        self.secret_changed = time.monotonic()
+        self.stored = {}  # info_hash -> {(ip, port): expiry}
+        self.torrents = {}  # info_hash -> DHTTorrent
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()  # set when a torrent is added or bootstrapping ends
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.last_bootstrap = None
+        self.bootstrapping = False
+        self.last_refresh = time.monotonic()
+        self.counts = {'queries_sent': 0, 'replies': 0, 'timeouts': 0, 'queries_received': 0, 'dropped_packets': 0}
+
+    def start(self):
+        """Binds the UDP socket (trying the next few ports if ours is taken) and starts the node's threads."""
+        self.load()
+        ports = [0] if self.port == 0 else range(self.port, self.port + 10)
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.bind((self.host, port))
+                break
+            except OSError:
+                sock.close()
+        else:
+            raise OSError(f"could not bind a UDP port for the DHT from {self.port}")
+        sock.settimeout(0.2)
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+        threading.Thread(target=self.maintain, daemon=True).start()
+        with self.print_lock:
+            print(f"DHT node on UDP port {self.port} ({len(self.table)} saved nodes)")
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        self.pool.shutdown(wait=False)
+        self.save()
+        if self.sock:
+            self.sock.close()
+
+    def load(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.node_id = bytes.fromhex(state['id'])
+            self.table = RoutingTable(self.node_id)
+            for node_id, ip, port in state['nodes']:
+                self.table.add(bytes.fromhex(node_id), (ip, port), 0.0)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # start afresh
+
+    def save(self):
+        """Writes the node id and the nodes that answered us to state_path."""
+        if not self.state_path:
+            return
+        with self.lock:
+            nodes = [[n.id.hex(), n.address[0], n.address[1]] for n in self.table.by_address.values() if not n.bad]
+        tmp_path = self.state_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'id': self.node_id.hex(), 'nodes': nodes}, f)
+            os.replace(tmp_path, self.state_path)
+        except OSError:
+            pass
+
+    def add_torrent(self, info_hash, on_peers, wants_peers=None, port=None):
+        """Starts looking up (and, with `port`, announcing) an info hash."""
+        with self.lock:
+            self.torrents[info_hash] = DHTTorrent(info_hash, on_peers, wants_peers, port)
+        self.wakeup.set()
+
+    def remove_torrent(self, info_hash):
+        with self.lock:
+            self.torrents.pop(info_hash, None)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, nodes=len(self.table), good_nodes=self.table.good(), torrents=len(self.torrents),
+                        stored_peers=sum(len(peers) for peers in self.stored.values()))
+
+    def maintain(self):
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            now = time.monotonic()
+            with self.lock:
+                if now - self.secret_changed > SECRET_LIFETIME:
+                    self.secrets = [os.urandom(8), self.secrets[0]]
+                    self.secret_changed = now
+                for info_hash, peers in list(self.stored.items()):
+                    for address, expiry in list(peers.items()):
+                        if expiry < now:
+                            del peers[address]
+                    if not peers:
+                        del self.stored[info_hash]
+                good = self.table.good()
+                stale = self.table.stale(now)[:K]
+                for node in stale:
+                    node.last_ping = now
+                # With an empty table, lookups wait for bootstrapping to find some nodes.
+                due = [t for t in self.torrents.values() if good and not t.busy and
+                       (now >= t.next_lookup or (now >= t.earliest_lookup and t.wants_peers()))]
+                for t in due:
+                    t.busy = True
+            if good < K and not self.bootstrapping and (self.last_bootstrap is None or now - self.last_bootstrap > 30):
+                self.bootstrapping = True
+                self.last_bootstrap = now
+                self.submit(self.bootstrap)
+            elif now - self.last_refresh > STALE_AFTER:
+                self.last_refresh = now
+                self.submit(self.find_node, self.node_id)  # keeps our own neighbourhood fresh
+            for node in stale:
+                self.send_query(node.address, b'ping', {})
+            for t in due:
+                self.submit(self.lookup_torrent, t)
+            self.wakeup.wait(1.0)
+
+    def submit(self, fn, *args):
+        try:
+            self.pool.submit(fn, *args)
+        except RuntimeError:
+            pass  # stopping
+
+    def bootstrap(self):
+        """Fills the routing table by looking our own id up, through the bootstrap nodes if the table can't."""
+        try:
+            self.find_node(self.node_id)
+            with self.lock:
+                if self.table.good() >= K:
+                    return
+            addresses = []
+            for host, port in self.bootstrap_nodes:
+                try:
+                    addresses += {info[4][:2] for info in socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)}
+                except OSError:
+                    continue
+            replies = self.query_all(addresses, b'find_node', {b'target': self.node_id})
+            seeds = [node for reply in replies for node in parse_compact_nodes(reply.get(b'nodes'))]
+            self.lookup(self.node_id, b'find_node', {b'target': self.node_id}, seeds=seeds)
+        finally:
+            self.bootstrapping = False
+            self.wakeup.set()
+
+    def lookup_torrent(self, t):
+        peers = []
+        try:
+            peers = self.get_peers(t.info_hash, t.on_peers, t.port)
+        finally:
+            now = time.monotonic()
+            with self.lock:
+                t.busy = False
+                t.last_peers = len(peers)
+                # An empty table finds nothing; try again as soon as bootstrapping has had a chance.
+                t.next_lookup = now + (self.interval if self.table.good() else 5)
+                t.earliest_lookup = now + self.min_interval
+
+    def get_peers(self, info_hash, on_peers=None, port=None):
+        """Looks up peers for an info hash; with `port`, announces it to the closest nodes. Returns the peers.
+
+        `on_peers` hears about peers as they arrive, so a download can start connecting
+        before the lookup is over.
+        """
+        closest, peers = self.lookup(info_hash, b'get_peers', {b'info_hash': info_hash}, on_peers)
+        if port:
+            for address, token in closest:
+                if token:
+                    self.send_query(address, b'announce_peer', {b'info_hash': info_hash, b'port': port,
+                                                                b'token': token, b'implied_port': 0})
+        return peers
+
+    def find_node(self, target):
+        """Looks up the nodes closest to `target`. Returns their addresses."""
+        closest, _ = self.lookup(target, b'find_node', {b'target': target})
+        return [address for address, _ in closest]
+
+    def lookup(self, target, method, args, on_peers=None, seeds=(), max_queries=200):
+        """Iterative lookup: asks the closest nodes we know of for closer ones until the K closest have all answered.
+
+        At most `alpha` queries are in flight at once. `seeds` are [(node_id, address)] to
+        start from besides the routing table. Returns ([(address, token)] of the K closest
+        nodes that answered, peers found).
+        """
+        with self.lock:
+            shortlist = {n.address: n.id for n in self.table.closest(target)}  # address -> node id
+        shortlist.update((address, node_id) for node_id, address in seeds if node_id != self.node_id)
+        queried, answered, peers = set(), {}, []
+        state = threading.Condition()
+        in_flight = 0
+
+        def reply(address, response):
+            nonlocal in_flight
+            new_peers = []
+            with state:
+                in_flight -= 1
+                if response is None:
+                    shortlist.pop(address, None)
+                else:
+                    answered[address] = response.get(b'token')
+                    for node_id, node_address in parse_compact_nodes(response.get(b'nodes')):
+                        if node_id != self.node_id and node_address not in shortlist:
+                            shortlist[node_address] = node_id
+                    values = response.get(b'values', [])
+                    for value in values if isinstance(values, list) else []:
+                        for peer in parse_compact_peers(value) if isinstance(value, bytes) else []:
+                            if peer not in peers:
+                                peers.append(peer)
+                                new_peers.append(peer)
+                state.notify()
+            if new_peers and on_peers:
+                on_peers(new_peers)
+
+        with state:
+            while not self.stopping.is_set():
+                closest = sorted(shortlist, key=lambda a: distance(shortlist[a], target))[:K]
+                todo = [a for a in closest if a not in queried]
+                if not todo and not in_flight:
+                    break
+                while todo and in_flight < self.alpha and len(queried) < max_queries:
+                    address = todo.pop(0)
+                    queried.add(address)
+                    in_flight += 1
+                    self.send_query(address, method, args, lambda response, address=address: reply(address, response))
+                if in_flight:
+                    state.wait(self.query_timeout + 1)
+                elif len(queried) >= max_queries:
+                    break
+            closest = sorted((a for a in answered if a in shortlist), key=lambda a: distance(shortlist[a], target))[:K]
+            return [(address, answered[address]) for address in closest], list(peers)
+
+    def query_all(self, addresses, method, args):
+        """Sends the same query to several nodes at once and waits for them. Returns the replies that came."""
+        replies, done = [], threading.Semaphore(0)
+
+        def reply(response):
+            replies.append(response)
+            done.release()
+
+        for address in addresses:
+            self.send_query(address, method, args, reply)
+        for _ in addresses:
+            done.acquire(timeout=self.query_timeout + 1)
+        return [r for r in replies if r is not None]
+
+    def send_query(self, address, method, args, callback=None):
+        """Sends a KRPC query. `callback`, if given, gets the reply's arguments, or None on error or timeout."""
+        with self.lock:
+            self.next_transaction = (self.next_transaction + 1) % 2**16
+            transaction = struct.pack('!H', self.next_transaction)
+            self.transactions[transaction] = (callback, time.monotonic() + self.query_timeout, address)
+            self.counts['queries_sent'] += 1
+        message = {b't': transaction, b'y': b'q', b'q': method, b'a': {**args, b'id': self.node_id}}
+        try:
+            self.sock.sendto(bencodepy.encode(message), address)
+        except (OSError, AttributeError):
+            with self.lock:
+                self.transactions.pop(transaction, None)
+            if callback:
+                callback(None)
+
+    def receive_loop(self):
+        next_expiry = time.monotonic()
+        while not self.stopping.is_set():
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except socket.timeout:
+                data = None
+            except OSError:
+                if self.stopping.is_set():
+                    break
+                data = None
+            if data is not None:
+                try:
+                    self.handle_packet(data, address[:2])
+                except Exception:
+                    # Whatever one packet does wrong, the node has to keep answering the rest.
+                    with self.lock:
+                        self.counts['dropped_packets'] += 1
+            now = time.monotonic()
+            if now >= next_expiry:
+                next_expiry = now + 0.1
+                self.expire_transactions(now)
+
+    def expire_transactions(self, now):
+        with self.lock:
+            expired = [(t, entry) for t, entry in self.transactions.items() if entry[1] < now]
+            for transaction, (_, _, address) in expired:
+                del self.transactions[transaction]
+                self.table.failed(address)
+                self.counts['timeouts'] += 1
+        for _, (callback, _, _) in expired:
+            if callback:
+                callback(None)
+
+    def handle_packet(self, data, address):
+        try:
+            message, _ = decode(data, 0)
+            kind = message[b'y']
+            transaction = message[b't']
+            if not isinstance(kind, bytes) or not isinstance(transaction, bytes):
+                raise TypeError("transaction id and message type must be strings")
+        except (ValueError, IndexError, KeyError, TypeError):
+            with self.lock:
+                self.counts['dropped_packets'] += 1
+            return
+        if kind == b'q':
+            self.handle_query(message, transaction, address)
+        elif kind in (b'r', b'e'):
+            with self.lock:
+                entry = self.transactions.get(transaction)
+                if entry is None or entry[2] != address:
+                    return  # late, or not from the node we asked
+                del self.transactions[transaction]
+                response = message.get(b'r') if kind == b'r' else None
+                if isinstance(response, dict) and isinstance(response.get(b'id'), bytes) and len(response[b'id']) == 20:
+                    self.table.add(response[b'id'], address, time.monotonic())
+                    self.counts['replies'] += 1
+                else:
+                    response = None
+            if entry[0]:
+                entry[0](response)
+
+    def handle_query(self, message, transaction, address):
+        """Answers ping, find_node, get_peers and announce_peer."""
+        try:
+            method, args = message[b'q'], message[b'a']
+            if not isinstance(method, bytes) or not isinstance(args, dict):
+                raise TypeError
+            node_id = args[b'id']
+            if not isinstance(node_id, bytes) or len(node_id) != 20:
+                raise ValueError
+            reply = {b'id': self.node_id}
+            with self.lock:
+                self.counts['queries_received'] += 1
+                self.table.add(node_id, address, time.monotonic())
+                if method == b'ping':
+                    pass
+                elif method == b'find_node':
+                    target = args[b'target']
+                    if not isinstance(target, bytes) or len(target) != 20:
+                        raise ValueError
+                    reply[b'nodes'] = self.closest_nodes(target)
+                elif method == b'get_peers':
+                    info_hash = args[b'info_hash']
+                    if not isinstance(info_hash, bytes) or len(info_hash) != 20:
+                        raise ValueError
+                    reply[b'token'] = self.token(address[0], self.secrets[0])
+                    peers = list(self.stored.get(info_hash, ()))
+                    if peers:
+                        reply[b'values'] = [compact_peers([peer]) for peer in random.sample(peers, min(len(peers), MAX_VALUES))]
+                    reply[b'nodes'] = self.closest_nodes(info_hash)
+                elif method == b'announce_peer':
+                    if args[b'token'] not in (self.token(address[0], secret) for secret in self.secrets):
+                        self.send_error(transaction, address, 203, b'Bad token')
+                        return
+                    info_hash = args[b'info_hash']
+                    port = address[1] if args.get(b'implied_port') else args[b'port']
+                    if not isinstance(info_hash, bytes) or len(info_hash) != 20 or not isinstance(port, int) \
+                            or not 0 < port < 65536:
+                        raise ValueError
+                    self.store(info_hash, (address[0], port))
+                else:
+                    self.send_error(transaction, address, 204, b'Method Unknown')
+                    return
+        except (KeyError, ValueError, TypeError):
+            self.send_error(transaction, address, 203, b'Protocol Error')
+            return
+        self.send_message({b't': transaction, b'y': b'r', b'r': reply}, address)
+
+    def closest_nodes(self, target):
+        """Compact info of the nodes we know closest to `target`. Call with the lock held."""
+        return compact_nodes((n.id, n.address) for n in self.table.closest(target))
+
+    def store(self, info_hash, address):
+        """Remembers an announced peer. Call with the lock held."""
+        peers = self.stored.get(info_hash)
+        if peers is None:
+            if len(self.stored) >= MAX_STORED_TORRENTS:
+                return
+            peers = self.stored[info_hash] = {}
+        if address in peers or len(peers) < MAX_STORED_PEERS:
+            peers[address] = time.monotonic() + PEER_LIFETIME
+
+    def token(self, ip, secret):
+        return hashlib.sha1(secret + ip.encode()).digest()[:8]
+
+    def send_error(self, transaction, address, code, text):
+        self.send_message({b't': transaction, b'y': b'e', b'e': [code, text]}, address)
+
+    def send_message(self, message, address):
+        try:
+            self.sock.sendto(bencodepy.encode(message), address)
+        except OSError:
+            pass
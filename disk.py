@@ -0,0 +1,170 @@
+import os
+import queue
+import threading
+import time
+
+class DiskPipeline:
+    """Verifies and writes completed pieces off the peer threads.
+
+    Completed pieces go onto a hash queue served by `hash_workers` threads (hashlib releases
+    the GIL, so they hash in parallel). Verified pieces go to `write_workers` writer threads.
+    Each torrent talks to the pipeline through its own DiskChannel, which holds the torrent's
+    results and `notify` callback, so one pipeline can serve every torrent of a session.
+
+    Memory is capped by `max_pending_bytes`: submitting never blocks, but `has_capacity()`
+    turns False so no new pieces are started until the disk catches up.
+    """
+    def __init__(self, hash_workers=None, max_pending_bytes=64 * 1024 * 1024, write_workers=1):
+        self.max_pending_bytes = max_pending_bytes
+        self.metrics = None  # a metrics.Metrics to report hash and write times to
+        self.hash_queue = queue.Queue()
+        self.write_queue = queue.Queue()
+        self.counter_lock = threading.Lock()
+        self.pending_bytes = 0
+        self.peak_pending_bytes = 0
+        self.hashed_bytes = 0
+        self.hash_seconds = 0.0
+        self.hash_failures = 0
+        self.written_bytes = 0
+        self.write_seconds = 0.0
+        hash_workers = hash_workers or min(4, os.cpu_count() or 1)
+        self.hash_threads = [threading.Thread(target=self.hash_loop, daemon=True) for _ in range(hash_workers)]
+        self.write_threads = [threading.Thread(target=self.write_loop, daemon=True) for _ in range(write_workers)]
+        for thread in self.hash_threads + self.write_threads:
+            thread.start()
+
+    def channel(self, write_piece, owned=False, print_lock=None):
+        """Returns a DiskChannel for one torrent. An owned channel stops the pipeline when it stops."""
+        return DiskChannel(self, write_piece, owned, print_lock)
+
+    def submit(self, piece, channel):
+        """Queues a piece whose blocks have all arrived. Never blocks."""
+        with self.counter_lock:
+            self.pending_bytes += piece.length
+            channel.pending_bytes += piece.length
+            self.peak_pending_bytes = max(self.peak_pending_bytes, self.pending_bytes)
+        self.hash_queue.put((piece, channel))
+
+    def has_capacity(self):
+        return self.pending_bytes < self.max_pending_bytes
+
+    def hash_loop(self):
+        while True:
+            item = self.hash_queue.get()
+            if item is None:
+                break
+            piece, channel = item
+            start = time.perf_counter()
+            ok = piece.is_hash_correct()
+            elapsed = time.perf_counter() - start
+            if self.metrics:
+                self.metrics.observe('bt_hash_seconds', elapsed)
+            with self.counter_lock:
+                self.hashed_bytes += piece.length
+                self.hash_seconds += elapsed
+                if not ok:
+                    self.hash_failures += 1
+                    self.pending_bytes -= piece.length
+                    channel.pending_bytes -= piece.length
+            if ok:
+                self.write_queue.put(item)
+            else:
+                channel.report('failed', piece)
+
+    def write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            piece, channel = item
+            start = time.perf_counter()
+            try:
+                channel.write_piece(piece)
+                result, error = 'written', None
+            except OSError as e:
+                result, error = 'write_failed', e
+            elapsed = time.perf_counter() - start
+            if self.metrics:
+                self.metrics.observe('bt_write_seconds', elapsed)
+                if error:
+                    self.metrics.record('write_failed', piece=piece.index, error=str(error))
+            with self.counter_lock:
+                self.pending_bytes -= piece.length
+                channel.pending_bytes -= piece.length
+                if result == 'written':
+                    self.written_bytes += piece.length
+                self.write_seconds += elapsed
+            channel.report(result, piece, error)
+
+    def stats(self):
+        """Queue depths and throughput counters."""
+        return {
+            'hash_queue': self.hash_queue.qsize(),
+            'write_queue': self.write_queue.qsize(),
+            'pending_bytes': self.pending_bytes,
+            'peak_pending_bytes': self.peak_pending_bytes,
+            'hashed_bytes': self.hashed_bytes,
+            'hash_failures': self.hash_failures,
+            'hash_mb_s': self.hashed_bytes / self.hash_seconds / 1e6 if self.hash_seconds else 0.0,
+            'written_bytes': self.written_bytes,
+            'write_mb_s': self.written_bytes / self.write_seconds / 1e6 if self.write_seconds else 0.0,
+        }
+
+    def stop(self, timeout=30):
+        """Finishes queued work and stops the worker threads."""
+        for _ in self.hash_threads:
+            self.hash_queue.put(None)
+        for thread in self.hash_threads:
+            thread.join(timeout)
+        for _ in self.write_threads:
+            self.write_queue.put(None)
+        for thread in self.write_threads:
+            thread.join(timeout)
+
+class DiskChannel:
+    """One torrent's connection to a DiskPipeline.
+
+    Results are queued on `results` and `notify` is called so the PieceManager can apply them
+    on the right thread. A channel with nothing pending may always start a piece, so on a
+    shared pipeline a busy torrent can't keep an idle one from downloading.
+
+    `notify` runs on the worker threads; if it raises, the error is printed and the worker
+    carries on, since every torrent on the pipeline depends on it.
+    """
+    def __init__(self, pipeline, write_piece, owned=False, print_lock=None):
+        self.pipeline = pipeline
+        self.write_piece = write_piece
+        self.owned = owned
+        self.print_lock = print_lock or threading.Lock()
+        self.notify = None
+        self.results = queue.SimpleQueue()  # ('verified' | 'failed' | 'written' | 'write_failed', piece, error)
+        self.pending_bytes = 0
+
+    def submit(self, piece):
+        self.pipeline.submit(piece, self)
+
+    def has_capacity(self):
+        return self.pending_bytes == 0 or self.pipeline.has_capacity()
+
+    def report(self, result, piece, error=None):
+        self.results.put((result, piece, error))
+        if self.notify:
+            try:
+                self.notify()
+            except Exception as e:
+                with self.print_lock:
+                    print(f"\nError applying disk results for piece {piece.index}: {e!r}")
+                if self.pipeline.metrics:
+                    self.pipeline.metrics.record('disk_callback_failed', piece=piece.index, error=repr(e))
+
+    def stats(self):
+        return self.pipeline.stats()
+
+    def stop(self, timeout=30):
+        """Finishes this torrent's queued work (and stops the pipeline if the channel owns it)."""
+        if self.owned:
+            self.pipeline.stop(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while self.pending_bytes and time.monotonic() < deadline:
+            time.sleep(0.05)
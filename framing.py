@@ -0,0 +1,84 @@
+import struct
+
+from pipelining import BLOCK_SIZE
+
+MIN_READ = 16384
+MAX_EXTENDED_MESSAGE = 1 << 18  # extension messages: handshakes, PEX, a metadata piece with its header
+
+def max_message_length(num_pieces=None):
+    """The longest message body a peer may send: a piece message with one block, a bitfield
+    (unknown size without `num_pieces`) or an extension message."""
+    bitfield = 1 + (num_pieces + 7) // 8 if num_pieces is not None else 0
+    return max(BLOCK_SIZE + 13, bitfield, MAX_EXTENDED_MESSAGE)
+
+class MessageBuffer:
+    """Preallocated receive buffer that frames length-prefixed peer messages without copying.
+
+    The socket reads straight into the free tail (`recv_into(buffer.writable())`) and
+    `next_message` hands out memoryviews into the buffer. A returned view is only valid
+    until the next call to `writable()`, which may move unread bytes to the front.
+
+    A length prefix over `max_length` raises ValueError before anything is allocated for it.
+    """
+    def __init__(self, size=1 << 18, max_length=None):
+        self.max_length = max_message_length() if max_length is None else max_length
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first unread byte
+        self.end = 0    # one past the last received byte
+        self.bytes_copied = 0  # bytes moved by compaction or growth
+
+    def __len__(self):
+        return self.end - self.start
+
+    def writable(self):
+        """Returns the free tail of the buffer to receive into."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buf) - self.end < MIN_READ and self.start > 0:
+            self._compact()
+        return self.view[self.end:]
+
+    def advance(self, n):
+        """Marks `n` bytes written into `writable()` as received."""
+        self.end += n
+
+    def next_message(self):
+        """Returns the next complete message body as a memoryview, or None if it hasn't fully arrived.
+
+        Keep-alives come back as an empty view.
+        """
+        available = self.end - self.start
+        if available < 4:
+            return None
+        msg_len = struct.unpack_from('!I', self.buf, self.start)[0]
+        if msg_len > self.max_length:
+            raise ValueError(f"peer sent a {msg_len}-byte message (limit {self.max_length})")
+        if available < 4 + msg_len:
+            self._reserve(4 + msg_len)
+            return None
+        begin = self.start + 4
+        self.start = begin + msg_len
+        return self.view[begin:self.start]
+
+    def _reserve(self, size):
+        """Makes sure a message of `size` bytes starting at `start` fits in the buffer."""
+        if len(self.buf) - self.start >= size:
+            return
+        if size <= len(self.buf):
+            self._compact()
+            return
+        # Rare: a message (e.g. a huge bitfield) bigger than the buffer. Earlier views keep the old one alive.
+        unread = self.end - self.start
+        buf = bytearray(max(size, 2 * len(self.buf)))
+        buf[:unread] = self.view[self.start:self.end]
+        self.bytes_copied += unread
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.start, self.end = 0, unread
+
+    def _compact(self):
+        unread = self.end - self.start
+        self.view[:unread] = self.view[self.start:self.end]
+        self.bytes_copied += unread
+        self.start, self.end = 0, unread
@@ -0,0 +1,299 @@
+"""Magnet links: find peers for an info hash and fetch the info dictionary from them (BEP 9)."""
+import base64
+import hashlib
+import os
+import random
+import string
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import bencodepy
+
+from Torrent import Torrent, decode
+from Tracker import TrackerManager
+from connections import ConnectionManager
+from peer import Peer
+from pex import parse_pex
+
+METADATA_BLOCK = 16 * 1024  # ut_metadata piece size
+MAX_METADATA_SIZE = 64 * 1024 * 1024  # refuse peers that claim a bigger info dictionary
+REQUEST, DATA, REJECT = 0, 1, 2  # ut_metadata msg_type
+
+class Magnet:
+    """A parsed magnet URI: the info hash, a display name, trackers and peers to try.
+
+    Stands in for a Torrent where only the info hash is needed (tracker announces, peer
+    handshakes) until the metadata has been fetched.
+    """
+    def __init__(self, uri):
+        url = urlparse(uri)
+        if url.scheme != 'magnet':
+            raise ValueError(f"not a magnet link: {uri}")
+        params = parse_qs(url.query)
+        self.info_hash = None
+        for topic in params.get('xt', []):
+            if topic.lower().startswith('urn:btih:'):
+                self.info_hash = parse_info_hash(topic[9:])
+        if self.info_hash is None:
+            raise ValueError(f"magnet link without a BitTorrent info hash: {uri}")
+        self.name = params.get('dn', [self.info_hash.hex()])[0]
+        # Every tracker is its own tier, as other clients do with magnet links.
+        self.announce_list = [[url.encode('utf-8')] for url in params.get('tr', [])]
+        self.peers = [parse_address(peer) for peer in params.get('x.pe', [])]
+        self.total_size = 0  # unknown until the metadata arrives
+        self.num_pieces = 0
+
+    def __str__(self):
+        return self.name
+
+def parse_info_hash(text):
+    if len(text) == 40:
+        return bytes.fromhex(text)
+    if len(text) == 32:
+        return base64.b32decode(text.upper())
+    raise ValueError(f"bad info hash in magnet link: {text}")
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host.strip('[]'), int(port)
+
+def metadata_message(msg_type, piece, data=b'', total_size=None):
+    """A ut_metadata message payload: a bencoded header, followed by the piece for DATA."""
+    header = {b'msg_type': msg_type, b'piece': piece}
+    if total_size is not None:
+        header[b'total_size'] = total_size
+    return bencodepy.encode(header) + data
+
+def parse_metadata_message(payload):
+    """(msg_type, piece, data) of a ut_metadata message payload."""
+    payload = bytes(payload)
+    header, end = decode(payload, 0)
+    return header[b'msg_type'], header[b'piece'], payload[end:]
+
+def metadata_path(download_dir, info_hash):
+    """Where the .torrent made from a magnet link's metadata is kept, next to the resume data."""
+    return os.path.join(download_dir, f'.{info_hash.hex()}.torrent')
+
+def save_torrent(path, torrent):
+    """Writes a .torrent with the fetched info dictionary, byte for byte, and the trackers."""
+    trackers = {}
+    if torrent.announce_list:
+        trackers = {b'announce': torrent.announce_list[0][0], b'announce-list': torrent.announce_list}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        # Keys in sorted order: announce, announce-list, info.
+        f.write(b'd' + bencodepy.encode(trackers)[1:-1] + b'4:info')
+        f.write(torrent.info_bytes)
+        f.write(b'e')
+    os.replace(tmp_path, path)
+
+class MetadataFetcher:
+    """Fetches a magnet link's info dictionary from the swarm.
+
+    Peers come from the magnet's trackers, its x.pe addresses, the DHT (if given) and peer
+    exchange, and are connected to through a ConnectionManager, like a download's. Each peer that offers ut_metadata is asked for a
+    different 16 KiB piece at a time, so the pieces come from several peers in parallel; a
+    piece a peer rejects or sits on for `request_timeout` seconds is asked of another.
+
+    The assembled dictionary must hash to the info hash. If it doesn't, the contributors lose
+    trust as they would for a bad piece, and from then on the whole dictionary is taken from a
+    single peer at a time, so a liar is the sole contributor of its copy and gets banned.
+    """
+    def __init__(self, magnet, peer_id=None, print_lock=None, max_peers=30, request_timeout=10, port=6881, dht=None):
+        self.magnet = magnet
+        self.peer_id = peer_id or '-PY0001-' + ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+        self.print_lock = print_lock or threading.Lock()
+        self.request_timeout = request_timeout
+        self.connections = ConnectionManager(max_peers, max_peers, retry_after=5.0)
+        self.connections.add_peers(magnet.peers)
+        self.trackers = TrackerManager(magnet, self.peer_id, self.print_lock, self.connections.add_peers,
+                                       lambda: (0, 0, METADATA_BLOCK), self.connections.wants_peers, port)
+        self.dht = dht
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.connections.notify = self.wakeup.set
+        self.done = threading.Event()
+        self.metadata_size = None
+        self.blocks = {}  # piece -> data
+        self.contributors = {}  # piece -> address it came from
+        self.requested = {}  # piece -> (address, when)
+        self.single_source = False  # after a bad copy, take it all from one peer at a time
+        self.source = None  # that peer
+        self.info_bytes = None
+        self.peers = set()
+
+    def fetch(self, timeout=None):
+        """Finds peers and fetches the metadata. Returns the Torrent; raises TimeoutError if it takes too long."""
+        with self.print_lock:
+            print(f"Fetching metadata for {self.magnet} ({self.magnet.info_hash.hex()})")
+        if not self.magnet.announce_list and not self.magnet.peers and not self.dht:
+            raise ValueError("the magnet link has no trackers or peers to ask for the metadata, and the DHT is off")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.trackers.start()
+        if self.dht:
+            self.dht.add_torrent(self.magnet.info_hash, self.connections.add_peers, self.connections.wants_peers)
+        try:
+            while not self.done.is_set():
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"no peer sent the metadata for {self.magnet} within {timeout:.0f}s")
+                self.wakeup.clear()
+                for ip, port in self.connections.take_candidates():
+                    threading.Thread(target=self.fetch_from, args=(ip, port), daemon=True).start()
+                self.wakeup.wait(1.0)
+        finally:
+            self.stop()
+        if self.info_bytes is None:
+            raise RuntimeError(f"stopped before the metadata for {self.magnet} arrived")
+        with self.print_lock:
+            print(f"Metadata verified: {len(self.info_bytes)} bytes from "
+                  f"{len(set(self.contributors.values()))} peer(s)")
+        return Torrent.from_metadata(self.info_bytes, self.magnet.announce_list)
+
+    def stop(self):
+        self.done.set()
+        self.wakeup.set()
+        if self.dht:
+            self.dht.remove_torrent(self.magnet.info_hash)
+        self.trackers.stop()
+        for peer in list(self.peers):
+            peer.close()
+
+    def known_peers(self):
+        """Addresses found while fetching, to hand on to the download."""
+        with self.connections.lock:
+            return [r.address for r in self.connections.known.values() if not r.banned and not r.inbound]
+
+    def fetch_from(self, ip, port):
+        """Runs one peer connection until the metadata is complete or the peer is no use."""
+        address = (ip, port)
+        peer = Peer(ip, port, self.magnet, self.peer_id)
+        if not peer.connect():
+            self.connections.connect_failed(address)
+            return
+        self.connections.peer_connected(address)
+        self.peers.add(peer)
+        received = 0
+        try:
+            if not peer.supports_extensions:
+                return
+            peer.send_extended_handshake()
+            give_up = time.monotonic() + self.request_timeout  # time to offer ut_metadata
+            waiting = None  # (piece, sent) of our request in flight
+            while not self.done.is_set() and peer.is_connected() and not self.is_banned(address):
+                msg = peer.receive_message()
+                if msg and msg[0] == 'extended' and msg[1] == b'ut_pex':
+                    self.connections.add_peers(parse_pex(msg[2]))
+                elif msg and msg[0] == 'extended' and msg[1] == b'ut_metadata':
+                    msg_type, piece, data = parse_metadata_message(msg[2])
+                    if msg_type == REJECT:
+                        return  # it doesn't have the metadata (yet)
+                    if msg_type == DATA and waiting and piece == waiting[0]:
+                        received += len(data)
+                        self.piece_received(address, piece, data)
+                        waiting = None
+                if b'ut_metadata' not in peer.extensions or peer.metadata_size is None:
+                    if time.monotonic() > give_up:
+                        return
+                    continue
+                if waiting and time.monotonic() - waiting[1] > self.request_timeout:
+                    return  # sat on our request; someone else will be asked
+                if waiting is None:
+                    piece = self.next_piece(address, peer.metadata_size)
+                    if piece is not None:
+                        peer.send_extended(b'ut_metadata', metadata_message(REQUEST, piece))
+                        waiting = (piece, time.monotonic())
+        except Exception:
+            pass
+        finally:
+            peer.close()
+            self.peers.discard(peer)
+            self.release(address)
+            self.connections.peer_disconnected(address, received)
+
+    def num_blocks(self):
+        return (self.metadata_size + METADATA_BLOCK - 1) // METADATA_BLOCK
+
+    def next_piece(self, address, size):
+        """A piece for the peer at `address`, which offers `size` bytes, or None if it has nothing to do.
+
+        The first size offered is the one fetched; peers that disagree wait in case it proves wrong.
+        """
+        with self.lock:
+            if self.metadata_size is None and 0 < size <= MAX_METADATA_SIZE:
+                self.metadata_size = size
+            if size != self.metadata_size:
+                return None
+            if self.single_source:
+                if self.source is None:
+                    self.source = address
+                elif self.source != address:
+                    return None
+            now = time.monotonic()
+            for piece in range(self.num_blocks()):
+                if piece in self.blocks:
+                    continue
+                holder = self.requested.get(piece)
+                if holder is None or now - holder[1] > self.request_timeout:
+                    self.requested[piece] = (address, now)
+                    return piece
+            return None
+
+    def release(self, address):
+        """Hands back the pieces a departing peer was asked for."""
+        with self.lock:
+            for piece, (holder, _) in list(self.requested.items()):
+                if holder == address:
+                    del self.requested[piece]
+            if self.source == address:
+                self.source = None
+
+    def piece_received(self, address, piece, data):
+        with self.lock:
+            if self.done.is_set() or piece in self.blocks or not 0 <= piece < self.num_blocks():
+                return
+            if len(data) != min(METADATA_BLOCK, self.metadata_size - piece * METADATA_BLOCK):
+                return
+            self.blocks[piece] = data
+            self.contributors[piece] = address
+            self.requested.pop(piece, None)
+            if len(self.blocks) < self.num_blocks():
+                return
+            info_bytes = b''.join(self.blocks[i] for i in range(self.num_blocks()))
+            contributors = set(self.contributors.values())
+            ok = hashlib.sha1(info_bytes).digest() == self.magnet.info_hash
+            if ok:
+                self.info_bytes = info_bytes
+                self.done.set()
+            else:
+                self.blocks.clear()
+                self.contributors.clear()
+                self.requested.clear()
+                self.metadata_size = None
+                self.single_source, self.source = True, None
+        self.connections.piece_verified(contributors, ok)
+        self.wakeup.set()
+        if not ok:
+            with self.print_lock:
+                print(f"\nMetadata from {len(contributors)} peer(s) doesn't match the info hash; "
+                      f"fetching it again from one peer at a time.")
+
+    def is_banned(self, address):
+        with self.connections.lock:
+            record = self.connections.known.get(address)
+            return record is not None and record.banned
+
+def fetch_metadata(uri, download_dir, print_lock=None, timeout=None, port=6881, dht=None):
+    """Resolves a magnet link to a .torrent in `download_dir`, fetching the metadata unless it is there already.
+
+    Returns (torrent_path, peers): the peers found along the way, for the download to start with.
+    """
+    magnet = Magnet(uri)
+    path = metadata_path(download_dir, magnet.info_hash)
+    if os.path.exists(path):
+        return path, magnet.peers
+    fetcher = MetadataFetcher(magnet, print_lock=print_lock, port=port, dht=dht)
+    torrent = fetcher.fetch(timeout)
+    os.makedirs(download_dir, exist_ok=True)
+    save_torrent(path, torrent)
+    return path, fetcher.known_peers()
@@ -1,30 +1,158 @@
 import argparse
 import os
+import threading
 from Downloader import Downloader
+from dht import BOOTSTRAP_NODES, DHT
+from magnet import fetch_metadata, parse_address
+from metrics import EventLog, Metrics
+from picker import MAX_PRIORITY
+from session import Session
 
 def main():
     """Main function to run the BitTorrent client from the command line."""
     parser = argparse.ArgumentParser(description="A simple BitTorrent client.")
-    parser.add_argument("torrent_file", help="Path to the .torrent file.")
+    parser.add_argument("torrent_file", nargs="*",
+                        help="Path to the .torrent file or a magnet link (any number of them with --session).")
     parser.add_argument("-d", "--download_dir", default=".", help="Directory to save the downloaded files.")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="Peer engine: one thread per peer, or a single asyncio event loop.")
+    parser.add_argument("--max-connecting", type=int, default=50, help="Concurrent connection attempts.")
+    parser.add_argument("--max-peers", type=int,
+                        help="Peers to stay connected to; more are requested from the trackers when below it. "
+                             "With --session, the total over all torrents (default 50, or 200 with --session).")
+    parser.add_argument("--strategy", choices=["rarest", "sequential"], default="rarest",
+                        help="Piece selection: rarest-first (random for the first few pieces) or sequential for streaming.")
+    parser.add_argument("--file-priority", nargs="+", metavar="INDEX=PRIORITY",
+                        help="Per-file priorities for a single torrent: 0 skips the file, 1 is normal (the default) "
+                             "and up to 7 downloads it before lower ones, e.g. --file-priority 0=7 3=0.")
+    parser.add_argument("--endgame-copies", type=int, default=3, help="Peers asked for the same block once in endgame.")
+    parser.add_argument("--storage", choices=["pwrite", "mmap"], default="pwrite",
+                        help="Disk backend: positional writes through cached file handles, or mmap (single-file torrents).")
+    parser.add_argument("--max-buffer-mb", type=int, default=256,
+                        help="Memory budget for in-flight piece buffers; no new pieces start once it is used up. "
+                             "With --session, shared by all torrents.")
+    parser.add_argument("--max-requests", type=int, default=250, help="Upper bound on outstanding block requests per peer.")
+    parser.add_argument("--port", type=int, default=6881, help="Port to accept incoming peer connections on.")
+    parser.add_argument("--no-listen", action="store_true", help="Don't accept incoming peer connections.")
+    parser.add_argument("--no-dht", action="store_true", help="Don't look for peers on the DHT.")
+    parser.add_argument("--dht-bootstrap", nargs="+", metavar="HOST:PORT",
+                        help="DHT nodes to join through when no saved ones answer (default: the public routers).")
+    parser.add_argument("--seed", action="store_true", help="Keep uploading to other peers after the download completes.")
+    parser.add_argument("--upload-slots", type=int, default=4, help="Peers we upload to at the same time.")
+    parser.add_argument("--request-timeout", type=float, default=15,
+                        help="Seconds without a block before a peer's requests are given to other peers.")
+    parser.add_argument("--max-download-rate", type=float, default=0,
+                        help="Download limit in KiB/s, 0 for none (with --session, over all torrents).")
+    parser.add_argument("--max-upload-rate", type=float, default=0,
+                        help="Upload limit in KiB/s, 0 for none (with --session, over all torrents).")
+    parser.add_argument("--peer-download-rate", type=float, default=0, help="Download limit per peer in KiB/s, 0 for none.")
+    parser.add_argument("--peer-upload-rate", type=float, default=0, help="Upload limit per peer in KiB/s, 0 for none.")
+    parser.add_argument("--session", action="store_true",
+                        help="Run any number of torrents in one process under shared limits, "
+                             "controlled through a local HTTP API.")
+    parser.add_argument("--control-port", type=int, default=8765, help="Localhost port of the --session control API.")
+    parser.add_argument("--control-token", help="Token the control API requires in an X-Session-Token header "
+                                                "(default: a random one, saved to .session-token in the download directory).")
+    parser.add_argument("--disk-writers", type=int, default=2, help="Disk writer threads shared by a --session.")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve Prometheus metrics at http://127.0.0.1:PORT/metrics.")
+    parser.add_argument("--event-log", help="Append peer, tracker and piece events to this JSON-lines file "
+                                            "(summarize it with 'python metrics.py FILE').")
     args = parser.parse_args()
 
-    torrent_file = args.torrent_file
+    if not args.session and len(args.torrent_file) != 1:
+        parser.error("give exactly one .torrent file, or use --session")
+    if args.file_priority and args.session:
+        parser.error("--file-priority applies to a single torrent, not --session")
+    try:
+        args.file_priority = parse_file_priorities(args.file_priority)
+    except ValueError as e:
+        parser.error(str(e))
     download_dir = args.download_dir
-    
 
-    if not os.path.exists(torrent_file):
-        print(f"Error: Torrent file not found at '{torrent_file}'")
-        return
+    for torrent_file in args.torrent_file:
+        if not torrent_file.startswith('magnet:') and not os.path.exists(torrent_file):
+            print(f"Error: Torrent file not found at '{torrent_file}'")
+            return
 
     if not os.path.exists(download_dir):
         os.makedirs(download_dir)
         print(f"Created download directory at '{download_dir}'")
 
     print("Starting BitTorrent Client...")
-    print("Commands: 'q' (quit) or Ctrl+C")
-    
-    client = Downloader(torrent_file, download_dir)
+    print("Commands: 'q' (quit) or Ctrl+C, 'd <KiB/s>' / 'u <KiB/s>' to change the download / upload limit (0 for none)")
+
+    metrics = start_metrics(args)
+    dht = start_dht(args)
+    try:
+        if args.session:
+            run_session(args, metrics, dht)
+        else:
+            run_client(args, metrics, dht)
+    finally:
+        if dht:
+            dht.stop()
+        if metrics and metrics.event_log:
+            metrics.event_log.close()
+
+def parse_file_priorities(specs):
+    """['0=7', '3=0'] -> {0: 7, 3: 0}; None for no specs."""
+    if not specs:
+        return None
+    priorities = {}
+    for spec in specs:
+        index, _, priority = spec.partition('=')
+        if not index.isdigit() or not priority.isdigit() or not 0 <= int(priority) <= MAX_PRIORITY:
+            raise ValueError(f"--file-priority wants INDEX=PRIORITY with a priority from 0 to {MAX_PRIORITY}, not '{spec}'")
+        priorities[int(index)] = int(priority)
+    return priorities
+
+def start_metrics(args):
+    """A Metrics for --metrics-port / --event-log, or None when neither is given."""
+    if args.metrics_port is None and not args.event_log:
+        return None
+    metrics = Metrics(EventLog(args.event_log) if args.event_log else None)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+        print(f"Metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+    return metrics
+
+def start_dht(args):
+    """The DHT node shared by every torrent, on the UDP port of the same number as --port; None with --no-dht."""
+    if args.no_dht:
+        return None
+    bootstrap = [parse_address(node) for node in args.dht_bootstrap] if args.dht_bootstrap else BOOTSTRAP_NODES
+    try:
+        return DHT(args.port, os.path.join(args.download_dir, '.dht.json'), bootstrap).start()
+    except OSError as e:
+        print(f"Could not start the DHT ({e}); peers will only come from trackers.")
+        return None
+
+def run_client(args, metrics, dht):
+    """Downloads the one torrent until it is done, or 'q' or Ctrl+C."""
+    download_dir = args.download_dir
+    torrent_file, peers = args.torrent_file[0], []
+    if torrent_file.startswith('magnet:'):
+        try:
+            torrent_file, peers = fetch_metadata(torrent_file, download_dir, port=args.port, dht=dht)
+        except KeyboardInterrupt:
+            print("\nCtrl+C detected. Shutting down...")
+            return
+        except (ValueError, RuntimeError) as e:
+            print(f"Could not get the metadata: {e}")
+            return
+
+    client = Downloader(torrent_file, download_dir, max_requests=args.max_requests,
+                        engine=args.engine, max_connecting=args.max_connecting, strategy=args.strategy,
+                        endgame_copies=args.endgame_copies, storage=args.storage,
+                        max_buffer_mb=args.max_buffer_mb, target_peers=args.max_peers or 50,
+                        request_timeout=args.request_timeout, listen_port=None if args.no_listen else args.port,
+                        seed=args.seed, upload_slots=args.upload_slots,
+                        download_rate=int(args.max_download_rate * 1024), upload_rate=int(args.max_upload_rate * 1024),
+                        peer_download_rate=int(args.peer_download_rate * 1024),
+                        peer_upload_rate=int(args.peer_upload_rate * 1024), metrics=metrics, dht=dht,
+                        file_priorities=args.file_priority)
+    client.connections.add_peers(peers)
     try:
         client.start()
         # The main thread will now handle user input and wait for the download to finish
@@ -34,6 +162,9 @@ def main():
                 if cmd.lower() == 'q':
                     print("\nQuitting...")
                     break # Exit the loop, finally will handle shutdown
+                limit = parse_limit(cmd)
+                if limit:
+                    client.set_limits(**limit)
             except (EOFError, KeyboardInterrupt) as e:
                 # This handles Ctrl+D and cases where input stream is closed
                 print("\nInput stream closed. Shutting down...")
@@ -48,5 +179,54 @@ def main():
             client.stop()
         print("Client has shut down.")
 
+def parse_limit(cmd):
+    """'d 500' or 'u 0' -> {'download': 512000} or {'upload': 0}; None for anything else."""
+    parts = cmd.split()
+    if len(parts) != 2 or parts[0].lower() not in ('d', 'u'):
+        return None
+    try:
+        rate = int(float(parts[1]) * 1024)
+    except ValueError:
+        return None
+    direction = 'download' if parts[0].lower() == 'd' else 'upload'
+    print(f"{direction.capitalize()} limit: {f'{rate // 1024} KiB/s' if rate else 'none'}")
+    return {direction: rate}
+
+def run_session(args, metrics, dht):
+    """Runs the given torrents (and any added through the control API) until 'q' or Ctrl+C."""
+    session = Session(args.download_dir, max_peers=args.max_peers or 200, max_connecting=args.max_connecting,
+                      max_buffer_mb=args.max_buffer_mb, disk_writers=args.disk_writers,
+                      listen_port=None if args.no_listen else args.port, control_port=args.control_port,
+                      control_token=args.control_token, seed=args.seed, max_requests=args.max_requests, strategy=args.strategy,
+                      endgame_copies=args.endgame_copies, storage=args.storage,
+                      request_timeout=args.request_timeout, upload_slots=args.upload_slots,
+                      download_rate=int(args.max_download_rate * 1024), upload_rate=int(args.max_upload_rate * 1024),
+                      peer_download_rate=int(args.peer_download_rate * 1024),
+                      peer_upload_rate=int(args.peer_upload_rate * 1024), metrics=metrics, dht=dht)
+    try:
+        session.start()
+        for torrent_file in args.torrent_file:
+            try:
+                session.add(torrent_file)
+            except Exception as e:
+                print(f"Could not add {torrent_file}: {e}")
+        while True:
+            try:
+                cmd = input()
+                if cmd.lower() == 'q':
+                    print("\nQuitting...")
+                    break
+                limit = parse_limit(cmd)
+                if limit:
+                    session.set_limits(**limit)
+            except EOFError:
+                # No terminal (e.g. run as a service): keep running until interrupted.
+                threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\nCtrl+C detected. Shutting down...")
+    finally:
+        session.stop()
+        print("Session has shut down.")
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
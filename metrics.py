@@ -0,0 +1,280 @@
+"""Counters, histograms and an event log for finding out where a download is slow.
+
+    python metrics.py events.jsonl    # summarize an event log written with --event-log
+"""
+import bisect
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+WAIT_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0)
+ANNOUNCE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name -> (type, help, histogram buckets). Gauges come from collectors at scrape time.
+METRICS = {
+    'bt_received_bytes_total': ('counter', 'Block payload bytes received from peers.', None),
+    'bt_sent_bytes_total': ('counter', 'Block payload bytes uploaded to peers.', None),
+    'bt_request_rtt_seconds': ('histogram', 'Time from sending a block request to receiving the block.', LATENCY_BUCKETS),
+    'bt_hash_seconds': ('histogram', 'Time to hash one piece.', LATENCY_BUCKETS),
+    'bt_write_seconds': ('histogram', 'Time to write one piece to disk.', LATENCY_BUCKETS),
+    'bt_data_lock_wait_seconds': ('histogram', 'Time peer threads waited for the data lock (threads engine).', WAIT_BUCKETS),
+    'bt_loop_lag_seconds': ('histogram', 'How late the event loop ran a one second timer (asyncio engine).', LATENCY_BUCKETS),
+    'bt_tracker_announces_total': ('counter', 'Tracker announces by result.', None),
+    'bt_tracker_announce_seconds': ('histogram', 'Tracker announce duration.', ANNOUNCE_BUCKETS),
+    'bt_peers_discovered_total': ('counter', 'New peer addresses by where they came from (tracker, dht, pex).', None),
+    'bt_connects_total': ('counter', 'Peer connections by result (ok, failed, inbound).', None),
+    'bt_disconnects_total': ('counter', 'Peer connections closed.', None),
+    'bt_chokes_received_total': ('counter', 'Times a peer choked us.', None),
+    'bt_snubs_total': ('counter', 'Peers that sat on our requests until they timed out.', None),
+    'bt_pieces_total': ('counter', 'Pieces checked, by result (verified, failed).', None),
+    'bt_write_failures_total': ('counter', 'Pieces that could not be written.', None),
+    'bt_bans_total': ('counter', 'Peers banned for corrupt data.', None),
+    'bt_peers': ('gauge', 'Connected peers.', None),
+    'bt_peers_connecting': ('gauge', 'Connection attempts in progress.', None),
+    'bt_peers_known': ('gauge', 'Peer addresses known.', None),
+    'bt_dht_nodes': ('gauge', 'Nodes in the DHT routing table.', None),
+    'bt_peers_unchoked': ('gauge', 'Peers we are uploading to.', None),
+    'bt_outstanding_requests': ('gauge', 'Block requests in flight.', None),
+    'bt_upload_queue': ('gauge', 'Peer requests waiting for the upload limit.', None),
+    'bt_downloaded_bytes': ('gauge', 'Verified bytes on disk.', None),
+    'bt_size_bytes': ('gauge', 'Total size of the torrent.', None),
+    'bt_buffer_bytes': ('gauge', 'Piece buffer memory in use.', None),
+    'bt_hash_queue': ('gauge', 'Pieces waiting to be hashed.', None),
+    'bt_write_queue': ('gauge', 'Verified pieces waiting to be written.', None),
+    'bt_disk_pending_bytes': ('gauge', 'Bytes submitted to the disk pipeline and not yet written.', None),
+    'bt_peer_received_bytes': ('gauge', 'Bytes received from one connected peer.', None),
+    'bt_peer_sent_bytes': ('gauge', 'Bytes uploaded to one connected peer.', None),
+    'bt_peer_rate_bytes': ('gauge', 'Download rate from one connected peer in bytes/s.', None),
+    'bt_peer_window': ('gauge', 'Request window of one connected peer.', None),
+}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Process-wide counters and histograms, plus collectors that report gauges when scraped.
+
+    Events (`record`) are the less frequent things worth keeping for later: tracker
+    announces, connects, disconnects, chokes, snubs, piece checks and bans. Each one is
+    written to the event log, if there is one, and counted. `replay` feeds a saved log back
+    through the same counting, so its counters can be studied offline. Per-block samples
+    such as request RTT only go to histograms, never to the log.
+    """
+    def __init__(self, event_log=None):
+        self.event_log = event_log
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.collectors = []  # callables returning [(name, labels dict, value)]
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def record(self, event, **fields):
+        """Logs an event and updates the counters it feeds."""
+        if self.event_log:
+            self.event_log.write(event, fields)
+        self.apply(event, fields)
+
+    def apply(self, event, fields):
+        if event == 'announce':
+            self.inc('bt_tracker_announces_total', result='ok' if fields['ok'] else 'failed')
+            self.observe('bt_tracker_announce_seconds', fields['seconds'])
+        elif event == 'connect':
+            self.inc('bt_connects_total', result=fields['result'])
+        elif event == 'disconnect':
+            self.inc('bt_disconnects_total')
+        elif event == 'choke':
+            self.inc('bt_chokes_received_total')
+        elif event == 'snub':
+            self.inc('bt_snubs_total')
+        elif event == 'piece':
+            self.inc('bt_pieces_total', result='verified' if fields['ok'] else 'failed')
+        elif event == 'write_failed':
+            self.inc('bt_write_failures_total')
+        elif event == 'ban':
+            self.inc('bt_bans_total')
+
+    def add_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self.lock:
+            collectors = list(self.collectors)
+            series = {}  # name -> {labels: value}
+            for (name, labels), value in self.counters.items():
+                series.setdefault(name, {})[labels] = value
+            histograms = {key: (list(h.counts), h.sum, h.count, h.buckets) for key, h in self.histograms.items()}
+        for collector in collectors:
+            for name, labels, value in collector():
+                series.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+        for (name, labels), histogram in histograms.items():
+            series.setdefault(name, {})[labels] = histogram
+
+        lines = []
+        for name in sorted(series):
+            kind, help_text, _ = METRICS[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series[name].items()):
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                counts, total, count, buckets = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves render() at http://host:port/metrics from a background thread. Returns the server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    @classmethod
+    def replay(cls, path):
+        """Rebuilds the event counters from a saved event log."""
+        metrics = cls()
+        for entry in read_events(path):
+            metrics.apply(entry['event'], entry)
+        return metrics
+
+class TimedLock:
+    """A lock that reports how long each acquire waited to a histogram."""
+    def __init__(self, lock, metrics, name):
+        self.lock = lock
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        if not self.lock.acquire(False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.metrics.observe(self.name, time.perf_counter() - start)
+        else:
+            self.metrics.observe(self.name, 0.0)
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+class EventLog:
+    """Appends events to a file as JSON lines: {"time": unix time, "event": name, ...fields}."""
+    def __init__(self, path):
+        self.file = open(path, 'a', buffering=1)
+        self.lock = threading.Lock()
+
+    def write(self, event, fields):
+        line = json.dumps(dict(time=round(time.time(), 3), event=event, **fields), default=str)
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_events(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+def summarize(path):
+    """Prints what happened over an event log: counts by event, the noisiest peers and trackers, and failures."""
+    events = list(read_events(path))
+    if not events:
+        print("No events.")
+        return
+    span = events[-1]['time'] - events[0]['time']
+    print(f"{len(events)} events over {span:.0f}s")
+    counts = {}
+    for entry in events:
+        counts[entry['event']] = counts.get(entry['event'], 0) + 1
+    for event, count in sorted(counts.items(), key=lambda item: -item[1]):
+        print(f"  {event:<12} {count}")
+
+    received = {}
+    for entry in events:
+        if entry['event'] == 'disconnect':
+            received[entry['peer']] = received.get(entry['peer'], 0) + entry.get('received', 0)
+    if received:
+        print("Peers that sent the most:")
+        for peer, total in sorted(received.items(), key=lambda item: -item[1])[:10]:
+            print(f"  {peer:<22} {total / 2**20:9.2f} MB")
+    announces = [e for e in events if e['event'] == 'announce']
+    if announces:
+        print("Trackers:")
+        for url in sorted({e['url'] for e in announces}):
+            mine = [e for e in announces if e['url'] == url]
+            failed = sum(1 for e in mine if not e['ok'])
+            print(f"  {url:<50} {len(mine)} announces, {failed} failed, "
+                  f"{sum(e['seconds'] for e in mine) / len(mine):.2f}s average")
+    failures = [e for e in events if e['event'] in ('piece', 'ban', 'write_failed') and not e.get('ok', False)]
+    if failures:
+        print(f"Failures: {len(failures)} (first: {failures[0]})")
+    print()
+    print(Metrics.replay(path).render(), end='')
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(__doc__.strip())
+    summarize(sys.argv[1])
@@ -1,10 +1,23 @@
+import collections
 import socket
 import struct
+import threading
 import time
 
+import bencodepy
+
+from pipelining import RequestPipeline
+from framing import MessageBuffer, max_message_length
+from ratelimit import RateLimits
+from Torrent import decode
+
+RESERVED = bytes([0, 0, 0, 0, 0, 0x10, 0, 0])  # handshake reserved bytes: we speak the extension protocol (BEP 10)
+EXTENSIONS = {b'ut_metadata': 1, b'ut_pex': 2}  # extended message ids we assign, sent in our extension handshake
+EXTENSION_NAMES = {number: name for name, number in EXTENSIONS.items()}
+
 class Peer:
     """Represents a peer connection in the swarm."""
-    def __init__(self, ip, port, torrent, peer_id):
+    def __init__(self, ip, port, torrent, peer_id, min_requests=2, max_requests=250):
         self.ip = ip
         self.port = port
         self.torrent = torrent
@@ -15,8 +28,23 @@ class Peer:
         self.peer_choking = True
         self.peer_interested = False
         self.bitfield = None
-        self.buffer = b''
+        # A magnet link's peers come before the piece count is known.
+        self.max_message = max_message_length(getattr(torrent, 'num_pieces', None))
+        self.buffer = MessageBuffer(max_length=self.max_message)
         self.last_message_time = time.time()
+        self.pipeline = RequestPipeline(min_window=min_requests, max_window=max_requests)
+        self.send_lock = threading.Lock()  # other peers' threads may send cancels to us
+        self.connected_at = None
+        self.uploaded_bytes = 0
+        self.upload_queue = collections.deque()  # (index, offset, length) requests waiting for the upload limit
+        self.pending_haves = collections.deque()  # verified pieces to announce, sent from the peer's own loop
+        self.limits = RateLimits()  # this peer's own download/upload limits
+        self.supports_extensions = False  # its handshake set the BEP 10 bit
+        self.extensions = {}  # extension name -> the message id the peer assigned it
+        self.metadata_size = None  # size of the info dictionary, if the peer offers it (BEP 9)
+        self.listen_port = None  # where the peer accepts connections, if we know
+        self.pex_sent = set()  # addresses we last told the peer we are connected to (BEP 11)
+        self.pex_received_at = None
 
     def connect(self):
         """Connects to the peer."""
@@ -25,6 +53,26 @@ class Peer:
             self.sock.settimeout(5)
             self.sock.connect((self.ip, self.port))
             self.handshake()
+            self.sock.settimeout(1)
+            return True
+        except Exception:
+            self.close()
+            return False
+
+    def accept(self, sock):
+        """Takes over an inbound connection and answers the remote peer's handshake."""
+        self.sock = sock
+        try:
+            self.sock.settimeout(5)
+            response = b''
+            while len(response) < 68:
+                chunk = self.sock.recv(68 - len(response))
+                if not chunk:
+                    raise Exception("Connection closed during handshake")
+                response += chunk
+            self.check_handshake(response)
+            self.sock.sendall(self.handshake_message())
+            self.sock.settimeout(1)
             return True
         except Exception:
             self.close()
@@ -32,44 +80,138 @@ class Peer:
 
     def handshake(self):
         """Performs the BitTorrent handshake."""
-        pstr = b'BitTorrent protocol'
-        pstrlen = len(pstr)
-        handshake_msg = struct.pack('!B19s8x20s20s', pstrlen, pstr, self.torrent.info_hash, self.peer_id.encode('utf-8'))
-        self.sock.send(handshake_msg)
+        self.sock.send(self.handshake_message())
         
         response = self.sock.recv(68)
+        self.check_handshake(response)
+
+    def handshake_message(self):
+        pstr = b'BitTorrent protocol'
+        pstrlen = len(pstr)
+        return struct.pack('!B19s8s20s20s', pstrlen, pstr, RESERVED, self.torrent.info_hash, self.peer_id.encode('utf-8'))
+
+    def check_handshake(self, response):
         if len(response) < 68:
             raise Exception("Handshake response too short")
             
-        _, _, info_hash, _ = struct.unpack('!B19s8x20s20s', response)
+        _, _, reserved, info_hash, remote_id = struct.unpack('!B19s8s20s20s', response)
+        self.supports_extensions = bool(reserved[5] & 0x10)
         if info_hash != self.torrent.info_hash:
             raise Exception("Info hash mismatch")
+        if remote_id == self.peer_id.encode('utf-8'):
+            raise Exception("Connected to ourselves")
+
+    def send(self, msg):
+        """Writes raw bytes to the peer. Raises OSError if it is (or gets) closed."""
+        with self.send_lock:
+            sock = self.sock  # close() may clear it from another thread at any time
+            if sock is None:
+                raise ConnectionError(f"not connected to {self.ip}:{self.port}")
+            sock.sendall(msg)
 
     def send_interested(self):
         """Sends an interested message."""
-        if self.sock and not self.is_interested:
+        if self.is_connected() and not self.is_interested:
             msg = struct.pack('!IB', 1, 2)
-            self.sock.send(msg)
+            self.send(msg)
             self.is_interested = True
 
+    def send_not_interested(self):
+        if self.is_connected() and self.is_interested:
+            self.send(struct.pack('!IB', 1, 3))
+            self.is_interested = False
+
+    def send_choke(self):
+        if self.is_connected() and not self.is_choking:
+            self.send(struct.pack('!IB', 1, 0))
+            self.is_choking = True
+
+    def send_unchoke(self):
+        if self.is_connected() and self.is_choking:
+            self.send(struct.pack('!IB', 1, 1))
+            self.is_choking = False
+
+    def send_bitfield(self, bitfield):
+        if self.is_connected():
+            self.send(struct.pack('!IB', len(bitfield) + 1, 5) + bytes(bitfield))
+
+    def send_have(self, piece_index):
+        if self.is_connected():
+            self.send(struct.pack('!IBI', 5, 4, piece_index))
+
+    def queue_have(self, piece_index):
+        """Queues a have message; safe from any thread. flush_haves sends it."""
+        self.pending_haves.append(piece_index)
+
+    def flush_haves(self):
+        """Sends the queued have messages in one write."""
+        haves = []
+        while self.pending_haves:
+            haves.append(self.pending_haves.popleft())
+        if haves and self.is_connected():
+            self.send(b''.join(struct.pack('!IBI', 5, 4, piece_index) for piece_index in haves))
+
+    def send_piece(self, piece_index, block_offset, data):
+        """Uploads one block."""
+        if self.is_connected():
+            self.send(b''.join((struct.pack('!IBII', 9 + len(data), 7, piece_index, block_offset), data)))
+            self.uploaded_bytes += len(data)
+
+    def send_extended_handshake(self, metadata_size=None, listen_port=None, extensions=EXTENSIONS):
+        """Tells the peer which extensions we speak (BEP 10), the metadata size and our port if we have them."""
+        handshake = {b'm': extensions, b'v': b'PY0001'}
+        if metadata_size:
+            handshake[b'metadata_size'] = metadata_size
+        if listen_port:
+            handshake[b'p'] = listen_port
+        self.send_extended_message(0, bencodepy.encode(handshake))
+
+    def send_extended(self, name, payload):
+        """Sends an extension message. Returns False if the peer doesn't support that extension."""
+        number = self.extensions.get(name)
+        if not number or not self.is_connected():
+            return False
+        self.send_extended_message(number, payload)
+        return True
+
+    def send_extended_message(self, number, payload):
+        if self.is_connected():
+            self.send(struct.pack('!IBB', len(payload) + 2, 20, number) + payload)
+
     def send_request(self, piece_index, block_offset, block_length):
         """Sends a request for a block."""
-        if self.sock:
-            msg = struct.pack('!IBIII', 13, 6, piece_index, block_offset, block_length)
-            self.sock.send(msg)
+        self.send_requests([(piece_index, block_offset, block_length)])
+
+    def send_requests(self, blocks):
+        """Sends a batch of block requests in a single write and tracks them in the pipeline."""
+        if self.is_connected() and blocks:
+            msg = b''.join(struct.pack('!IBIII', 13, 6, index, offset, length) for index, offset, length in blocks)
+            self.send(msg)
+            for index, offset, length in blocks:
+                self.pipeline.add(index, offset, length)
+
+    def send_cancels(self, blocks):
+        """Cancels outstanding requests (endgame, timeouts) and drops them from the pipeline."""
+        blocks = [b for b in blocks if self.pipeline.cancel(b[0], b[1])]
+        if self.is_connected() and blocks:
+            self.send(b''.join(struct.pack('!IBIII', 13, 8, index, offset, length) for index, offset, length in blocks))
 
     def receive_message(self):
         """Receives and processes a message from the peer."""
         if not self.sock:
             return None
 
+        # Drain messages that are already buffered before blocking on the socket again.
+        msg = self.process_buffer()
+        if msg:
+            return msg
+
         try:
-            self.sock.settimeout(1)
-            data = self.sock.recv(4096)
-            if not data:
+            received = self.sock.recv_into(self.buffer.writable())
+            if not received:
                 self.close()
                 return None
-            self.buffer += data
+            self.buffer.advance(received)
             self.last_message_time = time.time()
         except socket.timeout:
             return None
@@ -77,34 +219,87 @@ class Peer:
             self.close()
             return None
 
-        while len(self.buffer) >= 4:
-            msg_len = struct.unpack('!I', self.buffer[:4])[0]
-            if len(self.buffer) < 4 + msg_len:
-                break
-            
-            packet = self.buffer[4:4+msg_len]
-            self.buffer = self.buffer[4+msg_len:]
-            
-            if msg_len == 0: continue
+        return self.process_buffer()
 
-            msg_id = packet[0]
-            payload = packet[1:]
-            
-            if msg_id == 0: self.peer_choking = True
-            elif msg_id == 1: self.peer_choking = False
-            elif msg_id == 2: self.peer_interested = True
-            elif msg_id == 3: self.peer_interested = False
-            elif msg_id == 4:
-                piece_index = struct.unpack('!I', payload)[0]
-                if self.bitfield:
-                    self.bitfield[piece_index // 8] |= (1 << (7 - piece_index % 8))
-            elif msg_id == 5: self.bitfield = bytearray(payload)
-            elif msg_id == 7:
-                piece_index, block_offset = struct.unpack('!II', payload[:8])
-                block_data = payload[8:]
-                return ('piece', piece_index, block_offset, block_data)
+    def process_buffer(self):
+        """Handles complete messages in the buffer, returning the first one the caller must act on.
+
+        Payloads are memoryviews into the receive buffer; a returned piece block is only valid
+        until the next call to receive_message.
+        """
+        while True:
+            packet = self.buffer.next_message()
+            if packet is None:
+                return None
+            if not packet:
+                continue  # keep-alive
+
+            msg = self.handle_message(packet[0], packet[1:])
+            if msg:
+                return msg
+
+    def handle_message(self, msg_id, payload):
+        """Updates peer state for one message and returns it if the caller must act on it."""
+        if msg_id == 0:
+            self.peer_choking = True
+            return ('choke',)
+        elif msg_id == 1: self.peer_choking = False
+        elif msg_id == 2: self.peer_interested = True
+        elif msg_id == 3: self.peer_interested = False
+        elif msg_id == 4:
+            piece_index = struct.unpack('!I', payload)[0]
+            if self.bitfield is None:
+                # Peers that start with nothing may skip the bitfield and only send haves.
+                self.bitfield = bytearray((self.torrent.num_pieces + 7) // 8)
+            mask = 1 << (7 - piece_index % 8)
+            if piece_index // 8 < len(self.bitfield) and not self.bitfield[piece_index // 8] & mask:
+                self.bitfield[piece_index // 8] |= mask
+                return ('have', piece_index)
+        elif msg_id == 5:
+            num_pieces = self.torrent.num_pieces  # 0 for a magnet link whose metadata we don't have yet
+            if num_pieces and (len(payload) != (num_pieces + 7) // 8 or
+                               payload[-1] & (0xff >> ((num_pieces - 1) % 8 + 1))):
+                raise ValueError(f"peer sent a {len(payload)}-byte bitfield for {num_pieces} pieces")
+            old_bitfield = self.bitfield
+            self.bitfield = bytearray(payload)
+            return ('bitfield', old_bitfield)
+        elif msg_id == 6:
+            piece_index, block_offset, block_length = struct.unpack('!III', payload)
+            return ('request', piece_index, block_offset, block_length)
+        elif msg_id == 7:
+            piece_index, block_offset = struct.unpack('!II', payload[:8])
+            block_data = payload[8:]
+            return ('piece', piece_index, block_offset, block_data)
+        elif msg_id == 8:
+            request = struct.unpack('!III', payload)
+            if request in self.upload_queue:
+                self.upload_queue.remove(request)
+        elif msg_id == 20 and payload:
+            if payload[0] == 0:
+                self.handle_extended_handshake(bytes(payload[1:]))
+                return ('extended_handshake',)
+            name = EXTENSION_NAMES.get(payload[0])
+            if name:
+                return ('extended', name, payload[1:])
         return None
 
+    def handle_extended_handshake(self, payload):
+        try:
+            handshake, _ = decode(payload, 0)
+            extensions = handshake.get(b'm', {})
+            self.extensions = {name: number for name, number in extensions.items()
+                               if isinstance(number, int) and number > 0}
+            size = handshake.get(b'metadata_size')
+            self.metadata_size = size if isinstance(size, int) and size > 0 else None
+            port = handshake.get(b'p')
+            if isinstance(port, int) and 0 < port < 65536:
+                self.listen_port = port
+        except (ValueError, IndexError, AttributeError):
+            pass  # a garbled handshake just means no extensions
+
+    def is_connected(self):
+        return self.sock is not None
+
     def close(self):
         """Closes the connection."""
         if self.sock:
@@ -1,133 +1,423 @@
 import os
 import hashlib
-import random
+import queue
+import threading
+
+from picker import MAX_PRIORITY, PiecePicker, has_piece
+from disk import DiskPipeline
+from storage import open_storage, ReadCache
+from resume import ResumeData, recheck
+from bufferpool import BufferPool
+from pipelining import BLOCK_SIZE
+
+NEEDED, REQUESTED, DOWNLOADED = 0, 1, 2  # block states
+MAX_REQUEST = 128 * 1024  # largest block we upload in one piece message
 
 class Piece:
-    """Represents a single piece of the torrent."""
+    """Represents a single piece of the torrent.
+
+    Block state is one byte per block in `blocks`, indexed by offset // BLOCK_SIZE. It is only
+    allocated once the piece is in flight; until then every block is implicitly needed.
+    `contributors` holds the addresses of the peers whose blocks went into it.
+    """
+    __slots__ = ('index', 'length', 'hash', 'data', 'blocks', 'remaining', 'is_complete', 'is_downloading',
+                 'contributors')
+
     def __init__(self, index, torrent):
         self.index = index
-        self.torrent = torrent
-        self.length = torrent.piece_length if index < (len(torrent.pieces) // 20 - 1) else torrent.total_size % torrent.piece_length
-        if self.length == 0: self.length = torrent.piece_length
-        self.hash = torrent.pieces[index*20 : (index+1)*20]
+        self.length = torrent.piece_size(index)
+        self.hash = torrent.piece_hash(index)
         self.data = None
-        self.blocks = []
+        self.blocks = None
+        self.remaining = self.num_blocks
         self.is_complete = False
         self.is_downloading = False
-        self.init_blocks()
-
-    def init_blocks(self):
-        """Initializes the blocks for the piece."""
-        self.blocks = []
-        num_blocks = (self.length + 16383) // 16384
-        for i in range(num_blocks):
-            offset = i * 16384
-            length = min(16384, self.length - offset)
-            self.blocks.append({'offset': offset, 'length': length, 'status': 'needed'})
-
-    def add_block(self, offset, data):
-        """Adds a block to the piece."""
+        self.contributors = None
+
+    @property
+    def num_blocks(self):
+        return (self.length + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    def block_length(self, offset):
+        return min(BLOCK_SIZE, self.length - offset)
+
+    def block_states(self):
+        if self.blocks is None:
+            self.blocks = bytearray(self.num_blocks)
+        return self.blocks
+
+    def add_block(self, offset, data, source=None):
+        """Adds a block to the piece. Returns False if the block was already downloaded or is not a valid block."""
+        block, misaligned = divmod(offset, BLOCK_SIZE)
+        if misaligned or not 0 <= block < self.num_blocks or len(data) != self.block_length(offset):
+            return False
+        states = self.block_states()
+        if states[block] == DOWNLOADED:
+            return False
+        states[block] = DOWNLOADED
         self.data[offset:offset+len(data)] = data
-        for block in self.blocks:
-            if block['offset'] == offset:
-                block['status'] = 'downloaded'
-                break
-        
-        if all(b['status'] == 'downloaded' for b in self.blocks):
+        if source is not None:
+            if self.contributors is None:
+                self.contributors = set()
+            self.contributors.add(source)
+        self.remaining -= 1
+        if self.remaining == 0:
             self.is_complete = True
             self.is_downloading = False
+        return True
 
     def get_block_to_request(self):
-        for block in self.blocks:
-            if block['status'] == 'needed':
-                block['status'] = 'requested'
-                return block
-        return None
+        """Marks the first needed block as requested and returns its (offset, length), or None."""
+        if self.is_complete:
+            return None
+        states = self.block_states()
+        block = states.find(NEEDED)
+        if block < 0:
+            return None
+        states[block] = REQUESTED
+        offset = block * BLOCK_SIZE
+        return offset, self.block_length(offset)
+
+    def missing_blocks(self):
+        """Yields (offset, length) of every block that has not arrived yet."""
+        if self.is_complete:
+            return
+        states = self.block_states()
+        for block in range(len(states)):
+            if states[block] != DOWNLOADED:
+                offset = block * BLOCK_SIZE
+                yield offset, self.block_length(offset)
+
+    def mark_requested(self, offset):
+        if self.blocks is not None and self.blocks[offset // BLOCK_SIZE] == NEEDED:
+            self.blocks[offset // BLOCK_SIZE] = REQUESTED
+
+    def release_block(self, offset):
+        """Puts a requested block back so it can be requested again."""
+        block = offset // BLOCK_SIZE
+        if self.blocks is not None and block < len(self.blocks) and self.blocks[block] == REQUESTED:
+            self.blocks[block] = NEEDED
+
+    def release_requested(self):
+        """Puts every requested block back."""
+        if self.blocks is not None:
+            self.blocks = self.blocks.replace(bytes([REQUESTED]), bytes([NEEDED]))
 
     def is_hash_correct(self):
         return hashlib.sha1(self.data).digest() == self.hash
 
     def reset(self):
         self.data = None
+        self.blocks = None
+        self.remaining = self.num_blocks
         self.is_complete = False
         self.is_downloading = False
-        self.init_blocks()
+        self.contributors = None
+
+class PieceTable:
+    """The Piece objects of a torrent, made the first time each piece is looked up.
+
+    Only pieces that have been touched and aren't verified are kept, so a torrent with a
+    million pieces doesn't start with a million objects. Looking up a verified piece gives a
+    fresh Piece that is already complete.
+    """
+    def __init__(self, torrent, bitfield):
+        self.torrent = torrent
+        self.bitfield = bitfield
+        self.live = {}  # piece index -> Piece
+
+    def __len__(self):
+        return self.torrent.num_pieces
+
+    def __getitem__(self, index):
+        piece = self.live.get(index)
+        if piece is None:
+            if not 0 <= index < self.torrent.num_pieces:
+                raise IndexError(index)
+            piece = Piece(index, self.torrent)
+            if has_piece(self.bitfield, index):
+                piece.is_complete = True
+            else:
+                piece = self.live.setdefault(index, piece)  # another thread may have made it first
+        return piece
+
+    def discard(self, index):
+        """Forgets a piece once it is verified. Returns it, or None if it was never looked up."""
+        return self.live.pop(index, None)
 
 class PieceManager:
-    def __init__(self, torrent, download_dir, print_lock):
+    def __init__(self, torrent, download_dir, print_lock, strategy='rarest', hash_workers=None,
+                 max_pending_bytes=64 * 1024 * 1024, storage='pwrite', max_open_files=64,
+                 buffer_pool=None, disk=None):
         self.torrent = torrent
         self.download_dir = download_dir
         self.print_lock = print_lock
-        self.bitfield = bytearray((len(torrent.pieces) // 20 + 7) // 8)
-        self.pieces = [Piece(i, torrent) for i in range(len(torrent.pieces) // 20)]
-        self.needed_pieces = list(self.pieces)
-        random.shuffle(self.needed_pieces)
+        self.bitfield = bytearray((torrent.num_pieces + 7) // 8)
+        self.pieces = PieceTable(torrent, self.bitfield)
+        self.picker = PiecePicker(len(self.pieces), strategy)
+        self.seed_peers = set()  # peers counted once as seeds rather than per piece
         self.completed_pieces = 0
         self.downloaded_size = 0
+        self.duplicate_bytes = 0  # bytes received for blocks we already had (endgame waste)
+        self.endgame_requests = 0
+        self.dropped_blocks = 0  # blocks that arrived when no buffer could be had for their piece
+        self.on_verified = None  # callback(piece_index, contributors, ok) once a piece is checked (and written)
+        self.verified = threading.Condition()  # notified when pieces are verified, for readers waiting on them
+        self.file_priorities = [1] * len(torrent.files)
+        self.pool = buffer_pool or BufferPool()
+        self.storage = open_storage(torrent, download_dir, storage, max_open_files)
+        self.resume = ResumeData(self.storage, torrent.info_hash, download_dir)
+        self.read_cache = ReadCache(self.storage, torrent.piece_length)
+        self.hash_workers = hash_workers
         self.init_files()
+        if disk is None:
+            self.disk = DiskPipeline(hash_workers, max_pending_bytes).channel(self.write_piece_to_disk, owned=True,
+                                                                              print_lock=print_lock)
+        else:
+            self.disk = disk.channel(self.write_piece_to_disk, print_lock=print_lock)  # shared with other torrents
 
     def init_files(self):
-        for file_info in self.torrent.files:
-            path = os.path.join(self.download_dir, file_info['path'])
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            if not os.path.exists(path):
-                with open(path, 'wb') as f:
-                    f.truncate(file_info['length'])
+        existing = [os.path.exists(path) for path in self.storage.paths]
+        self.storage.allocate()
+        if any(existing):
+            self.resume_existing(existing)
+
+    def resume_existing(self, existing):
+        """Marks pieces already on disk as done, from the resume sidecar or by rechecking the data."""
+        piece_length = self.torrent.piece_length
+        resumed = self.resume.load(len(self.pieces), piece_length)
+        if resumed is not None:
+            bitfield, candidates = resumed
+            verified = [i for i in range(len(self.pieces)) if has_piece(bitfield, i)]
+            with self.print_lock:
+                print(f"Resuming: {len(verified)}/{len(self.pieces)} pieces already verified.")
+        else:
+            verified, candidates = [], range(len(self.pieces))
+        # Only pieces that lie entirely in files that were already there can be complete.
+        candidates = [i for i in candidates
+                      if all(existing[f] for f, _, _, _ in self.storage.spans(i * piece_length, self.torrent.piece_size(i)))]
+        if candidates:
+            with self.print_lock:
+                print(f"Rechecking {len(candidates)} pieces of existing data...")
+            rechecked = recheck(self.storage, piece_length, self.torrent.pieces, candidates, self.hash_workers,
+                                self.recheck_progress)
+            verified.extend(rechecked)
+            with self.print_lock:
+                print(f"\nRecheck done: {len(rechecked)}/{len(candidates)} pieces verified.")
+        for piece_index in verified:
+            self.mark_piece_complete(piece_index)
+        self.resume.save(self.bitfield)
+
+    def recheck_progress(self, done, total):
+        if done == total or done % 256 == 0:
+            with self.print_lock:
+                print(f"Rechecked {done}/{total} pieces", end='\r')
+
+    def mark_piece_complete(self, piece_index):
+        self.bitfield[piece_index // 8] |= (1 << (7 - piece_index % 8))
+        piece = self.pieces.discard(piece_index)
+        if piece is not None:  # peers may still hold it
+            piece.is_complete = True
+            piece.is_downloading = False
+            piece.blocks = None
+            piece.contributors = None
+        self.completed_pieces += 1
+        self.downloaded_size += self.torrent.piece_size(piece_index)
+        self.picker.mark_done(piece_index)
+
+    def set_file_priorities(self, priorities):
+        """Sets a priority per file: 0 = don't download, 1 = normal, up to MAX_PRIORITY first.
+
+        A piece that spans several files gets the highest priority among them.
+        """
+        files = self.torrent.files
+        if len(priorities) != len(files):
+            raise ValueError(f"expected {len(files)} file priorities, got {len(priorities)}")
+        piece_length = self.torrent.piece_length
+        pieces = bytearray(len(self.pieces))
+        for index, priority in enumerate(priorities):
+            priority = max(0, min(priority, MAX_PRIORITY))
+            start, end = files.offsets[index], files.offsets[index + 1]
+            if not priority or end == start:
+                continue
+            first, last = start // piece_length, (end - 1) // piece_length
+            pieces[first] = max(pieces[first], priority)
+            pieces[last] = max(pieces[last], priority)
+            pieces[first + 1:last] = bytes([priority]) * max(last - first - 1, 0)  # only this file's
+        self.file_priorities = list(priorities)
+        self.picker.set_priorities(pieces)
 
     def get_piece_to_download(self, peer_bitfield):
-        for i, piece in enumerate(self.needed_pieces):
-            if not piece.is_downloading: # Check if piece is already being downloaded
-                piece_index = piece.index
-                if (peer_bitfield[piece_index // 8] >> (7 - piece_index % 8)) & 1:
-                    piece.is_downloading = True
-                    return self.needed_pieces.pop(i)
+        if not self.disk.has_capacity():
+            return None  # let hashing and writing catch up before buffering more pieces
+        piece_index = self.picker.pick(peer_bitfield, self.completed_pieces)
+        if piece_index is None:
+            return None
+        piece = self.pieces[piece_index]
+        if piece.data is None:
+            piece.data = self.pool.acquire(piece.length)
+            if piece.data is None:
+                piece = self.reuse_released(peer_bitfield, piece)
+                if piece is None:
+                    return None  # memory budget used up; finish the pieces already in flight first
+        piece.is_downloading = True
+        self.picker.mark_in_progress(piece.index)
+        return piece
+
+    def reuse_released(self, peer_bitfield, wanted):
+        """With the buffer budget used up: a piece another peer handed back (snub, timeout, drop)
+        that still holds its buffer and that this peer has, so its blocks aren't lost. Failing that,
+        frees one such buffer for `wanted`: nothing else would ever give it back. None if neither works.
+        """
+        released = [p for p in list(self.pieces.live.values())
+                    if p.data is not None and not p.is_downloading and not p.is_complete]
+        for piece in released:
+            if self.picker.needed[piece.index] and has_piece(peer_bitfield, piece.index):
+                return piece
+        for piece in released:
+            self.pool.release(piece.data)
+            piece.reset()
+            wanted.data = self.pool.acquire(wanted.length)
+            if wanted.data is not None:
+                return wanted
         return None
 
-    def receive_block(self, piece_index, block_offset, data):
+    def add_peer_bitfield(self, peer, old_bitfield=None):
+        """Counts a peer's pieces toward availability (replacing a previous bitfield if it sent one)."""
+        if old_bitfield:
+            self.remove_peer(peer, old_bitfield)
+        if self.picker.add_bitfield(peer.bitfield):
+            self.seed_peers.add(peer)
+
+    def add_peer_have(self, piece_index):
+        self.picker.add_have(piece_index)
+
+    def remove_peer(self, peer, bitfield=None):
+        """Drops a disconnected peer's pieces from availability."""
+        bitfield = bitfield or peer.bitfield
+        if bitfield:
+            self.picker.remove_bitfield(bitfield, peer in self.seed_peers)
+        self.seed_peers.discard(peer)
+
+    def in_endgame(self):
+        return self.picker.in_endgame()
+
+    def overdue_pieces(self):
+        return self.picker.overdue()
+
+    def get_endgame_blocks(self, peer_bitfield, skip, limit, pieces=None):
+        """Returns up to `limit` missing blocks of in-progress pieces the peer has, for duplicate requests.
+
+        `skip(piece_index, block_offset)` filters out blocks the peer already asked for (or that
+        enough peers are already fetching). `pieces` limits the search, e.g. to overdue pieces.
+        """
+        blocks = []
+        for piece_index in list(self.picker.in_progress if pieces is None else pieces):
+            if not has_piece(peer_bitfield, piece_index):
+                continue
+            piece = self.pieces[piece_index]
+            for block_offset, block_length in piece.missing_blocks():
+                if not skip(piece_index, block_offset):
+                    piece.mark_requested(block_offset)
+                    blocks.append((piece_index, block_offset, block_length))
+                    if len(blocks) >= limit:
+                        self.endgame_requests += len(blocks)
+                        return blocks
+        self.endgame_requests += len(blocks)
+        return blocks
+
+    def has(self, piece_index):
+        """True if the piece is verified and on disk."""
+        return 0 <= piece_index < len(self.pieces) and has_piece(self.bitfield, piece_index)
+
+    def read_block(self, piece_index, block_offset, length):
+        """Returns a block of a verified piece for uploading, or None if the request is not valid."""
+        if not self.has(piece_index) or not 0 < length <= MAX_REQUEST \
+                or block_offset < 0 or block_offset + length > self.torrent.piece_size(piece_index):
+            return None
+        return self.read_cache.read(piece_index, block_offset, length)
+
+    def needed_count(self):
+        """Pieces still to download, not counting those of files that are skipped."""
+        picker = self.picker
+        return picker.wanted_count + picker.deferred_count + len(picker.in_progress)
+
+    def receive_block(self, piece_index, block_offset, data, source=None):
+        """Stores a block from peer address `source`. Returns True if it was new, False for a duplicate."""
         piece = self.pieces[piece_index]
-        if not piece.is_complete:
+        if piece.is_complete:
+            self.duplicate_bytes += len(data)
+            return False
+        if piece.data is None:
+            # A late or endgame block for a piece that isn't being downloaded right now.
+            piece.data = self.pool.acquire(piece.length)
             if piece.data is None:
-                piece.data = bytearray(piece.length)
-
-            piece.add_block(block_offset, data)
-            if piece.is_complete:
-                if piece.is_hash_correct():
-                    self.write_piece_to_disk(piece)
-                    self.completed_pieces += 1
-                    self.downloaded_size += piece.length
-                    self.bitfield[piece_index // 8] |= (1 << (7 - piece_index % 8))
-                    with self.print_lock:
-                        print(f"\nPiece {piece_index} completed and verified. ({self.completed_pieces}/{len(self.pieces)})")
-                else:
+                self.dropped_blocks += 1
+                piece.release_block(block_offset)
+                return False
+
+        if not piece.add_block(block_offset, data, source):
+            self.duplicate_bytes += len(data)
+            return False
+        if piece.is_complete:
+            self.disk.submit(piece)
+        return True
+
+    def process_completed(self):
+        """Applies hash and write results from the disk pipeline. Call with the data lock held."""
+        while True:
+            try:
+                result, piece, error = self.disk.results.get_nowait()
+            except queue.Empty:
+                return
+            piece_index = piece.index
+            contributors = piece.contributors
+            if result == 'written':
+                self.mark_piece_complete(piece_index)
+                try:
+                    self.resume.maybe_save(self.bitfield)
+                except OSError as e:  # e.g. a full disk; the next save tries again
                     with self.print_lock:
+                        print(f"\nCould not save resume data: {e}")
+                with self.verified:
+                    self.verified.notify_all()
+                with self.print_lock:
+                    print(f"\nPiece {piece_index} completed and verified. ({self.completed_pieces}/{len(self.pieces)})")
+            else:
+                with self.print_lock:
+                    if result == 'failed':
                         print(f"\nPiece {piece_index} hash check failed. Redownloading.")
-                    piece.reset()
-                    self.needed_pieces.insert(0, piece)
+                    else:
+                        print(f"\nPiece {piece_index} could not be written ({error}). Redownloading.")
+                if piece.data is not None:
+                    self.pool.release(piece.data)
+                piece.reset()
+                self.picker.mark_needed(piece_index)
+            if self.on_verified and result != 'write_failed':
+                self.on_verified(piece_index, contributors or (), result == 'written')
+
+    def release_piece(self, piece):
+        """Returns an unfinished piece to the needed list, e.g. when its peer goes away."""
+        if piece.is_complete or not piece.is_downloading:
+            return
+        piece.is_downloading = False
+        piece.release_requested()
+        self.picker.mark_needed(piece.index)
 
     def write_piece_to_disk(self, piece):
-        piece_offset = piece.index * self.torrent.piece_length
-        current_pos = 0
-        for file_info in self.torrent.files:
-            file_start = current_pos
-            file_end = file_start + file_info['length']
-            
-            if piece_offset < file_end and (piece_offset + piece.length) > file_start:
-                write_start = max(piece_offset, file_start)
-                write_end = min(piece_offset + piece.length, file_end)
-                
-                data_start = write_start - piece_offset
-                data_end = write_end - piece_offset
-                data_to_write = piece.data[data_start:data_end]
-                
-                file_pos = write_start - file_start
-                path = os.path.join(self.download_dir, file_info['path'])
-                with open(path, 'r+b') as f:
-                    f.seek(file_pos)
-                    f.write(data_to_write)
-            
-            current_pos = file_end
-        
-        piece.data = None
+        self.storage.write(piece.index * self.torrent.piece_length, piece.data)
+        buf, piece.data = piece.data, None
+        self.pool.release(buf)
+
+    def close(self):
+        """Applies the last disk results, closes files and saves resume data. Stop the disk pipeline first."""
+        self.process_completed()
+        self.storage.close()
+        self.resume.save(self.bitfield)
 
     def is_complete(self):
-        return self.completed_pieces == len(self.pieces)
\ No newline at end of file
+        return self.completed_pieces == len(self.pieces)
+
+    def is_done(self):
+        """True once every piece of the files we download is verified (all of them, unless some are skipped)."""
+        return self.is_complete() or not self.needed_count()
\ No newline at end of file
@@ -0,0 +1,24 @@
+"""Peer exchange (BEP 11): connected peers tell each other which peers they are connected to."""
+import bencodepy
+
+from Torrent import decode
+from Tracker import compact_peers, parse_compact_peers
+
+PEX_INTERVAL = 60  # seconds between messages to a peer
+MAX_PEX_PEERS = 50  # added (and dropped) peers per message; more are ignored
+SEED, REACHABLE = 0x02, 0x10  # added.f flags: the peer is a seed, it accepts incoming connections
+
+def pex_message(added, dropped, flags=None):
+    """A ut_pex payload. `flags` maps added addresses to their added.f flags; IPv4 peers only."""
+    added = [a for a in added if compact_peers([a])]
+    flags = flags or {}
+    return bencodepy.encode({b'added': compact_peers(added), b'added.f': bytes(flags.get(a, 0) for a in added),
+                             b'dropped': compact_peers(dropped)})
+
+def parse_pex(payload):
+    """The addresses a ut_pex payload adds, at most MAX_PEX_PEERS of them."""
+    message, _ = decode(bytes(payload), 0)
+    added = message.get(b'added', b'') if isinstance(message, dict) else None
+    if not isinstance(added, bytes):
+        return []
+    return parse_compact_peers(added[:6 * MAX_PEX_PEERS])
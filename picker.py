@@ -0,0 +1,270 @@
+import random
+import time
+from array import array
+from itertools import compress
+
+def has_piece(bitfield, index):
+    return (bitfield[index >> 3] >> (7 - (index & 7))) & 1
+
+class RarestFirst:
+    """Picks the piece the fewest connected peers have."""
+    def pick(self, picker, bitfield):
+        buckets = picker.buckets
+        # With connected seeds every piece is available, so the zero bucket counts too.
+        for count in range(0 if picker.seeds else 1, len(buckets)):
+            for index in buckets[count]:
+                if has_piece(bitfield, index):
+                    return index
+        return None
+
+class RandomFirst:
+    """Picks a random piece, so the first pieces complete quickly and become tradeable."""
+    def __init__(self, attempts=64):
+        self.attempts = attempts
+
+    def pick(self, picker, bitfield):
+        for _ in range(self.attempts):
+            index = random.randrange(picker.num_pieces)
+            if picker.wanted[index] and has_piece(bitfield, index):
+                return index
+        return RarestFirst().pick(picker, bitfield)
+
+class Sequential:
+    """Picks the lowest-numbered piece still needed, for streaming."""
+    def pick(self, picker, bitfield):
+        wanted = picker.wanted
+        index = wanted.find(1, picker.cursor)
+        if index != -1:
+            picker.cursor = index
+        while index != -1:
+            if has_piece(bitfield, index):
+                return index
+            index = wanted.find(1, index + 1)
+        return None
+
+STRATEGIES = {'rarest': RarestFirst, 'sequential': Sequential}
+MAX_PRIORITY = 7  # piece and file priorities: 0 = don't download, 1 = normal, up to 7
+
+# Byte translation tables: 1 -> 0xff (to mask priorities with `needed`), and priority p -> 1.
+ONES_TO_FF = bytes([0, 0xff] + [0] * 254)
+TIER_MASKS = [bytes(int(value == tier) for value in range(256)) for tier in range(MAX_PRIORITY + 1)]
+
+def and_bytes(a, b):
+    return (int.from_bytes(a, 'big') & int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+# Bit offsets set in each byte value, most significant bit first.
+SET_BITS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+
+class PiecePicker:
+    """Keeps per-piece availability counts and chooses the next piece for a peer.
+
+    Pieces that are still needed and not being downloaded sit in buckets keyed by how
+    many peers have them, so rarest-first only looks at the lowest non-empty buckets.
+    Buckets are lists with swap-removal (`position` maps a piece to its slot), so adding,
+    removing and moving a piece are O(1).
+
+    Peers that have everything are only counted in `seeds`: they raise every piece
+    equally, so they don't change the order and cost O(1) instead of O(pieces). A large
+    bitfield only updates the counts and the buckets are rebuilt once before the next pick.
+
+    Pieces have priorities (see set_priorities). Only the highest priority tier that still has
+    needed pieces is in the buckets; lower tiers wait in `needed` until it runs out, and are
+    only picked early from a peer that has none of the top tier. Pieces with a deadline (a
+    reader is waiting for them) are picked before anything else, earliest deadline first.
+    """
+    def __init__(self, num_pieces, strategy='rarest', random_first=4):
+        self.num_pieces = num_pieces
+        self.availability = array('I', bytes(4 * num_pieces))
+        self.needed = bytearray(b'\x01' * num_pieces)  # 1 = not verified and not in progress
+        self.wanted = bytearray(b'\x01' * num_pieces)  # 1 = needed and in the top priority tier
+        self.wanted_count = num_pieces
+        self.priority = bytearray(b'\x01' * num_pieces)
+        self.tier = 1  # priority of the pieces in `wanted`
+        self.deferred_count = 0  # needed pieces below the top tier (priority 0 ones aren't counted)
+        self.deadlines = {}  # piece index -> time.monotonic() a reader wants it by
+        self.in_progress = set()
+        self.buckets = [list(range(num_pieces))]
+        self.position = array('I', range(num_pieces))
+        self.stale = False
+        self.seeds = 0
+        self.full_bitfield = bytearray(b'\xff' * (num_pieces // 8))
+        if num_pieces % 8:
+            self.full_bitfield.append((0xff00 >> (num_pieces % 8)) & 0xff)
+        self.cursor = 0
+        self.strategy = STRATEGIES[strategy]() if isinstance(strategy, str) else strategy
+        self.random_first = random_first
+        self.first_strategy = RandomFirst()
+
+    def pick(self, bitfield, completed_pieces=0):
+        """Returns the index of a piece the peer has and we want, or None."""
+        if self.stale:
+            self._rebuild()
+        if self.deadlines:
+            for index in sorted(self.deadlines, key=self.deadlines.get):
+                if self.needed[index] and has_piece(bitfield, index):
+                    return index
+        if completed_pieces < self.random_first and isinstance(self.strategy, RarestFirst):
+            index = self.first_strategy.pick(self, bitfield)
+        else:
+            index = self.strategy.pick(self, bitfield)
+        if index is None and self.deferred_count:
+            index = self._pick_deferred(bitfield)
+        return index
+
+    def _pick_deferred(self, bitfield):
+        # The peer has nothing from the top tier; rather than leave it idle, take a lower one.
+        needed, priority = self.needed, self.priority
+        index = needed.find(1)
+        while index != -1:
+            if priority[index] and has_piece(bitfield, index):
+                return index
+            index = needed.find(1, index + 1)
+        return None
+
+    def set_priorities(self, priorities):
+        """Sets every piece's priority (0 to MAX_PRIORITY; 0 = don't download unless it has a deadline)."""
+        if len(priorities) != self.num_pieces:
+            raise ValueError(f"expected {self.num_pieces} priorities, got {len(priorities)}")
+        self.priority = bytearray(min(p, MAX_PRIORITY) for p in priorities)
+        self._retier()
+
+    def set_deadline(self, index, deadline):
+        """Asks for a piece by time.monotonic() `deadline`; cleared when it is done."""
+        if 0 <= index < self.num_pieces and (self.needed[index] or index in self.in_progress):
+            self.deadlines[index] = deadline
+
+    def clear_deadline(self, index):
+        self.deadlines.pop(index, None)
+
+    def overdue(self, now=None):
+        """In-progress pieces past their deadline, which other peers may help finish."""
+        now = time.monotonic() if now is None else now
+        return [index for index, deadline in self.deadlines.items() if deadline <= now and index in self.in_progress]
+
+    def add_bitfield(self, bitfield):
+        """Counts a peer's pieces. Returns True if the peer was counted as a seed."""
+        if bitfield == self.full_bitfield:
+            self.seeds += 1
+            return True
+        self._count_bitfield(bitfield, 1)
+        return False
+
+    def remove_bitfield(self, bitfield, seed=False):
+        if seed:
+            self.seeds -= 1
+        else:
+            self._count_bitfield(bitfield, -1)
+
+    def add_have(self, index):
+        if index < self.num_pieces:
+            self._adjust(index, 1)
+
+    def in_endgame(self):
+        """True once every remaining piece is already being downloaded."""
+        return self.wanted_count == 0 and bool(self.in_progress)
+
+    def mark_in_progress(self, index):
+        self._take(index)
+        self.in_progress.add(index)
+
+    def mark_needed(self, index):
+        """Makes a piece pickable again, e.g. after a failed hash check or a lost peer."""
+        self.in_progress.discard(index)
+        if self.needed[index]:
+            return
+        self.needed[index] = 1
+        priority = self.priority[index]
+        if priority > self.tier:
+            self._retier()
+        elif priority == self.tier:
+            self.wanted[index] = 1
+            self.wanted_count += 1
+            if not self.stale:
+                self._add(self.availability[index], index)
+            self.cursor = min(self.cursor, index)
+        elif priority:
+            self.deferred_count += 1
+
+    def mark_done(self, index):
+        self._take(index)
+        self.in_progress.discard(index)
+        self.deadlines.pop(index, None)
+
+    def _take(self, index):
+        if not self.needed[index]:
+            return
+        self.needed[index] = 0
+        if self.wanted[index]:
+            self.wanted[index] = 0
+            self.wanted_count -= 1
+            if not self.stale:
+                self._remove(self.availability[index], index)
+            if not self.wanted_count and self.deferred_count:
+                self._retier()
+        elif self.priority[index]:
+            self.deferred_count -= 1
+
+    def _retier(self):
+        """Fills `wanted` with the needed pieces of the highest priority any of them has."""
+        priorities = and_bytes(self.needed.translate(ONES_TO_FF), self.priority)
+        self.tier = max(priorities, default=0) or 1
+        self.wanted = bytearray(priorities.translate(TIER_MASKS[self.tier]))
+        self.wanted_count = self.wanted.count(1)
+        self.deferred_count = self.num_pieces - priorities.count(0) - self.wanted_count
+        self.cursor = 0
+        self.stale = True  # the buckets only hold wanted pieces
+
+    def _count_bitfield(self, bitfield, delta):
+        availability = self.availability
+        num_pieces = self.num_pieces
+        if self.stale or sum(map(int.bit_count, bitfield)) > num_pieces // 16:
+            # Cheaper to recount and rebuild the buckets once than to move every piece.
+            self.stale = True
+            for byte_index, byte in enumerate(bitfield):
+                if byte:
+                    base = byte_index * 8
+                    for bit in SET_BITS[byte]:
+                        index = base + bit
+                        if index < num_pieces and availability[index] + delta >= 0:
+                            availability[index] += delta
+            return
+        for byte_index, byte in enumerate(bitfield):
+            if byte:
+                base = byte_index * 8
+                for bit in SET_BITS[byte]:
+                    if base + bit < num_pieces:
+                        self._adjust(base + bit, delta)
+
+    def _adjust(self, index, delta):
+        old = self.availability[index]
+        new = old + delta
+        if new < 0:
+            return
+        self.availability[index] = new
+        if self.wanted[index] and not self.stale:
+            self._remove(old, index)
+            self._add(new, index)
+
+    def _add(self, count, index):
+        while count >= len(self.buckets):
+            self.buckets.append([])
+        bucket = self.buckets[count]
+        self.position[index] = len(bucket)
+        bucket.append(index)
+
+    def _remove(self, count, index):
+        bucket = self.buckets[count]
+        last = bucket.pop()
+        if last != index:
+            slot = self.position[index]
+            bucket[slot] = last
+            self.position[last] = slot
+
+    def _rebuild(self):
+        availability = self.availability
+        self.buckets = [[] for _ in range(max(availability, default=0) + 1)]
+        for index in compress(range(self.num_pieces), self.wanted):
+            bucket = self.buckets[availability[index]]
+            self.position[index] = len(bucket)
+            bucket.append(index)
+        self.stale = False
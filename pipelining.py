@@ -0,0 +1,141 @@
+import math
+import time
+
+BLOCK_SIZE = 16384
+
+class RequestPipeline:
+    """Tracks outstanding block requests to one peer and sizes the request window.
+
+    The window is the number of requests kept in flight. It is sized from the
+    observed throughput so that roughly `queue_time` seconds of data (and never
+    less than two round trips) are always requested ahead of what has arrived.
+
+    The throughput is an exponentially weighted average over half-second samples.
+    Reading `rate` counts the time since the last sample as well, so the estimate
+    decays towards zero while nothing arrives instead of keeping its last value.
+    """
+    SAMPLE_TIME = 0.5  # seconds per throughput sample
+    WEIGHT = 0.7       # weight of the previous average when a sample is added
+
+    def __init__(self, min_window=2, max_window=250, initial_window=8, queue_time=1.0):
+        self.min_window = min_window
+        self.max_window = max_window
+        self.initial_window = max(min_window, min(initial_window, max_window))
+        self.window = self.initial_window
+        self.queue_time = queue_time
+        self.outstanding = {}  # (piece_index, offset) -> (length, sent_at)
+        self._rate = 0.0       # bytes/sec as of the last completed sample
+        self.min_rtt = None    # best request->block time seen, approximates the link RTT
+        self.received_bytes = 0
+        self.last_rtt = None   # request->block time of the latest block
+        self.last_progress = time.monotonic()  # last block, or the first request after an idle spell
+        self.snubbed = False
+        self._sample_bytes = 0
+        self._sample_start = time.monotonic()
+        self._last_block = self._sample_start
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def __contains__(self, key):
+        return key in self.outstanding
+
+    def has_room(self):
+        return len(self.outstanding) < self.window
+
+    def add(self, piece_index, offset, length):
+        """Records a request that was sent to the peer."""
+        now = time.monotonic()
+        if not self.outstanding:
+            self.last_progress = now
+        self.outstanding[(piece_index, offset)] = (length, now)
+
+    def complete(self, piece_index, offset, length):
+        """Records an arrived block. Returns False if it was not requested."""
+        entry = self.outstanding.pop((piece_index, offset), None)
+        if entry is None:
+            return False
+        now = time.monotonic()
+        if now - self._last_block > self.SAMPLE_TIME and now - self._sample_start >= self.SAMPLE_TIME:
+            # The first block after a silence: close the sample that ended before it.
+            self._rate = self.current_rate(now)
+            self._sample_bytes = 0
+            self._sample_start = now
+        self.last_progress = self._last_block = now
+        self.received_bytes += length
+        if self.snubbed:
+            self.snubbed = False
+            self.window = self.min_window
+        rtt = self.last_rtt = now - entry[1]
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        self._sample_bytes += length
+        if now - self._sample_start >= self.SAMPLE_TIME:
+            self._rate = self.current_rate(now)
+            self._sample_bytes = 0
+            self._sample_start = now
+            self._resize()
+        return True
+
+    @property
+    def rate(self):
+        """Bytes/sec received from the peer lately; falls off while it sends nothing."""
+        return self.current_rate(time.monotonic())
+
+    def current_rate(self, now):
+        elapsed = now - self._sample_start
+        if elapsed < self.SAMPLE_TIME:
+            return self._rate
+        # The bytes so far make one sample up to the last block (at least SAMPLE_TIME long); the
+        # silence after it counts as that many samples of nothing, so a stalled peer's rate falls
+        # off exponentially.
+        span = min(max(self._last_block - self._sample_start, self.SAMPLE_TIME), elapsed)
+        rate = self._sample_bytes / span
+        if self._rate:
+            weight = self.WEIGHT ** (span / self.SAMPLE_TIME)
+            rate = weight * self._rate + (1 - weight) * rate
+        return rate * self.WEIGHT ** ((elapsed - span) / self.SAMPLE_TIME)
+
+    def cancel(self, piece_index, offset):
+        """Forgets a request we cancelled. Returns False if it was not outstanding."""
+        return self.outstanding.pop((piece_index, offset), None) is not None
+
+    def stalled(self, timeout):
+        """True if requests are outstanding but nothing has arrived for `timeout` seconds."""
+        return bool(self.outstanding) and time.monotonic() - self.last_progress >= timeout
+
+    def expired(self, timeout):
+        """Returns requests outstanding for at least `timeout` seconds as (index, offset, length).
+
+        Safe to call while another thread completes or cancels requests: it works on a snapshot.
+        """
+        deadline = time.monotonic() - timeout
+        return [(index, offset, length) for (index, offset), (length, sent_at) in list(self.outstanding.items())
+                if sent_at <= deadline]
+
+    def snub(self):
+        """Shrinks the window to a single request until the peer delivers again."""
+        self.snubbed = True
+        self.window = 1
+
+    def clear(self):
+        """Forgets every outstanding request (e.g. after a choke) and returns their keys.
+
+        The throughput estimate and the window start over too: after a choke the old rate
+        says nothing about what the peer will send next.
+        """
+        keys = list(self.outstanding)
+        self.outstanding.clear()
+        self._rate = 0.0
+        self._sample_bytes = 0
+        self._sample_start = self._last_block = time.monotonic()
+        if not self.snubbed:
+            self.window = self.initial_window
+        return keys
+
+    def _resize(self):
+        target_time = self.queue_time
+        if self.min_rtt is not None:
+            target_time = max(target_time, 2 * self.min_rtt)
+        wanted = math.ceil(self._rate * target_time / BLOCK_SIZE)
+        self.window = max(self.min_window, min(wanted, self.max_window))
@@ -0,0 +1,67 @@
+import threading
+import time
+
+class TokenBucket:
+    """Allows `rate` bytes per second on average, in bursts of up to `burst` seconds' worth.
+
+    A rate of 0 means unlimited. `consume` may overdraw the bucket; the debt is paid off
+    before anything else is allowed, so a block never has to be split to fit. The rate can be
+    changed at any time from any thread.
+    """
+    def __init__(self, rate=0, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = rate * burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * self.burst)
+
+    def available(self):
+        """Bytes that may be used right now (infinite when unlimited, negative while in debt)."""
+        if not self.rate:
+            return float('inf')
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate * self.burst)
+        self.last = now
+
+class RateLimits:
+    """Download and upload buckets of one level: the session, a torrent or a peer."""
+    def __init__(self, download=0, upload=0):
+        self.download = TokenBucket(download)
+        self.upload = TokenBucket(upload)
+
+    def set(self, download=None, upload=None):
+        """Changes the limits in bytes per second (0 for unlimited); None leaves one as it is."""
+        if download is not None:
+            self.download.set_rate(download)
+        if upload is not None:
+            self.upload.set_rate(upload)
+
+def allowance(buckets):
+    """Bytes every bucket of a chain (e.g. peer, torrent, session) allows right now."""
+    return min(bucket.available() for bucket in buckets)
+
+def consume(buckets, amount):
+    for bucket in buckets:
+        bucket.consume(amount)
+
+def format_rate(rate):
+    """A bytes-per-second limit for the status line."""
+    return f"{rate / 1024:.0f} KiB/s" if rate else "unlimited"
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class ResumeData:
+    """Sidecar file that remembers which pieces are verified on disk.
+
+    It stores the piece bitfield together with the size and mtime of every file. On startup
+    the bitfield is trusted for files that still match; pieces touching a changed file are rechecked.
+    Saves go through a temporary file and os.replace, so the sidecar is never half-written.
+    """
+    def __init__(self, storage, info_hash, download_dir, save_interval=5.0):
+        self.storage = storage
+        self.info_hash = info_hash
+        self.path = os.path.join(download_dir, f'.{info_hash.hex()}.resume')
+        self.save_interval = save_interval
+        self.last_save = 0.0
+
+    def file_stats(self):
+        stats = []
+        for path in self.storage.paths:
+            try:
+                st = os.stat(path)
+                stats.append([st.st_size, st.st_mtime_ns])
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def load(self, num_pieces, piece_length):
+        """Returns (bitfield, stale) from the sidecar, or None if there is no usable one.
+
+        `stale` lists the pieces that touch a file whose size or mtime changed since the save;
+        they are cleared from the bitfield and have to be rechecked.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            bitfield = bytearray.fromhex(state['bitfield'])
+            saved = state['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if state.get('info_hash') != self.info_hash.hex() or len(bitfield) != (num_pieces + 7) // 8:
+            return None
+        if not isinstance(saved, list) or len(saved) != len(self.storage.paths):
+            return None
+        stale = set()
+        for index, stats in enumerate(self.file_stats()):
+            length = self.storage.lengths[index]
+            if stats == saved[index] or length == 0:
+                continue
+            start = self.storage.offsets[index]
+            stale.update(range(start // piece_length, (start + length - 1) // piece_length + 1))
+        for index in stale:
+            bitfield[index // 8] &= ~(1 << (7 - index % 8))
+        return bitfield, sorted(stale)
+
+    def save(self, bitfield):
+        state = {'info_hash': self.info_hash.hex(), 'bitfield': bitfield.hex(), 'files': self.file_stats()}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+
+    def maybe_save(self, bitfield):
+        """Saves if the last save is older than save_interval."""
+        if time.monotonic() - self.last_save >= self.save_interval:
+            self.save(bitfield)
+
+def recheck(storage, piece_length, piece_hashes, indices, workers=None, progress=None):
+    """Hashes existing data for the given pieces in parallel and returns the indices that verify.
+
+    Reading (preadv) and hashing (hashlib) both release the GIL, so threads use every core
+    while only `workers` pieces are held in memory at a time.
+    """
+    def check(index):
+        length = min(piece_length, storage.total_size - index * piece_length)
+        data = storage.read(index * piece_length, length)
+        return index, hashlib.sha1(data).digest() == piece_hashes[index * 20:(index + 1) * 20]
+
+    verified = []
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for done, (index, ok) in enumerate(pool.map(check, indices), 1):
+            if ok:
+                verified.append(index)
+            if progress:
+                progress(done, len(indices))
+    return verified
@@ -0,0 +1,492 @@
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from Downloader import Downloader, bind_listener
+from Torrent import Torrent
+from bufferpool import BufferPool, BufferShare
+from disk import DiskPipeline
+from magnet import Magnet, MetadataFetcher, metadata_path, save_torrent
+from ratelimit import RateLimits, format_rate
+
+RUNNING = ('downloading', 'seeding')
+TOKEN_HEADER = 'X-Session-Token'
+TOKEN_FILE = '.session-token'  # in the download directory, readable by the user only
+
+class SessionTorrent:
+    """A torrent in a session: the .torrent it came from and, unless paused or finished, its Downloader."""
+    def __init__(self, path, torrent):
+        self.path = path
+        self.id = torrent.info_hash.hex()
+        self.info_hash = torrent.info_hash
+        self.name = torrent.name
+        self.downloader = None
+        self.engine_future = None
+        self.buffers = None
+        self.fetcher = None  # a MetadataFetcher while a magnet link's metadata is being fetched
+        self.state = 'starting'  # starting | metadata | downloading | seeding | paused | finished | error
+        self.error = None
+        self.last_summary = {}  # kept after the downloader stops so paused torrents still report progress
+        self.rates = {'download': 0, 'upload': 0}  # this torrent's limits in bytes/s, kept across pause/resume
+
+class Session:
+    """Runs many torrents in one process under global limits.
+
+    Every torrent runs on one asyncio event loop and shares one listening socket (inbound
+    peers are routed by the info hash in their handshake), one disk pipeline with
+    `disk_writers` writer threads and one buffer pool of `max_buffer_mb`.
+
+    Once a second the limits are split fairly between running torrents. Each gets an equal
+    part of `max_peers` and `max_connecting`; the part a torrent can't use because it has
+    nobody left to try goes to the torrents that still have candidates waiting, and torrents
+    over their part lose their slowest peers. Each torrent may hold up to twice its equal
+    part of the buffer budget, so a busy torrent can borrow from idle ones while the pool as a
+    whole stays within budget.
+
+    With `dht` (a dht.DHT), every torrent that isn't private also looks for peers on the DHT,
+    and magnet links without trackers can be fetched.
+
+    A JSON API on 127.0.0.1:`control_port` adds, pauses, resumes, removes and lists torrents:
+
+        GET    /torrents               all torrents
+        POST   /torrents               {"path": "file.torrent"} or {"path": "magnet:?..."} adds one
+        GET    /torrents/<id>          one torrent (id is the info hash in hex)
+        POST   /torrents/<id>/pause    stop it, keeping its data
+        POST   /torrents/<id>/resume   start it again
+        POST   /torrents/<id>/limits   {"download": KiB/s, "upload": KiB/s} for this torrent, 0 for none
+        DELETE /torrents/<id>          stop it and forget it (downloaded files stay)
+        GET    /session                totals and limits
+        POST   /session/limits         {"download": KiB/s, "upload": KiB/s} for the whole session
+
+    Every request must carry the session's token in an X-Session-Token header, and a body
+    must be sent as Content-Type: application/json, so a web page the user happens to open
+    can't drive the API. The token is `control_token`, or a random one written to
+    .session-token in the download directory.
+    """
+    def __init__(self, download_dir, max_peers=200, max_connecting=50, max_buffer_mb=512, hash_workers=None,
+                 disk_writers=2, max_pending_mb=128, listen_port=6881, control_port=8765, seed=False,
+                 download_rate=0, upload_rate=0, metrics=None, dht=None, control_token=None, **options):
+        self.download_dir = download_dir
+        self.max_peers = max_peers
+        self.max_connecting = max_connecting
+        self.listen_port = listen_port  # None: don't accept inbound peers
+        self.control_port = control_port  # None: no control API
+        self.control_token = control_token or secrets.token_urlsafe(24)
+        self.seed = seed
+        self.options = options  # passed on to every Downloader (strategy, storage, max_requests, ...)
+        self.print_lock = threading.Lock()
+        self.pool = BufferPool(max_buffer_mb * 1024 * 1024)
+        self.disk = DiskPipeline(hash_workers, max_pending_mb * 1024 * 1024, disk_writers)
+        self.disk.metrics = self.metrics = metrics  # shared by every torrent; None to record nothing
+        self.limits = RateLimits(download_rate, upload_rate)  # bytes/s over all torrents
+        self.dht = dht
+        self.torrents = {}  # id -> SessionTorrent, in the order they were added
+        self.lock = threading.Lock()
+        self.listen_sock = None
+        self.announce_port = listen_port or 6881
+        self.control_server = None
+        self.loop = None
+        self.stopped = None
+        self.ready = threading.Event()
+        self.thread = None
+        self.is_running = True
+
+    def start(self):
+        """Starts the event loop thread, the peer listener and the control API."""
+        if self.listen_port is not None:
+            self.listen_sock = bind_listener(self.listen_port, backlog=128)
+            if self.listen_sock is None:
+                with self.print_lock:
+                    print(f"Could not listen on port {self.listen_port} or the next few; "
+                          "only outgoing connections will be made.")
+            else:
+                self.announce_port = self.listen_sock.getsockname()[1]
+                with self.print_lock:
+                    print(f"Listening for peers on port {self.announce_port}")
+        if self.control_port is not None:
+            self.start_control()
+        self.thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = None
+        if self.listen_sock:
+            server = await asyncio.start_server(self.accept, sock=self.listen_sock, backlog=128)
+        self.ready.set()
+        while not self.stopped.is_set():
+            self.tick()
+            try:
+                await asyncio.wait_for(self.stopped.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+        if server:
+            server.close()
+        with self.lock:
+            running = [t for t in self.torrents.values() if t.downloader or t.fetcher]
+        if running:
+            # Tracker farewells take a few seconds each; say them all at once.
+            with ThreadPoolExecutor(max_workers=len(running)) as pool:
+                await asyncio.gather(*(self.loop.run_in_executor(pool, self.stop_torrent, t) for t in running))
+
+    async def accept(self, reader, writer):
+        """Reads an inbound peer's handshake and hands the connection to the torrent it asks for."""
+        try:
+            handshake = await asyncio.wait_for(reader.readexactly(68), 5)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        info_hash = handshake[28:48]
+        with self.lock:
+            target = next((t for t in self.torrents.values() if t.info_hash == info_hash and t.state in RUNNING), None)
+        downloader = target and target.downloader
+        if downloader is None or not downloader.is_running:
+            writer.close()
+            return
+        await downloader.async_engine.accept(reader, writer, handshake)
+
+    def tick(self):
+        """Runs on the loop once a second: completion, fair shares of the limits and the status line."""
+        with self.lock:
+            running = [t for t in self.torrents.values() if t.state in RUNNING and t.downloader]
+        for t in list(running):
+            d = t.downloader
+            if not d.check_complete():
+                t.state = 'finished'
+                running.remove(t)
+                self.loop.run_in_executor(None, self.stop_torrent, t)
+            elif d.seeding:
+                t.state = 'seeding'
+        self.rebalance(running)
+        self.print_status()
+
+    def rebalance(self, running):
+        """Splits the peer, connect and buffer limits between the running torrents.
+
+        A torrent over its new target loses its slowest peers at once, but one under it may
+        only grow into slots that are free now, so the total never goes over max_peers while
+        peers are being moved from one torrent to another.
+        """
+        running = [(t, t.downloader) for t in running if t.downloader]  # one may be paused meanwhile
+        if not running:
+            return
+        share = max(self.max_peers // len(running), 1)
+        used, hungry, spare = {}, [], 0
+        for t, d in running:
+            stats = d.connections.stats()
+            used[t] = stats['connected'] + stats['connecting']
+            if d.connections.has_candidates():
+                hungry.append(t)
+            else:
+                spare += max(share - used[t], 0)
+        bonus = spare // len(hungry) if hungry else 0
+        free = self.max_peers - sum(used.values())
+        budget = self.pool.budget
+        for t, d in sorted(running, key=lambda item: used[item[0]]):
+            target = share + bonus if t in hungry else share
+            if target > used[t]:
+                grant = max(min(target - used[t], free), 0)
+                free -= grant
+                target = used[t] + grant
+            d.connections.target_peers = d.connections.max_peers = target
+            d.connections.max_connecting = max(self.max_connecting // len(running), 1)
+            t.buffers.limit = 2 * budget // len(running)
+            peers = [p for p in d.peers if p.is_connected()]
+            if len(peers) > target:
+                # The rate decays while a peer sends nothing, so silent peers go first.
+                rates = {p: p.pipeline.rate for p in peers}
+                peers.sort(key=rates.get)
+                for peer in peers[:len(peers) - target]:
+                    peer.close()
+
+    def add(self, path):
+        """Adds a .torrent file or magnet link and starts it. Returns its id.
+
+        Blocks while existing data is checked. A magnet link whose metadata isn't in the
+        download directory yet is fetched in the background first (state 'metadata').
+        """
+        if path.startswith('magnet:'):
+            magnet = Magnet(path)
+            cached = metadata_path(self.download_dir, magnet.info_hash)
+            if os.path.exists(cached):
+                return self.add(cached)
+            t = SessionTorrent(path, magnet)
+        else:
+            t = SessionTorrent(path, Torrent(path))
+        with self.lock:
+            if t.id in self.torrents:
+                raise ValueError(f"{t.name} is already in the session")
+            self.torrents[t.id] = t
+        if t.path.startswith('magnet:'):
+            self.resolve(t)
+        else:
+            self.launch(t)
+        return t.id
+
+    def resolve(self, t):
+        """Fetches a magnet link's metadata in the background, then starts the download."""
+        t.state, t.error = 'metadata', None
+        t.fetcher = MetadataFetcher(Magnet(t.path), print_lock=self.print_lock, port=self.announce_port, dht=self.dht)
+        threading.Thread(target=self.fetch_metadata, args=(t, t.fetcher), daemon=True).start()
+
+    def fetch_metadata(self, t, fetcher):
+        try:
+            torrent = fetcher.fetch()
+            path = metadata_path(self.download_dir, t.info_hash)
+            os.makedirs(self.download_dir, exist_ok=True)
+            save_torrent(path, torrent)
+        except Exception as e:
+            if t.state == 'metadata':
+                t.state, t.error = 'error', str(e)
+            return
+        finally:
+            t.fetcher = None
+        if t.state != 'metadata' or not self.is_running:
+            return  # removed while fetching, or the session is shutting down
+        t.path, t.name = path, torrent.name
+        try:
+            self.launch(t)
+        except Exception:
+            return  # launch records the error
+        t.downloader.connections.add_peers(fetcher.known_peers())
+
+    def launch(self, t):
+        t.buffers = BufferShare(self.pool)
+        try:
+            # No peers until the next tick gives the torrent its share of the limits.
+            d = Downloader(t.path, self.download_dir, engine='asyncio', listen_port=None, seed=self.seed, target_peers=0,
+                           print_lock=self.print_lock, buffer_pool=t.buffers, disk=self.disk,
+                           download_rate=t.rates['download'], upload_rate=t.rates['upload'],
+                           global_limits=self.limits, metrics=self.metrics, dht=self.dht, **self.options)
+        except Exception as e:
+            t.state, t.error = 'error', str(e)
+            raise
+        d.trackers.tracker.port = self.announce_port
+        d.public_port = self.announce_port if self.listen_sock else None
+        t.downloader, t.state, t.error = d, 'downloading', None
+        t.engine_future = d.start(self.loop)
+        self.loop.call_soon_threadsafe(self.tick)
+
+    def stop_torrent(self, t):
+        """Stops a torrent's downloader and waits for its engine to finish. Blocks; keep it off the loop.
+
+        The engine closes the torrent's files and saves its resume data on the loop as it finishes.
+        """
+        if t.fetcher:
+            t.fetcher.stop()
+        d = t.downloader
+        if d is None:
+            return
+        t.last_summary = d.summary()
+        d.stop()
+        try:
+            t.engine_future.result(60)
+        except Exception:
+            pass
+        t.downloader = None
+
+    def pause(self, torrent_id):
+        t = self.get(torrent_id)
+        if t.state in RUNNING:
+            t.state = 'paused'
+            self.stop_torrent(t)
+
+    def resume(self, torrent_id):
+        t = self.get(torrent_id)
+        if t.state in ('paused', 'error'):
+            if t.path.startswith('magnet:'):
+                self.resolve(t)
+            else:
+                self.launch(t)
+
+    def set_limits(self, download=None, upload=None, torrent_id=None):
+        """Changes the session's rate limits, or one torrent's, in bytes/s (0 for none)."""
+        if torrent_id is None:
+            self.limits.set(download, upload)
+            return
+        t = self.get(torrent_id)
+        for direction, rate in (('download', download), ('upload', upload)):
+            if rate is not None:
+                t.rates[direction] = rate
+        d = t.downloader
+        if d is not None:
+            d.set_limits(download, upload)
+
+    def remove(self, torrent_id):
+        t = self.get(torrent_id)
+        with self.lock:
+            del self.torrents[torrent_id]
+        t.state = 'removed'
+        self.stop_torrent(t)
+
+    def get(self, torrent_id):
+        with self.lock:
+            if torrent_id not in self.torrents:
+                raise KeyError(torrent_id)
+            return self.torrents[torrent_id]
+
+    def describe(self, t):
+        d = t.downloader
+        if d is not None:
+            t.last_summary = d.summary()
+        info = {'id': t.id, 'name': t.name, 'path': t.path, 'state': t.state, 'error': t.error}
+        info.update(t.last_summary)
+        info.update(download_limit=t.rates['download'], upload_limit=t.rates['upload'])
+        return info
+
+    def list(self):
+        with self.lock:
+            torrents = list(self.torrents.values())
+        return [self.describe(t) for t in torrents]
+
+    def stats(self):
+        torrents = self.list()
+        states = [t['state'] for t in torrents]
+        disk = self.disk.stats()
+        return {
+            'torrents': len(torrents),
+            'states': {state: states.count(state) for state in set(states)},
+            'peers': sum(t.get('peers', 0) for t in torrents if t['state'] in RUNNING),
+            'max_peers': self.max_peers,
+            'download_rate': sum(t.get('download_rate', 0) for t in torrents if t['state'] in RUNNING),
+            'upload_rate': sum(t.get('upload_rate', 0) for t in torrents if t['state'] in RUNNING),
+            'download_limit': self.limits.download.rate,
+            'upload_limit': self.limits.upload.rate,
+            'uploaded': sum(t.get('uploaded', 0) for t in torrents),
+            'buffered': self.pool.in_use_bytes,
+            'buffer_budget': self.pool.budget,
+            'disk_pending': disk['pending_bytes'],
+            'listen_port': self.announce_port if self.listen_sock else None,
+            'dht_nodes': len(self.dht.table) if self.dht else None,
+        }
+
+    def print_status(self):
+        stats = self.stats()
+        states = stats['states']
+        status_line = (f"Session: {stats['torrents']} torrents ({states.get('downloading', 0)} downloading, "
+                       f"{states.get('seeding', 0)} seeding, {states.get('paused', 0)} paused, "
+                       f"{states.get('finished', 0)} finished) | "
+                       f"Peers: {stats['peers']}/{self.max_peers} | "
+                       f"Down: {stats['download_rate'] / 1024:.0f} KiB/s (limit {format_rate(self.limits.download.rate)}) | "
+                       f"Up: {stats['upload_rate'] / 1024:.0f} KiB/s (limit {format_rate(self.limits.upload.rate)}), "
+                       f"{stats['uploaded'] / 1024 / 1024:.2f} MB | "
+                       f"Buffers: {stats['buffered'] / 1024 / 1024:.0f}/{stats['buffer_budget'] / 1024 / 1024:.0f} MB | "
+                       f"Disk pending: {stats['disk_pending'] / 1024 / 1024:.0f} MB   ")
+        with self.print_lock:
+            print(status_line, end='\r')
+
+    def start_control(self):
+        """Serves the JSON control API on localhost from background threads."""
+        session = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.route('GET')
+
+            def do_POST(self):
+                self.route('POST')
+
+            def do_DELETE(self):
+                self.route('DELETE')
+
+            def route(self, method):
+                parts = [p for p in urlparse(self.path).path.split('/') if p]
+                token = self.headers.get(TOKEN_HEADER, '').encode('utf-8', 'replace')
+                if not hmac.compare_digest(token, session.control_token.encode('utf-8')):
+                    self.reply(401, {'error': f"missing or wrong {TOKEN_HEADER} header"})
+                    return
+                try:
+                    if int(self.headers.get('Content-Length') or 0) and \
+                            self.headers.get_content_type() != 'application/json':
+                        self.reply(415, {'error': "the body must be sent as Content-Type: application/json"})
+                    elif method == 'GET' and parts == ['session']:
+                        self.reply(200, session.stats())
+                    elif method == 'POST' and parts == ['session', 'limits']:
+                        session.set_limits(**self.limits())
+                        self.reply(200, session.stats())
+                    elif method == 'GET' and parts == ['torrents']:
+                        self.reply(200, session.list())
+                    elif method == 'POST' and parts == ['torrents']:
+                        path = self.body().get('path')
+                        if not path:
+                            raise ValueError("expected {\"path\": \"file.torrent\"}")
+                        self.reply(201, session.describe(session.get(session.add(path))))
+                    elif len(parts) == 2 and parts[0] == 'torrents' and method in ('GET', 'DELETE'):
+                        t = session.get(parts[1])
+                        if method == 'DELETE':
+                            session.remove(parts[1])
+                        self.reply(200, session.describe(t))
+                    elif len(parts) == 3 and parts[0] == 'torrents' and method == 'POST' and parts[2] == 'limits':
+                        session.set_limits(torrent_id=parts[1], **self.limits())
+                        self.reply(200, session.describe(session.get(parts[1])))
+                    elif len(parts) == 3 and parts[0] == 'torrents' and method == 'POST' and parts[2] in ('pause', 'resume'):
+                        getattr(session, parts[2])(parts[1])
+                        self.reply(200, session.describe(session.get(parts[1])))
+                    else:
+                        self.reply(404, {'error': 'no such endpoint'})
+                except KeyError as e:
+                    self.reply(404, {'error': f"no torrent {e}"})
+                except Exception as e:
+                    self.reply(400, {'error': str(e)})
+
+            def body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def limits(self):
+                """{"download": KiB/s, "upload": KiB/s} from the body, as bytes/s keyword arguments."""
+                body = self.body()
+                return {direction: int(float(body[direction]) * 1024) for direction in ('download', 'upload')
+                        if body.get(direction) is not None}
+
+            def reply(self, code, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.control_server = ThreadingHTTPServer(('127.0.0.1', self.control_port), Handler)
+        self.control_server.daemon_threads = True
+        token_path = self.save_token()
+        threading.Thread(target=self.control_server.serve_forever, daemon=True).start()
+        with self.print_lock:
+            print(f"Control API on http://127.0.0.1:{self.control_server.server_address[1]}/torrents "
+                  f"(send the token in {token_path} as {TOKEN_HEADER})")
+
+    def save_token(self):
+        """Writes the control token where only this user can read it. Returns the path."""
+        os.makedirs(self.download_dir, exist_ok=True)
+        path = os.path.join(self.download_dir, TOKEN_FILE)
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.control_token)
+        os.replace(tmp_path, path)
+        return path
+
+    def stop(self):
+        """Stops every torrent, saving resume data, and shuts the session down."""
+        if not self.is_running:
+            return
+        self.is_running = False
+        if self.control_server:
+            self.control_server.shutdown()
+            self.control_server.server_close()
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        if self.thread:
+            self.thread.join()
+        self.disk.stop()
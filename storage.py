@@ -0,0 +1,182 @@
+import bisect
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+class Storage:
+    """Maps torrent byte ranges onto the files on disk and does positional I/O.
+
+    File start offsets come from the torrent's FileTable so a range is located with a bisect
+    instead of a scan over every file. Open descriptors are kept in an LRU cache of at most
+    `max_open_files` and data is written with os.pwrite, so no seek or open/close per piece.
+    """
+    def __init__(self, torrent, download_dir, max_open_files=64):
+        files = torrent.files
+        self.paths = [os.path.join(download_dir, path) for path in files.paths]
+        self.lengths = files.lengths
+        self.offsets = files.offsets  # start of each file in the torrent's byte stream, then the total size
+        self.total_size = files.total_size
+        self.max_open_files = max_open_files
+        self.fds = OrderedDict()  # file index -> [fd, users]
+        self.fd_lock = threading.Lock()
+
+    def allocate(self):
+        """Creates missing files at their full (sparse) length."""
+        for path, length in zip(self.paths, self.lengths):
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.truncate(length)
+
+    def spans(self, offset, length):
+        """Yields (file_index, file_offset, data_offset, span_length) covering [offset, offset+length)."""
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        data_offset = 0
+        while length > 0 and index < len(self.lengths):
+            file_offset = offset - self.offsets[index]
+            span = min(length, self.lengths[index] - file_offset)
+            if span > 0:
+                yield index, file_offset, data_offset, span
+                offset += span
+                data_offset += span
+                length -= span
+            index += 1
+
+    def write(self, offset, data):
+        """Writes `data` at byte `offset` of the torrent."""
+        view = memoryview(data)
+        for index, file_offset, data_offset, span in self.spans(offset, len(view)):
+            fd = self._acquire(index)
+            try:
+                chunk = view[data_offset:data_offset + span]
+                while chunk:
+                    written = os.pwrite(fd, chunk, file_offset)
+                    chunk = chunk[written:]
+                    file_offset += written
+            finally:
+                self._release(index)
+
+    def read(self, offset, length):
+        """Reads `length` bytes at byte `offset` of the torrent."""
+        out = bytearray(length)
+        view = memoryview(out)
+        for index, file_offset, data_offset, span in self.spans(offset, length):
+            fd = self._acquire(index)
+            try:
+                while span:
+                    n = os.preadv(fd, [view[data_offset:data_offset + span]], file_offset)
+                    if n == 0:
+                        break  # short file; the rest stays zero
+                    data_offset += n
+                    file_offset += n
+                    span -= n
+            finally:
+                self._release(index)
+        return out
+
+    def close(self):
+        with self.fd_lock:
+            for fd, _ in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+
+    def _acquire(self, index):
+        with self.fd_lock:
+            entry = self.fds.get(index)
+            if entry is None:
+                entry = self.fds[index] = [os.open(self.paths[index], os.O_RDWR | getattr(os, 'O_BINARY', 0)), 1]
+                self._evict()  # after counting our use, so the new descriptor is never the one closed
+            else:
+                self.fds.move_to_end(index)
+                entry[1] += 1
+            return entry[0]
+
+    def _release(self, index):
+        with self.fd_lock:
+            self.fds[index][1] -= 1
+
+    def _evict(self):
+        # Close least recently used descriptors that no thread is using right now.
+        excess = len(self.fds) - self.max_open_files
+        if excess <= 0:
+            return
+        for index in [i for i, (_, users) in self.fds.items() if users == 0][:excess]:
+            os.close(self.fds.pop(index)[0])
+
+class MmapStorage(Storage):
+    """Single-file storage that writes and reads through one memory map of the whole file."""
+    def __init__(self, torrent, download_dir, max_open_files=1):
+        super().__init__(torrent, download_dir, max_open_files)
+        if len(self.paths) != 1:
+            raise ValueError("mmap storage only supports single-file torrents")
+        self.map = None
+        self.map_lock = threading.Lock()
+
+    def _mapped(self):
+        with self.map_lock:
+            if self.map is None:
+                with open(self.paths[0], 'r+b') as f:
+                    self.map = mmap.mmap(f.fileno(), self.total_size)
+            return self.map
+
+    def write(self, offset, data):
+        self._mapped()[offset:offset + len(data)] = data
+
+    def read(self, offset, length):
+        return bytearray(self._mapped()[offset:offset + length])
+
+    def close(self):
+        with self.map_lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.map = None
+
+class ReadCache:
+    """Recently uploaded pieces kept in memory, least recently used dropped first.
+
+    Peers request a piece block by block, so the whole piece is read once and every later
+    block is served from memory. Holds at most `capacity` bytes.
+    """
+    def __init__(self, storage, piece_length, capacity=32 * 1024 * 1024):
+        self.storage = storage
+        self.piece_length = piece_length
+        self.capacity = capacity
+        self.pieces = OrderedDict()  # piece index -> bytes
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, index):
+        return index in self.pieces
+
+    def load(self, index):
+        """Reads a piece from disk into the cache and returns it."""
+        offset = index * self.piece_length
+        data = bytes(self.storage.read(offset, min(self.piece_length, self.storage.total_size - offset)))
+        with self.lock:
+            if index not in self.pieces:
+                self.pieces[index] = data
+                self.size += len(data)
+                while self.size > self.capacity and len(self.pieces) > 1:
+                    self.size -= len(self.pieces.popitem(last=False)[1])
+        return data
+
+    def read(self, index, offset, length):
+        with self.lock:
+            data = self.pieces.get(index)
+            if data is not None:
+                self.pieces.move_to_end(index)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if data is None:
+            data = self.load(index)
+        return memoryview(data)[offset:offset + length]
+
+def open_storage(torrent, download_dir, backend='pwrite', max_open_files=64):
+    if backend == 'mmap':
+        return MmapStorage(torrent, download_dir)
+    return Storage(torrent, download_dir, max_open_files)
@@ -0,0 +1,109 @@
+"""Reading a torrent's files while they download.
+
+    d = Downloader('big.torrent', 'downloads', strategy='sequential')
+    d.start()
+    with d.open_file(0) as f:
+        for line in io.BufferedReader(f):
+            ...
+
+A read blocks until the pieces under it are verified, then reads them from disk. The pieces
+from the read position to `readahead` bytes past it get deadlines, so the picker fetches
+them before anything else and idle peers help finish the ones that run late.
+"""
+import io
+import time
+
+READAHEAD = 8 * 1024 * 1024
+DEADLINE_STEP = 0.5  # seconds added to the deadline for each piece further from the read position
+
+class TorrentFile(io.RawIOBase):
+    """A read-only, seekable raw file over one file of a running Downloader.
+
+    read() may return fewer bytes than asked for: as many as are verified from the position
+    on, once at least the first piece is. Wrap it in io.BufferedReader (or TextIOWrapper) for
+    the usual buffered behaviour. `timeout` bounds each wait, None waits until the download stops.
+    """
+    def __init__(self, downloader, index, readahead=READAHEAD, timeout=None):
+        super().__init__()
+        files = downloader.torrent.files
+        self.downloader = downloader
+        self.index = index
+        self.name = files.paths[index]
+        self.size = files.lengths[index]
+        self.start = files.offsets[index]  # where the file begins in the torrent's byte stream
+        self.piece_length = downloader.torrent.piece_length
+        self.readahead = readahead
+        self.timeout = timeout
+        self.position = 0
+        self.window = set()  # pieces we have set deadlines for
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"negative seek position {position}")
+        self.position = position
+        return position
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        offset = self.start + self.position
+        first, last = offset // self.piece_length, (offset + length - 1) // self.piece_length
+        self.request(first)
+        self.wait(first)
+        pm = self.downloader.piece_manager
+        end = first + 1
+        while end <= last and pm.has(end):
+            end += 1
+        length = min(length, end * self.piece_length - offset)
+        buffer[:length] = pm.storage.read(offset, length)
+        self.position += length
+        return length
+
+    def request(self, first):
+        """Sets deadlines on the pieces from `first` to the end of the readahead window."""
+        end = self.start + min(self.position + max(self.readahead, 1), self.size)
+        last = max((end - 1) // self.piece_length, first)
+        pm = self.downloader.piece_manager
+        now = time.monotonic()
+        window = {i for i in range(first, last + 1) if not pm.has(i)}
+        deadlines = {i: now + (i - first + 1) * DEADLINE_STEP for i in window - self.window}
+        self.downloader.set_deadlines(deadlines, self.window - window)
+        self.window = window
+
+    def wait(self, piece_index):
+        pm = self.downloader.piece_manager
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with pm.verified:
+            while not pm.has(piece_index):
+                if not self.downloader.is_running:
+                    raise OSError(f"{self.name}: the download stopped before piece {piece_index} was verified")
+                remaining = 1.0 if deadline is None else deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"{self.name}: piece {piece_index} not verified after {self.timeout}s")
+                pm.verified.wait(min(remaining, 1.0))
+
+    def close(self):
+        if not self.closed and self.window:
+            self.downloader.set_deadlines({}, self.window)
+            self.window = set()
+        super().close()
@@ -0,0 +1,29 @@
+import os
+import sys
+import time
+
+import pytest
+
+# The client is a set of top-level modules; make them importable from the tests.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class Clock:
+    """Stands in for the time module of the modules it is installed in; the tests move `now` by hand."""
+    def __init__(self, monkeypatch, now=1000.0):
+        self.monkeypatch = monkeypatch
+        self.now = now
+
+    def install(self, *modules):
+        for module in modules:
+            self.monkeypatch.setattr(module, 'time', self)
+        return self
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+@pytest.fixture
+def clock(monkeypatch):
+    return Clock(monkeypatch)
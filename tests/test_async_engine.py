@@ -0,0 +1,61 @@
+import asyncio
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+from async_engine import AsyncEngine, AsyncPeer
+from benchmarks.swarm import Swarm, run_download
+
+@pytest.fixture(scope='module')
+def swarm():
+    swarm = Swarm(size=4 * 2**20, piece_length=64 * 1024, seeders=16).start()
+    yield swarm
+    swarm.close()
+
+def test_a_download_completes_on_one_event_loop(swarm):
+    result = run_download(swarm, engine='asyncio', timeout=60)
+    assert result['complete'] and result['connected'] > 1
+    assert result['locks'].get('data') is None  # nothing to lock: the pieces are only touched on the loop
+    # Peers are tasks, not threads: the thread count doesn't grow with them.
+    assert result['threads'] < run_download(swarm, engine='threads', timeout=60)['threads']
+
+def test_a_download_completes_despite_corrupt_seeders():
+    swarm = Swarm(size=2 * 2**20, piece_length=64 * 1024, seeders=6, corrupt=3).start()
+    try:
+        assert run_download(swarm, engine='asyncio', timeout=60)['complete']
+    finally:
+        swarm.close()
+
+def feed(*messages):
+    reader = asyncio.StreamReader()
+    for message in messages:
+        reader.feed_data(message)
+    reader.feed_eof()
+    return reader
+
+def test_messages_are_read_from_the_stream():
+    torrent = SimpleNamespace(num_pieces=16)
+    peer = AsyncPeer('127.0.0.2', 1, torrent, bytes(20))
+
+    async def read():
+        peer.reader = feed(struct.pack('!I', 0), struct.pack('!IBI', 5, 4, 3), struct.pack('!IB', 1, 1))
+        return [await peer.receive_message() for _ in range(3)]
+
+    assert asyncio.run(read()) == [None, ('have', 3), None]  # an unchoke only changes the peer's state
+    assert not peer.peer_choking
+
+def test_an_oversized_message_is_refused_before_it_is_read():
+    peer = AsyncPeer('127.0.0.2', 1, SimpleNamespace(num_pieces=16), bytes(20))
+
+    async def read():
+        peer.reader = feed(struct.pack('!I', peer.max_message + 1))
+        await peer.receive_message()
+
+    with pytest.raises(ValueError):
+        asyncio.run(read())
+
+def test_stopping_an_engine_that_never_ran_leaves_the_closing_to_the_caller():
+    engine = AsyncEngine(SimpleNamespace())
+    assert not engine.stop()
+    assert not engine.on_loop_thread()
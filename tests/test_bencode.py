@@ -0,0 +1,63 @@
+import hashlib
+
+import bencodepy
+import pytest
+
+from Torrent import MAX_DEPTH, Torrent, decode, skip
+
+def test_decodes_nested_values():
+    data = bencodepy.encode({b'a': [1, -2, b'xyz'], b'b': {b'c': b''}})
+    value, end = decode(data, 0)
+    assert value == {b'a': [1, -2, b'xyz'], b'b': {b'c': b''}}
+    assert end == len(data) == skip(data, 0)
+
+@pytest.mark.parametrize('data', [
+    b'd1:x1:y-6:',  # negative length would move the cursor backwards
+    b'-1:',
+    b'd1:x1:y+1:a',
+    b' 1:a',
+    b':',
+    b'5:ab',  # runs past the end
+    b'i1x2e',
+    b'ie',
+    b'i 1e',
+    b'i-e',
+    b'd i1ei2ee',
+])
+def test_malformed_input_raises_value_or_index_error(data):
+    with pytest.raises((ValueError, IndexError)):
+        decode(data, 0)
+    with pytest.raises((ValueError, IndexError)):
+        skip(data, 0)
+
+def test_dictionary_keys_must_be_strings():
+    with pytest.raises(ValueError):
+        decode(b'di1ei2ee', 0)
+
+@pytest.mark.parametrize('data', [b'l', b'd', b'li1e', b'd1:a', b'i12', b'3:'])
+def test_truncated_input_raises(data):
+    with pytest.raises((ValueError, IndexError)):
+        decode(data, 0)
+
+def test_deep_nesting_is_refused_not_recursed():
+    data = b'l' * (MAX_DEPTH + 2) + b'e' * (MAX_DEPTH + 2)
+    with pytest.raises(ValueError):
+        decode(data, 0)
+    with pytest.raises(ValueError):
+        skip(data, 0)
+    ok = b'l' * MAX_DEPTH + b'e' * MAX_DEPTH
+    assert decode(ok, 0)[1] == len(ok)
+
+def test_torrent_rejects_negative_file_length(tmp_path):
+    info = {b'name': b'x', b'piece length': 16, b'pieces': hashlib.sha1(b'').digest(),
+            b'files': [{b'length': -5, b'path': [b'a']}]}
+    path = tmp_path / 'bad.torrent'
+    path.write_bytes(bencodepy.encode({b'info': info}))
+    with pytest.raises(ValueError):
+        Torrent(str(path))
+
+def test_torrent_rejects_negative_path_length(tmp_path):
+    path = tmp_path / 'bad.torrent'
+    path.write_bytes(b'd4:infod5:filesld6:lengthi1e4:pathl-3:abceeee4:name1:xee')
+    with pytest.raises(ValueError):
+        Torrent(str(path))
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import choker
+from choker import Choker
+
+class FakePeer:
+    def __init__(self, name):
+        self.name = name
+        self.pipeline = SimpleNamespace(received_bytes=0)
+        self.uploaded_bytes = 0
+        self.peer_interested = True
+        self.is_choking = True
+        self.connected_at = None
+
+    def is_connected(self):
+        return True
+
+    def __repr__(self):
+        return self.name
+
+def rechoke(c, peers, clock, seeding=False):
+    clock[0] += c.round_interval
+    unchoke, choke = c.rechoke(peers, seeding)
+    for p in unchoke:
+        p.is_choking = False
+    for p in choke:
+        p.is_choking = True
+    return {p for p in peers if not p.is_choking}
+
+def test_peers_are_ranked_by_what_they_sent_since_the_last_round(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(choker.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(choker.random, 'choices', lambda candidates, weights: [candidates[0]])
+    c = Choker(upload_slots=3, optimistic_rounds=1000)
+    fast, steady, slow, idle = peers = [FakePeer(n) for n in ('fast', 'steady', 'slow', 'idle')]
+    fast.pipeline.received_bytes = 100 << 20
+    steady.pipeline.received_bytes = 10 << 20
+    slow.pipeline.received_bytes = 1 << 20
+    c.last_round = clock[0]
+    assert {fast, steady} <= rechoke(c, peers, clock)
+
+    # The fast peer goes silent; it loses its slot to the ones still sending.
+    steady.pipeline.received_bytes += 10 << 20
+    slow.pipeline.received_bytes += 1 << 20
+    unchoked = rechoke(c, peers, clock)
+    assert {steady, slow} <= unchoked
+    assert fast not in unchoked or c.optimistic is fast
+
+def test_seeding_ranks_by_what_peers_took(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(choker.time, 'monotonic', lambda: clock[0])
+    c = Choker(upload_slots=2, optimistic_rounds=1000)
+    a, b = peers = [FakePeer('a'), FakePeer('b')]
+    a.uploaded_bytes, b.uploaded_bytes = 5 << 20, 1 << 20
+    c.last_round = clock[0]
+    rechoke(c, peers, clock, seeding=True)
+    assert not a.is_choking
+    b.uploaded_bytes += 1 << 20
+    rechoke(c, peers, clock, seeding=True)
+    assert not b.is_choking
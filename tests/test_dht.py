@@ -0,0 +1,211 @@
+import contextlib
+import io
+import os
+import socket
+import time
+
+import bencodepy
+import pytest
+
+from benchmarks.dht_cluster import DHTCluster
+from dht import DHT, K, RoutingTable, parse_compact_nodes
+from Tracker import parse_compact_peers
+
+INFO_HASH = bytes(range(20))
+
+@pytest.fixture
+def node():
+    with contextlib.redirect_stdout(io.StringIO()):
+        node = DHT(port=0, host='127.0.0.1', bootstrap=[], query_timeout=0.5).start()
+    yield node
+    node.stop()
+
+@pytest.fixture
+def client():
+    """Raw UDP sockets on 127.0.0.x addresses, to talk KRPC to the node by hand."""
+    socks = []
+
+    def bind(host='127.0.0.2'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, 0))
+        sock.settimeout(2)
+        socks.append(sock)
+        return sock
+
+    yield bind
+    for sock in socks:
+        sock.close()
+
+def query(sock, node, method, transaction=b'aa', node_id=None, **args):
+    """Sends a query and returns the reply with the same transaction id."""
+    args = {key.encode(): value for key, value in args.items()}
+    args[b'id'] = node_id or os.urandom(20)
+    sock.sendto(bencodepy.encode({b't': transaction, b'y': b'q', b'q': method, b'a': args}), ('127.0.0.1', node.port))
+    while True:
+        reply = bencodepy.decode(sock.recvfrom(65536)[0])
+        if reply[b't'] == transaction:
+            return reply
+
+def test_ping(node, client):
+    reply = query(client(), node, b'ping')
+    assert reply[b'y'] == b'r' and reply[b'r'][b'id'] == node.node_id
+
+def test_announce_peer_with_a_token_from_get_peers(node, client):
+    sock = client('127.0.0.2')
+    reply = query(sock, node, b'get_peers', info_hash=INFO_HASH)
+    assert reply[b'y'] == b'r' and b'values' not in reply[b'r']
+    token = reply[b'r'][b'token']
+    reply = query(sock, node, b'announce_peer', info_hash=INFO_HASH, port=6881, token=token)
+    assert reply[b'y'] == b'r'
+    reply = query(sock, node, b'announce_peer', info_hash=INFO_HASH, port=1, implied_port=1, token=token)
+    assert reply[b'y'] == b'r'
+    reply = query(client('127.0.0.3'), node, b'get_peers', info_hash=INFO_HASH)
+    peers = {peer for value in reply[b'r'][b'values'] for peer in parse_compact_peers(value)}
+    assert peers == {('127.0.0.2', 6881), ('127.0.0.2', sock.getsockname()[1])}
+
+def test_announce_peer_with_a_bad_token_is_refused(node, client):
+    token = query(client('127.0.0.2'), node, b'get_peers', info_hash=INFO_HASH)[b'r'][b'token']
+    other = client('127.0.0.3')
+    # Tokens are bound to the IP they were given to.
+    for bad in (token, b'', b'x' * 8):
+        reply = query(other, node, b'announce_peer', info_hash=INFO_HASH, port=6881, token=bad)
+        assert reply[b'y'] == b'e' and reply[b'e'][0] == 203
+    assert node.stats()['stored_peers'] == 0
+
+def test_tokens_survive_one_secret_rotation(node, client):
+    sock = client()
+    token = query(sock, node, b'get_peers', info_hash=INFO_HASH)[b'r'][b'token']
+    with node.lock:
+        node.secrets = [os.urandom(8), node.secrets[0]]
+    assert query(sock, node, b'announce_peer', info_hash=INFO_HASH, port=6881, token=token)[b'y'] == b'r'
+    with node.lock:
+        node.secrets = [os.urandom(8), node.secrets[0]]
+    assert query(sock, node, b'announce_peer', info_hash=INFO_HASH, port=6881, token=token)[b'y'] == b'e'
+
+@pytest.mark.parametrize('args', [
+    {'info_hash': b'short', 'port': 6881},
+    {'info_hash': INFO_HASH, 'port': 0},
+    {'info_hash': INFO_HASH, 'port': 70000},
+    {'info_hash': INFO_HASH, 'port': b'6881'},
+    {'info_hash': INFO_HASH},
+])
+def test_announce_peer_with_bad_arguments_is_refused(node, client, args):
+    sock = client()
+    token = query(sock, node, b'get_peers', info_hash=INFO_HASH)[b'r'][b'token']
+    reply = query(sock, node, b'announce_peer', token=token, **args)
+    assert reply[b'y'] == b'e' and reply[b'e'][0] == 203
+    assert node.stats()['stored_peers'] == 0
+
+def test_unknown_method(node, client):
+    reply = query(client(), node, b'vote')
+    assert reply[b'y'] == b'e' and reply[b'e'][0] == 204
+
+@pytest.mark.parametrize('packet', [
+    b'd1:tde1:y1:re',  # unhashable transaction id
+    b'd1:tli1ee1:y1:qe',
+    b'd1:t2:aa1:yi1ee',
+    b'd1:t2:aa1:y1:r',  # cut short
+    b'd1:x1:y-6:',
+    b'li1ee',
+    b'i1e',
+    b'',
+    b'\xff' * 100,
+])
+def test_malformed_packets_are_dropped(node, client, packet):
+    sock = client()
+    sock.sendto(packet, ('127.0.0.1', node.port))
+    # The node carries on: the next query is answered.
+    assert query(sock, node, b'ping', transaction=b'zz')[b'y'] == b'r'
+    assert node.stats()['dropped_packets'] == 1
+
+@pytest.mark.parametrize('method, a', [
+    (b'ping', [1]),
+    (b'ping', {b'id': b'short'}),
+    (b'ping', {b'id': 5}),
+    (b'find_node', {b'id': os.urandom(20), b'target': b'short'}),
+    (b'get_peers', {b'id': os.urandom(20), b'info_hash': [INFO_HASH]}),
+    (b'get_peers', {b'id': os.urandom(20)}),
+    (None, {b'id': os.urandom(20)}),
+])
+def test_malformed_queries_get_a_protocol_error(node, client, method, a):
+    sock = client()
+    message = {b't': b'bb', b'y': b'q', b'a': a}
+    if method is not None:
+        message[b'q'] = method
+    sock.sendto(bencodepy.encode(message), ('127.0.0.1', node.port))
+    reply = bencodepy.decode(sock.recvfrom(65536)[0])
+    assert reply[b't'] == b'bb' and reply[b'y'] == b'e' and reply[b'e'][0] == 203
+
+def test_a_reply_nobody_asked_for_is_ignored(node, client):
+    sock = client()
+    sock.sendto(bencodepy.encode({b't': b'zz', b'y': b'r', b'r': {b'id': os.urandom(20)}}), ('127.0.0.1', node.port))
+    sock.sendto(b'd1:t2:zz1:y1:r1:rli1eee', ('127.0.0.1', node.port))
+    assert query(sock, node, b'ping')[b'y'] == b'r'
+    assert len(node.table) == 1  # only the pinging node
+
+def id_in_bucket(own_id, bit, rng=os.urandom):
+    """A random id whose highest bit differing from `own_id` is `bit` (0 = least significant)."""
+    value = int.from_bytes(own_id, 'big') ^ (1 << bit) ^ (int.from_bytes(rng(20), 'big') & ((1 << bit) - 1))
+    return value.to_bytes(20, 'big')
+
+def test_a_bucket_holds_at_most_k_nodes():
+    table = RoutingTable(bytes(20))
+    for i in range(K):
+        assert table.add(id_in_bucket(table.own_id, 159), ('10.0.0.%d' % i, 1), 1.0)
+    assert not table.add(id_in_bucket(table.own_id, 159), ('10.0.1.1', 1), 1.0)
+    assert len(table.buckets[159]) == K
+    # Other buckets still have room.
+    assert table.add(id_in_bucket(table.own_id, 10), ('10.0.1.1', 1), 1.0)
+    assert len(table) == K + 1
+
+def test_a_bad_node_makes_room_in_a_full_bucket():
+    table = RoutingTable(bytes(20))
+    addresses = [('10.0.0.%d' % i, 1) for i in range(K)]
+    for address in addresses:
+        table.add(id_in_bucket(table.own_id, 159), address, 1.0)
+    table.failed(addresses[3])
+    assert not table.add(id_in_bucket(table.own_id, 159), ('10.0.1.1', 1), 1.0)  # one miss isn't bad yet
+    table.failed(addresses[3])
+    assert table.add(id_in_bucket(table.own_id, 159), ('10.0.1.1', 1), 1.0)
+    assert addresses[3] not in table.by_address and len(table.buckets[159]) == K
+
+def test_a_node_that_changes_id_is_replaced():
+    table = RoutingTable(bytes(20))
+    table.add(id_in_bucket(table.own_id, 159), ('10.0.0.1', 1), 1.0)
+    new_id = id_in_bucket(table.own_id, 20)
+    assert table.add(new_id, ('10.0.0.1', 1), 2.0)
+    assert len(table) == 1 and table.by_address[('10.0.0.1', 1)].id == new_id
+    assert table.buckets[159] == []
+
+def test_our_own_id_and_bad_ids_are_not_added():
+    table = RoutingTable(bytes(20))
+    assert not table.add(bytes(20), ('10.0.0.1', 1), 1.0)
+    assert not table.add(b'short', ('10.0.0.1', 1), 1.0)
+    assert len(table) == 0
+
+def test_queries_from_many_nodes_fill_a_bucket_only_to_k(node, client):
+    sock = client()
+    for i in range(K + 5):
+        query(sock, node, b'ping', transaction=b'p%d' % i, node_id=id_in_bucket(node.node_id, 159))
+        sock.close()
+        sock = client('127.0.0.%d' % (i + 3))
+    assert len(node.table.buckets[159]) == K
+    reply = query(sock, node, b'find_node', target=id_in_bucket(node.node_id, 159))
+    assert len(parse_compact_nodes(reply[b'r'][b'nodes'])) == K
+
+def test_get_peers_lookup_in_a_local_cluster():
+    cluster = DHTCluster(20, query_timeout=0.5).start(timeout=30)
+    try:
+        peers = [('127.0.0.%d' % i, 6000 + i) for i in range(2, 5)]
+        cluster.announce(INFO_HASH, peers)
+        with contextlib.redirect_stdout(io.StringIO()):
+            node = DHT(port=0, host='127.0.0.1', bootstrap=[cluster.bootstrap], query_timeout=0.5).start()
+        try:
+            deadline = time.monotonic() + 20
+            while node.table.good() < K and time.monotonic() < deadline:
+                time.sleep(0.1)
+            assert set(node.get_peers(INFO_HASH)) == set(peers)
+        finally:
+            node.stop()
+    finally:
+        cluster.close()
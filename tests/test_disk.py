@@ -0,0 +1,46 @@
+import hashlib
+import threading
+
+from disk import DiskPipeline
+
+class FakePiece:
+    def __init__(self, index, data, good=True):
+        self.index = index
+        self.data = data
+        self.length = len(data)
+        self.hash = hashlib.sha1(data if good else b'other').digest()
+
+    def is_hash_correct(self):
+        return hashlib.sha1(self.data).digest() == self.hash
+
+def test_worker_survives_a_failing_notify(capsys):
+    written = []
+    channel = DiskPipeline(hash_workers=1).channel(lambda piece: written.append(piece.index), owned=True)
+    calls = []
+    done = threading.Event()
+
+    def notify():
+        calls.append(1)
+        if len(calls) == 1:
+            raise AttributeError("'NoneType' object has no attribute 'sendall'")
+        if len(calls) == 4:
+            done.set()
+
+    channel.notify = notify
+    for index in range(4):
+        channel.submit(FakePiece(index, bytes([index]) * 100))
+    assert done.wait(5)
+    channel.stop()
+    assert sorted(written) == [0, 1, 2, 3]
+    results = []
+    while not channel.results.empty():
+        results.append(channel.results.get()[0])
+    assert results == ['written'] * 4
+    assert 'Error applying disk results' in capsys.readouterr().out
+
+def test_failed_hash_is_reported():
+    channel = DiskPipeline(hash_workers=1).channel(lambda piece: None, owned=True)
+    channel.submit(FakePiece(0, b'data', good=False))
+    result, piece, _ = channel.results.get(timeout=5)
+    channel.stop()
+    assert (result, piece.index) == ('failed', 0)
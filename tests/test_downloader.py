@@ -0,0 +1,160 @@
+import contextlib
+import io
+import os
+import threading
+import time
+
+import pytest
+
+import Downloader as Downloader_module
+import pipelining
+from benchmarks.synthetic import make_torrent
+from Downloader import Downloader
+from pipelining import BLOCK_SIZE, RequestPipeline
+from ratelimit import RateLimits
+
+@pytest.fixture
+def torrent_path(tmp_path):
+    path, _ = make_torrent(str(tmp_path), 256 * 1024, 16 * 1024)
+    return path
+
+def make_downloader(torrent_path, tmp_path, **options):
+    options.setdefault('listen_port', None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Downloader(torrent_path, str(tmp_path / 'downloads'), **options)
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_stop_closes_the_piece_manager_before_returning(torrent_path, tmp_path, engine):
+    dl = make_downloader(torrent_path, tmp_path, engine=engine)
+    threads = []
+    close = dl.piece_manager.close
+    dl.piece_manager.close = lambda: (threads.append(threading.current_thread()), close())
+    with contextlib.redirect_stdout(io.StringIO()):
+        dl.start()
+        while engine == 'asyncio' and dl.async_engine.stopped is None:
+            time.sleep(0.01)  # let the engine's loop start, or stop() closes on this thread
+        dl.stop()
+    assert dl.closed.is_set() and len(threads) == 1
+    if engine == 'asyncio':
+        assert threads[0] is not threading.current_thread()  # on the engine's loop
+    assert os.path.exists(dl.piece_manager.resume.path)
+
+def test_stop_before_start_closes_once(torrent_path, tmp_path):
+    dl = make_downloader(torrent_path, tmp_path, engine='asyncio')
+    calls = []
+    close = dl.piece_manager.close
+    dl.piece_manager.close = lambda: (calls.append(1), close())
+    dl.stop()
+    assert dl.closed.is_set() and calls == [1]
+
+class FakePeer:
+    def __init__(self, ip, connected_at):
+        self.ip, self.port = ip, 6881
+        self.pipeline = RequestPipeline()
+        self.connected_at = connected_at
+        self.is_choking = True
+        self.closed = False
+
+    def is_connected(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+def receive(peers, clock, rate, seconds):
+    """Each of `peers` delivers blocks at `rate` bytes/s for `seconds`."""
+    interval = BLOCK_SIZE / rate
+    for i in range(int(seconds / interval)):
+        for peer in peers:
+            peer.pipeline.add(i, 0, BLOCK_SIZE)
+        clock.now += interval
+        for peer in peers:
+            peer.pipeline.complete(i, 0, BLOCK_SIZE)
+
+@pytest.fixture
+def swapper(torrent_path, tmp_path, clock):
+    """A Downloader with three fake peers at its peer target and a candidate waiting."""
+    clock.install(Downloader_module, pipelining)
+    dl = make_downloader(torrent_path, tmp_path, target_peers=3, replace_interval=30)
+    dl.connections.add_peers([('10.0.0.9', 6881)])
+    dl.peers = [FakePeer(f'10.0.0.{i}', clock.now) for i in range(1, 4)]
+    dl.last_replace = clock.now
+    return dl
+
+def test_a_peer_that_went_silent_is_replaced(swapper, clock):
+    live, silent = swapper.peers[:2], swapper.peers[2]
+    receive(swapper.peers, clock, 1e6, 20)  # all equally fast...
+    receive(live, clock, 1e6, 15)  # ...until one stops sending
+    with contextlib.redirect_stdout(io.StringIO()):
+        swapper.replace_slowest()
+    assert silent.closed and not any(p.closed for p in live)
+
+def test_peers_about_as_fast_as_the_rest_are_kept(swapper, clock):
+    receive(swapper.peers, clock, 1e6, 35)
+    swapper.replace_slowest()
+    assert not any(p.closed for p in swapper.peers)
+
+def test_peers_are_only_replaced_once_an_interval(swapper, clock):
+    receive(swapper.peers[:2], clock, 1e6, 10)
+    swapper.replace_slowest()  # too soon after the last time
+    assert not any(p.closed for p in swapper.peers)
+
+def test_the_reported_download_rate_falls_to_zero_when_peers_go_idle(torrent_path, tmp_path, clock):
+    clock.install(Downloader_module, pipelining)
+    dl = make_downloader(torrent_path, tmp_path)
+    dl.peers = [FakePeer(f'10.0.0.{i}', clock.now) for i in range(1, 3)]
+    receive(dl.peers, clock, 1e6, 5)
+    assert dl.summary()['download_rate'] == pytest.approx(2e6, rel=0.1)
+    clock.now += 5
+    assert dl.summary()['download_rate'] < 0.1e6
+    clock.now += 30
+    assert dl.summary()['download_rate'] < 1
+
+class EndgamePeer(FakePeer):
+    """A FakePeer that has every piece and records the requests and cancels sent to it."""
+    def __init__(self, ip, num_pieces):
+        super().__init__(ip, 0)
+        self.bitfield = bytearray(b'\xff' * ((num_pieces + 7) // 8))
+        self.limits = RateLimits()
+        self.pending_haves = []
+        self.upload_queue = []
+        self.peer_choking = False
+        self.requests, self.cancels = [], []
+
+    def send_interested(self):
+        pass
+
+    def send_requests(self, blocks):
+        for block in blocks:
+            self.pipeline.add(*block)
+        self.requests.extend(blocks)
+
+    def send_cancels(self, blocks):
+        self.cancels.extend(blocks)
+
+def test_the_first_copy_of_an_endgame_block_cancels_the_others(tmp_path):
+    path, payload = make_torrent(str(tmp_path), 256 * 1024, 16 * 1024)
+    dl = make_downloader(path, tmp_path, endgame_copies=3)
+    last = dl.piece_manager.torrent.num_pieces - 1
+    for index in range(last):
+        dl.piece_manager.mark_piece_complete(index)
+    peers = dl.peers = [EndgamePeer(f'10.0.0.{i}', last + 1) for i in range(1, 4)]
+    active = {peer: [] for peer in peers}
+    for peer in peers:
+        dl.piece_manager.add_peer_bitfield(peer, peer.bitfield)
+    for peer in peers:
+        dl.fill_requests(peer, active[peer])
+    block = (last, 0, 16 * 1024)
+    assert peers[0].requests == [block]
+    assert dl.piece_manager.in_endgame()
+    assert peers[1].requests == peers[2].requests == [block]  # duplicates, up to endgame_copies
+    assert dl.endgame_holders[(last, 0)] == set(peers)
+    with contextlib.redirect_stdout(io.StringIO()):
+        dl.handle_peer_message(peers[1], ('piece', last, 0, payload[last * 16 * 1024:]), active[peers[1]])
+        assert peers[0].cancels == peers[2].cancels == [block] and peers[1].cancels == []
+        assert dl.endgame_holders == {}
+        # The copies that still arrive are counted as waste and cancel nothing more.
+        dl.handle_peer_message(peers[0], ('piece', last, 0, payload[last * 16 * 1024:]), active[peers[0]])
+        assert dl.piece_manager.duplicate_bytes == 16 * 1024
+        assert peers[1].cancels == [] and peers[2].cancels == [block]
+        dl.stop()
@@ -0,0 +1,36 @@
+import struct
+
+import pytest
+
+from framing import MAX_EXTENDED_MESSAGE, MessageBuffer, max_message_length
+from pipelining import BLOCK_SIZE
+
+def feed(buffer, data):
+    buffer.writable()[:len(data)] = data
+    buffer.advance(len(data))
+
+def test_frames_messages():
+    buffer = MessageBuffer(size=1024)
+    feed(buffer, struct.pack('!I', 0) + struct.pack('!IB', 1, 2) + struct.pack('!I', 5))
+    assert bytes(buffer.next_message()) == b''
+    assert bytes(buffer.next_message()) == b'\x02'
+    assert buffer.next_message() is None
+
+def test_oversized_length_is_refused_before_allocating():
+    buffer = MessageBuffer(size=1024)
+    feed(buffer, struct.pack('!I', 2**31))
+    with pytest.raises(ValueError):
+        buffer.next_message()
+    assert len(buffer.buf) == 1024
+
+def test_limit_covers_blocks_bitfields_and_extensions():
+    assert max_message_length() >= BLOCK_SIZE + 13
+    assert max_message_length(10) == max(BLOCK_SIZE + 13, MAX_EXTENDED_MESSAGE)
+    assert max_message_length(8 * 2**20) == 1 + 2**20  # a bitfield for 8M pieces
+
+def test_message_at_the_limit_is_accepted():
+    buffer = MessageBuffer(size=1024, max_length=4096)
+    feed(buffer, struct.pack('!I', 4096))
+    assert buffer.next_message() is None  # waits for the body, with room reserved for it
+    feed(buffer, bytes(4096))
+    assert len(buffer.next_message()) == 4096
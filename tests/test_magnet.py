@@ -0,0 +1,155 @@
+import asyncio
+import threading
+
+import pytest
+
+from benchmarks.seeder import Seeder
+from benchmarks.synthetic import info_hash, make_torrent
+from magnet import (DATA, MAX_METADATA_SIZE, METADATA_BLOCK, REJECT, REQUEST, Magnet, MetadataFetcher,
+                    metadata_message, parse_metadata_message)
+from Torrent import Torrent
+
+@pytest.fixture(scope='module')
+def torrent(tmp_path_factory):
+    # 1000 pieces of 1 KiB: 20000 bytes of piece hashes, so the info dictionary spans two metadata pieces.
+    path, payload = make_torrent(str(tmp_path_factory.mktemp('magnet')), 1000 * 1024, piece_length=1024)
+    torrent = Torrent(path)
+    assert torrent.info_hash == info_hash(path)
+    torrent.payload = payload
+    return torrent
+
+@pytest.fixture
+def seeders(torrent):
+    """Starts Seeders with a behavior each on 127.0.0.x ports, serving the torrent's metadata."""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    servers = []
+
+    def start(*behaviors):
+        addresses = []
+        for i, behavior in enumerate(behaviors):
+            seeder = Seeder(torrent.payload, torrent.info_hash, torrent.piece_length, behavior=behavior,
+                            metadata=bytes(torrent.info_bytes))
+            host = f'127.0.0.{i + 2}'
+            server = asyncio.run_coroutine_threadsafe(seeder.serve(host), loop).result(5)
+            servers.append(server)
+            addresses.append((host, server.sockets[0].getsockname()[1]))
+        return addresses
+
+    async def shutdown():
+        for server in servers:
+            server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    yield start
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+def make_fetcher(torrent, addresses=(), **options):
+    uri = f'magnet:?xt=urn:btih:{torrent.info_hash.hex()}' + ''.join(f'&x.pe={ip}:{port}' for ip, port in addresses)
+    return MetadataFetcher(Magnet(uri), port=0, **options)
+
+def blocks(torrent):
+    data = bytes(torrent.info_bytes)
+    return [data[i:i + METADATA_BLOCK] for i in range(0, len(data), METADATA_BLOCK)]
+
+def test_fetched_metadata_matches_the_info_hash(torrent, seeders):
+    fetcher = make_fetcher(torrent, seeders(None, None))
+    fetched = fetcher.fetch(timeout=20)
+    assert fetched.info_hash == torrent.info_hash
+    assert bytes(fetched.info_bytes) == bytes(torrent.info_bytes)
+    assert fetched.pieces == torrent.pieces
+
+def test_pieces_are_assembled_from_several_peers(torrent):
+    fetcher = make_fetcher(torrent)
+    size = len(torrent.info_bytes)
+    first, second = blocks(torrent)
+    assert fetcher.next_piece(('a', 1), size) == 0
+    assert fetcher.next_piece(('b', 1), size) == 1
+    assert fetcher.next_piece(('c', 1), size) is None  # both pieces are asked for
+    fetcher.piece_received(('b', 1), 1, second)
+    assert fetcher.info_bytes is None
+    fetcher.piece_received(('a', 1), 0, first)
+    assert fetcher.done.is_set()
+    assert Torrent.from_metadata(fetcher.info_bytes).info_hash == torrent.info_hash
+
+def test_metadata_with_a_bad_hash_is_rejected(torrent):
+    fetcher = make_fetcher(torrent)
+    size = len(torrent.info_bytes)
+    liar, honest = ('127.0.0.2', 1), ('127.0.0.3', 1)
+    fetcher.connections.add_peers([liar, honest])
+    first, second = blocks(torrent)
+    fetcher.next_piece(liar, size)
+    fetcher.next_piece(honest, size)
+    fetcher.piece_received(liar, 0, bytes([first[0] ^ 0xff]) + first[1:])
+    fetcher.piece_received(honest, 1, second)
+    assert fetcher.info_bytes is None and not fetcher.done.is_set()
+    assert fetcher.blocks == {} and fetcher.metadata_size is None
+    assert fetcher.single_source
+    assert all(record.trust < 0 for record in fetcher.connections.known.values())
+    # From now on one peer gives the whole dictionary, so a bad copy has a single contributor.
+    assert fetcher.next_piece(liar, size) == 0
+    assert fetcher.next_piece(honest, size) is None
+    fetcher.piece_received(liar, 0, bytes([first[0] ^ 0xff]) + first[1:])
+    assert fetcher.next_piece(liar, size) == 1
+    fetcher.piece_received(liar, 1, second)
+    assert fetcher.is_banned(liar) and not fetcher.is_banned(honest)
+    fetcher.release(liar)
+    assert fetcher.next_piece(honest, size) == 0
+
+def test_the_metadata_is_fetched_despite_a_corrupt_seeder(torrent, seeders):
+    corrupt, good = seeders('corrupt', None)
+    fetcher = make_fetcher(torrent, [corrupt, good])
+    fetched = fetcher.fetch(timeout=20)
+    assert fetched.info_hash == torrent.info_hash
+    assert set(fetcher.contributors.values()) == {good}
+
+def test_reject_messages_are_parsed():
+    assert parse_metadata_message(metadata_message(REJECT, 3)) == (REJECT, 3, b'')
+    assert parse_metadata_message(metadata_message(REQUEST, 0)) == (REQUEST, 0, b'')
+    assert parse_metadata_message(metadata_message(DATA, 1, b'xyz', total_size=3)) == (DATA, 1, b'xyz')
+
+def test_a_rejecting_peer_is_dropped_and_its_piece_asked_of_another(torrent, seeders):
+    (address,) = seeders('reject')
+    fetcher = make_fetcher(torrent, request_timeout=5)
+    thread = threading.Thread(target=fetcher.fetch_from, args=address, daemon=True)
+    thread.start()
+    thread.join(3)  # well before request_timeout: the rejection ends the connection
+    assert not thread.is_alive()
+    assert fetcher.blocks == {} and fetcher.requested == {}
+    assert fetcher.next_piece(('127.0.0.9', 1), len(torrent.info_bytes)) == 0
+
+def test_a_fetch_finishes_despite_a_rejecting_peer(torrent, seeders):
+    fetcher = make_fetcher(torrent, seeders('reject', None), request_timeout=5)
+    assert fetcher.fetch(timeout=20).info_hash == torrent.info_hash
+
+@pytest.mark.parametrize('size', [0, -1, MAX_METADATA_SIZE + 1])
+def test_an_impossible_total_size_is_refused(torrent, size):
+    fetcher = make_fetcher(torrent)
+    assert fetcher.next_piece(('a', 1), size) is None
+    assert fetcher.metadata_size is None
+    assert fetcher.next_piece(('b', 1), len(torrent.info_bytes)) == 0
+
+def test_a_total_size_that_disagrees_is_refused(torrent):
+    fetcher = make_fetcher(torrent)
+    size = len(torrent.info_bytes)
+    assert fetcher.next_piece(('a', 1), size) == 0
+    assert fetcher.next_piece(('b', 1), size + 1) is None
+    assert fetcher.next_piece(('b', 1), size - METADATA_BLOCK) is None
+    assert fetcher.metadata_size == size
+
+def test_a_piece_of_the_wrong_length_is_ignored(torrent):
+    fetcher = make_fetcher(torrent)
+    size = len(torrent.info_bytes)
+    first, second = blocks(torrent)
+    fetcher.next_piece(('a', 1), size)
+    fetcher.piece_received(('a', 1), 0, first[:-1])
+    fetcher.piece_received(('a', 1), 1, second + b'x')
+    fetcher.piece_received(('a', 1), 2, second)  # past the end
+    assert fetcher.blocks == {}
@@ -0,0 +1,106 @@
+import contextlib
+import io
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import EventLog, Metrics, TimedLock, format_labels, read_events, summarize
+
+def lines(metrics, prefix):
+    return [line for line in metrics.render().splitlines() if line.startswith(prefix)]
+
+def test_counters_are_rendered_per_label_set():
+    metrics = Metrics()
+    metrics.inc('bt_connects_total', result='ok')
+    metrics.inc('bt_connects_total', 2, result='ok')
+    metrics.inc('bt_connects_total', result='failed')
+    assert lines(metrics, 'bt_connects_total') == ['bt_connects_total{result="failed"} 1',
+                                                   'bt_connects_total{result="ok"} 3']
+    assert '# TYPE bt_connects_total counter' in metrics.render()
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics()
+    for value in (0.0005, 0.003, 0.003, 20.0):
+        metrics.observe('bt_request_rtt_seconds', value)
+    rendered = metrics.render().splitlines()
+    assert 'bt_request_rtt_seconds_bucket{le="0.001"} 1' in rendered
+    assert 'bt_request_rtt_seconds_bucket{le="0.005"} 3' in rendered
+    assert 'bt_request_rtt_seconds_bucket{le="10.0"} 3' in rendered
+    assert 'bt_request_rtt_seconds_bucket{le="+Inf"} 4' in rendered
+    assert 'bt_request_rtt_seconds_count 4' in rendered
+
+def test_collectors_report_gauges_until_removed():
+    metrics = Metrics()
+    collector = lambda: [('bt_peers', {'torrent': 'a'}, 7)]
+    metrics.add_collector(collector)
+    assert lines(metrics, 'bt_peers{') == ['bt_peers{torrent="a"} 7']
+    metrics.remove_collector(collector)
+    metrics.remove_collector(collector)  # twice is fine
+    assert lines(metrics, 'bt_peers{') == []
+
+def test_label_values_are_escaped():
+    assert format_labels((('peer', 'a"b\\c\nd'),)) == '{peer="a\\"b\\\\c\\nd"}'
+    assert format_labels(()) == ''
+
+def test_events_are_logged_counted_and_replayed(tmp_path):
+    path = str(tmp_path / 'events.jsonl')
+    log = EventLog(path)
+    metrics = Metrics(event_log=log)
+    metrics.record('announce', url='http://t/announce', ok=False, seconds=0.2)
+    metrics.record('connect', peer='10.0.0.1:6881', result='ok')
+    metrics.record('disconnect', peer='10.0.0.1:6881', received=2**20)
+    metrics.record('piece', index=3, ok=False)
+    log.close()
+    log.write('late', {})  # after closing: dropped, not an error
+    events = list(read_events(path))
+    assert [e['event'] for e in events] == ['announce', 'connect', 'disconnect', 'piece']
+    assert events[1]['peer'] == '10.0.0.1:6881' and events[0]['time'] > 0
+    replayed = Metrics.replay(path)
+    assert replayed.counters == metrics.counters
+    assert lines(replayed, 'bt_pieces_total') == ['bt_pieces_total{result="failed"} 1']
+
+def test_a_log_summary_lists_peers_trackers_and_failures(tmp_path):
+    path = str(tmp_path / 'events.jsonl')
+    metrics = Metrics(event_log=EventLog(path))
+    metrics.record('announce', url='http://t/announce', ok=True, seconds=0.5)
+    metrics.record('disconnect', peer='10.0.0.1:6881', received=3 * 2**20)
+    metrics.record('ban', peer='10.0.0.2:6881')
+    metrics.event_log.close()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        summarize(path)
+    text = output.getvalue()
+    assert '10.0.0.1:6881' in text and '3.00 MB' in text
+    assert 'http://t/announce' in text and '1 announces, 0 failed' in text
+    assert 'Failures: 1' in text and 'bt_bans_total 1' in text
+
+def test_a_timed_lock_reports_its_waits():
+    metrics = Metrics()
+    lock = TimedLock(threading.Lock(), metrics, 'bt_data_lock_wait_seconds')
+    with lock:
+        pass
+    lock.lock.acquire()
+    threading.Timer(0.05, lock.lock.release).start()
+    with lock:
+        pass
+    histogram = metrics.histograms[('bt_data_lock_wait_seconds', ())]
+    assert histogram.count == 2 and histogram.sum >= 0.04
+
+@pytest.fixture
+def server():
+    metrics = Metrics()
+    metrics.inc('bt_bans_total')
+    server = metrics.serve(0)
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+def test_the_endpoint_serves_the_metrics(server):
+    with urllib.request.urlopen(server + '/metrics', timeout=5) as response:
+        assert response.headers['Content-Type'].startswith('text/plain')
+        assert 'bt_bans_total 1' in response.read().decode()
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(server + '/other', timeout=5)
+    assert error.value.code == 404
@@ -0,0 +1,73 @@
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+from peer import Peer
+
+def make_peer():
+    return Peer('127.0.0.1', 1, SimpleNamespace(num_pieces=8, info_hash=bytes(20)), 'x' * 20)
+
+def test_send_on_a_closed_peer_raises_oserror():
+    peer = make_peer()
+    with pytest.raises(OSError):
+        peer.send(b'\x00\x00\x00\x00')
+    a, b = socket.socketpair()
+    peer.sock = a
+    peer.close()
+    with pytest.raises(OSError):
+        peer.send(b'\x00\x00\x00\x00')
+    b.close()
+
+def test_queued_haves_go_out_in_one_write_from_flush():
+    peer = make_peer()
+    a, b = socket.socketpair()
+    peer.sock = a
+    peer.queue_have(3)
+    peer.queue_have(5)
+    b.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        b.recv(100)  # queuing sends nothing
+    peer.flush_haves()
+    assert b.recv(100) == b'\x00\x00\x00\x05\x04\x00\x00\x00\x03\x00\x00\x00\x05\x04\x00\x00\x00\x05'
+    assert not peer.pending_haves
+    peer.close()
+    b.close()
+
+@pytest.mark.parametrize('num_pieces, payload', [
+    (8, b'\xff'),
+    (9, b'\xff\x80'),
+    (12, b'\x00\xf0'),
+    (16, b'\xff\xff'),
+])
+def test_a_bitfield_of_the_right_size_is_taken(num_pieces, payload):
+    peer = Peer('127.0.0.1', 1, SimpleNamespace(num_pieces=num_pieces, info_hash=bytes(20)), 'x' * 20)
+    assert peer.handle_message(5, memoryview(payload)) == ('bitfield', None)
+    assert peer.bitfield == payload
+
+@pytest.mark.parametrize('num_pieces, payload', [
+    (9, b'\xff'),          # short
+    (9, b''),
+    (8, b'\xff\x00'),      # long
+    (9, b'\xff\xc0'),      # a spare bit set
+    (12, b'\x00\x01'),
+])
+def test_a_bad_bitfield_is_refused(num_pieces, payload):
+    peer = Peer('127.0.0.1', 1, SimpleNamespace(num_pieces=num_pieces, info_hash=bytes(20)), 'x' * 20)
+    with pytest.raises(ValueError):
+        peer.handle_message(5, memoryview(payload))
+    assert peer.bitfield is None
+
+def test_receive_message_raises_on_a_bad_bitfield():
+    peer = make_peer()
+    a, b = socket.socketpair()
+    peer.sock = a
+    b.sendall(b'\x00\x00\x00\x01\x05')  # an empty bitfield for 8 pieces
+    with pytest.raises(ValueError):
+        peer.receive_message()
+    b.close()
+    peer.close()
+
+def test_any_bitfield_is_taken_before_the_metadata_is_known():
+    peer = Peer('127.0.0.1', 1, SimpleNamespace(num_pieces=0, info_hash=bytes(20)), 'x' * 20)
+    assert peer.handle_message(5, memoryview(b'\xff\xff\xff')) == ('bitfield', None)
@@ -0,0 +1,44 @@
+import bencodepy
+import pytest
+
+from pex import MAX_PEX_PEERS, REACHABLE, SEED, parse_pex, pex_message
+from Tracker import parse_compact_peers
+
+def test_flags_line_up_with_the_added_peers():
+    added = [('10.0.0.1', 6881), ('::1', 6881), ('10.0.0.2', 6882), ('10.0.0.3', 6883)]
+    flags = {('10.0.0.1', 6881): SEED | REACHABLE, ('::1', 6881): SEED, ('10.0.0.3', 6883): REACHABLE}
+    message = bencodepy.decode(pex_message(added, [('10.0.0.9', 1)], flags))
+    # The IPv6 peer is left out, and its flag with it.
+    assert parse_compact_peers(message[b'added']) == [('10.0.0.1', 6881), ('10.0.0.2', 6882), ('10.0.0.3', 6883)]
+    assert list(message[b'added.f']) == [SEED | REACHABLE, 0, REACHABLE]
+    assert parse_compact_peers(message[b'dropped']) == [('10.0.0.9', 1)]
+
+def test_flags_default_to_none():
+    message = bencodepy.decode(pex_message([('10.0.0.1', 6881)], []))
+    assert message[b'added.f'] == b'\x00' and message[b'dropped'] == b''
+
+def test_parse_round_trip():
+    added = [('10.0.0.%d' % i, 6881 + i) for i in range(1, 10)]
+    assert parse_pex(pex_message(added, [], {added[0]: SEED})) == added
+
+def test_parse_takes_at_most_max_pex_peers():
+    added = [('10.0.%d.%d' % (i // 250, i % 250 + 1), 6881) for i in range(MAX_PEX_PEERS + 20)]
+    assert parse_pex(pex_message(added, [])) == added[:MAX_PEX_PEERS]
+
+@pytest.mark.parametrize('payload, peers', [
+    (b'de', []),
+    (b'd5:added3:abce', []),  # shorter than one peer
+    (b'd5:added7:\x0a\x00\x00\x01\x1a\xe1xe', [('10.0.0.1', 6881)]),  # trailing byte
+    (b'd5:added6:\x0a\x00\x00\x01\x00\x00e', []),  # port 0
+    (b'd5:addedi1ee', []),
+    (b'd5:addedli1eee', []),
+    (b'li1ee', []),
+    (b'i1e', []),
+])
+def test_parse_odd_payloads(payload, peers):
+    assert parse_pex(payload) == peers
+
+@pytest.mark.parametrize('payload', [b'', b'd5:added', b'x'])
+def test_parse_truncated_payloads_raise_value_error(payload):
+    with pytest.raises((ValueError, IndexError)):
+        parse_pex(payload)
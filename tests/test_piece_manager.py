@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from benchmarks.synthetic import make_torrent
+from bufferpool import BufferPool
+from peice import DOWNLOADED, NEEDED, REQUESTED, Piece, PieceManager, PieceTable
+from pipelining import BLOCK_SIZE
+from Torrent import Torrent
+
+PIECE = 16384
+
+@pytest.fixture
+def manager(tmp_path):
+    path, _ = make_torrent(str(tmp_path), 16 * PIECE, PIECE)
+    pm = PieceManager(Torrent(path), str(tmp_path / 'dl'), threading.Lock(), buffer_pool=BufferPool(2 * PIECE))
+    yield pm
+    pm.disk.stop()
+    pm.close()
+
+def only(pm, *indices):
+    bitfield = bytearray(len(pm.bitfield))
+    for i in indices:
+        bitfield[i // 8] |= 0x80 >> (i % 8)
+    return bitfield
+
+def test_released_pieces_are_resumed_when_the_budget_is_used_up(manager):
+    full = manager.picker.full_bitfield
+    first, second = manager.get_piece_to_download(full), manager.get_piece_to_download(full)
+    assert manager.get_piece_to_download(full) is None  # both buffers in flight
+    manager.release_piece(first)
+    manager.release_piece(second)
+    resumed = [manager.get_piece_to_download(full) for _ in range(2)]
+    assert {p.index for p in resumed} == {first.index, second.index}
+    assert manager.pool.stats()['in_use_bytes'] == 2 * PIECE
+
+def test_buffer_of_a_released_piece_is_freed_for_a_peer_without_it(manager):
+    full = manager.picker.full_bitfield
+    held = [manager.get_piece_to_download(full) for _ in range(2)]
+    for piece in held:
+        manager.release_piece(piece)
+    other = next(i for i in range(16) if i not in {p.index for p in held})
+    piece = manager.get_piece_to_download(only(manager, other))
+    assert piece is not None and piece.index == other and piece.data is not None
+    assert manager.pool.stats()['in_use_bytes'] == 2 * PIECE
+
+@pytest.fixture
+def torrent(tmp_path):
+    # Pieces of two and a half blocks, the last piece shorter still.
+    path, payload = make_torrent(str(tmp_path), 2 * 40000 + 20000, 40000)
+    torrent = Torrent(path)
+    torrent.payload = payload
+    return torrent
+
+def test_block_state_is_allocated_once_a_block_is_asked_for(torrent):
+    piece = Piece(0, torrent)
+    assert piece.blocks is None and piece.num_blocks == 3
+    assert list(piece.missing_blocks()) == [(0, BLOCK_SIZE), (BLOCK_SIZE, BLOCK_SIZE), (2 * BLOCK_SIZE, 40000 - 2 * BLOCK_SIZE)]
+    assert piece.get_block_to_request() == (0, BLOCK_SIZE)
+    assert piece.blocks == bytearray([REQUESTED, NEEDED, NEEDED])
+
+def test_blocks_are_requested_in_order_and_put_back(torrent):
+    piece = Piece(2, torrent)
+    assert [piece.get_block_to_request() for _ in range(3)] == [(0, BLOCK_SIZE), (BLOCK_SIZE, 20000 - BLOCK_SIZE), None]
+    piece.release_block(BLOCK_SIZE)
+    assert piece.get_block_to_request() == (BLOCK_SIZE, 20000 - BLOCK_SIZE)
+    piece.release_requested()
+    assert piece.blocks == bytearray([NEEDED, NEEDED])
+
+def test_only_whole_aligned_blocks_are_added_once(torrent):
+    piece = Piece(2, torrent)
+    piece.data = bytearray(piece.length)
+    data = torrent.payload[80000:]
+    assert not piece.add_block(1, data[:BLOCK_SIZE])
+    assert not piece.add_block(0, data[:BLOCK_SIZE - 1])
+    assert not piece.add_block(2 * BLOCK_SIZE, b'x')  # past the end
+    assert piece.add_block(BLOCK_SIZE, data[BLOCK_SIZE:], source=('10.0.0.1', 1))
+    assert not piece.add_block(BLOCK_SIZE, data[BLOCK_SIZE:])
+    assert piece.remaining == 1 and not piece.is_complete
+    assert piece.get_block_to_request() == (0, BLOCK_SIZE)
+    piece.release_block(BLOCK_SIZE)  # a downloaded block stays downloaded
+    assert piece.add_block(0, data[:BLOCK_SIZE], source=('10.0.0.2', 1))
+    assert piece.is_complete and piece.is_hash_correct() and piece.blocks == bytearray([DOWNLOADED, DOWNLOADED])
+    assert piece.contributors == {('10.0.0.1', 1), ('10.0.0.2', 1)}
+    assert piece.get_block_to_request() is None and list(piece.missing_blocks()) == []
+    piece.reset()
+    assert piece.blocks is None and piece.remaining == 2 and piece.contributors is None
+
+def test_the_piece_table_only_keeps_pieces_in_flight(torrent):
+    bitfield = bytearray([0x80])  # piece 0 is verified
+    table = PieceTable(torrent, bitfield)
+    assert table[0].is_complete and table.live == {}
+    assert table[1] is table[1] and list(table.live) == [1]
+    assert table.discard(1) is not None and table.discard(1) is None
+    with pytest.raises(IndexError):
+        table[3]
@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+import pipelining
+from pipelining import BLOCK_SIZE, RequestPipeline
+
+def test_expired():
+    pipeline = RequestPipeline()
+    pipeline.add(0, 0, BLOCK_SIZE)
+    pipeline.outstanding[(0, 0)] = (BLOCK_SIZE, pipeline.outstanding[(0, 0)][1] - 60)
+    pipeline.add(0, BLOCK_SIZE, BLOCK_SIZE)
+    assert pipeline.expired(30) == [(0, 0, BLOCK_SIZE)]
+    assert sorted(pipeline.expired(0)) == [(0, 0, BLOCK_SIZE), (0, BLOCK_SIZE, BLOCK_SIZE)]
+
+def test_expired_while_another_thread_cancels():
+    pipeline = RequestPipeline()
+    stop = threading.Event()
+    errors = []
+
+    def cancel_and_add():
+        i = 0
+        while not stop.is_set():
+            pipeline.add(i, 0, BLOCK_SIZE)
+            pipeline.cancel(i - 500, 0)
+            i += 1
+
+    thread = threading.Thread(target=cancel_and_add)
+    thread.start()
+    try:
+        for _ in range(2000):
+            try:
+                pipeline.expired(0)
+            except RuntimeError as e:  # dictionary changed size during iteration
+                errors.append(e)
+                break
+    finally:
+        stop.set()
+        thread.join()
+    assert errors == []
+
+@pytest.fixture
+def clock(clock):
+    return clock.install(pipelining)
+
+def deliver(pipeline, clock, rate, seconds, index=0):
+    """Has the peer send blocks at `rate` bytes/s for `seconds`, keeping requests in flight."""
+    interval = BLOCK_SIZE / rate
+    for _ in range(int(seconds / interval)):
+        pipeline.add(index, 0, BLOCK_SIZE)
+        clock.now += interval
+        pipeline.complete(index, 0, BLOCK_SIZE)
+        index += 1
+    return index
+
+def test_rate_follows_the_throughput(clock):
+    pipeline = RequestPipeline()
+    deliver(pipeline, clock, 1e6, 5)
+    assert pipeline.rate == pytest.approx(1e6, rel=0.05)
+    assert pipeline.window > 8
+
+def test_rate_of_a_stalled_peer_decays(clock):
+    pipeline = RequestPipeline()
+    index = deliver(pipeline, clock, 1e6, 5)
+    pipeline.add(index, 0, BLOCK_SIZE)  # and then nothing arrives
+    clock.now += 2
+    assert pipeline.rate < 0.4e6
+    clock.now += 8
+    assert pipeline.rate < 1e3
+    # A peer that delivers again starts from about its new rate, not the old one.
+    deliver(pipeline, clock, 1e5, 4, index + 1)
+    assert pipeline.rate == pytest.approx(1e5, rel=0.2)
+
+def test_rate_of_a_slower_peer_drops(clock):
+    pipeline = RequestPipeline()
+    index = deliver(pipeline, clock, 1e6, 5)
+    deliver(pipeline, clock, 1e5, 10, index)
+    assert pipeline.rate == pytest.approx(1e5, rel=0.2)
+
+def test_clear_resets_the_rate_and_window(clock):
+    pipeline = RequestPipeline(initial_window=8)
+    deliver(pipeline, clock, 1e6, 5)
+    pipeline.add(99, 0, BLOCK_SIZE)
+    assert pipeline.clear() == [(99, 0)]
+    assert pipeline.rate == 0 and pipeline.window == 8
+    clock.now += 1
+    assert pipeline.rate == 0
+
+def test_clear_keeps_a_snubbed_peer_at_one_request(clock):
+    pipeline = RequestPipeline()
+    deliver(pipeline, clock, 1e6, 2)
+    pipeline.snub()
+    pipeline.clear()
+    assert pipeline.window == 1
@@ -0,0 +1,59 @@
+import pytest
+
+import ratelimit
+from ratelimit import RateLimits, TokenBucket, allowance, consume, format_rate
+
+@pytest.fixture
+def bucket(clock):
+    clock.install(ratelimit)
+    return TokenBucket(1000, burst=2.0)
+
+def test_a_new_bucket_starts_with_a_full_burst(bucket):
+    assert bucket.available() == 2000
+
+def test_tokens_refill_at_the_rate_up_to_the_burst(bucket, clock):
+    bucket.consume(2000)
+    assert bucket.available() == 0
+    clock.now += 0.5
+    assert bucket.available() == 500
+    clock.now += 10
+    assert bucket.available() == 2000  # an idle bucket saves up no more than `burst` seconds
+
+def test_an_overdraft_is_paid_off_first(bucket, clock):
+    bucket.consume(2000 + 16384)
+    assert bucket.available() == -16384
+    clock.now += 16
+    assert bucket.available() == pytest.approx(-384)
+    clock.now += 1
+    assert bucket.available() == pytest.approx(616)
+
+def test_a_rate_of_zero_is_unlimited(clock):
+    clock.install(ratelimit)
+    bucket = TokenBucket(0)
+    bucket.consume(10 ** 9)
+    assert bucket.available() == float('inf')
+
+def test_lowering_the_rate_caps_the_saved_tokens(bucket, clock):
+    bucket.set_rate(100)
+    assert bucket.available() == 200
+    bucket.consume(200)
+    clock.now += 1
+    assert bucket.available() == 100
+    bucket.set_rate(0)
+    assert bucket.available() == float('inf')
+
+def test_a_chain_allows_what_its_tightest_bucket_allows(clock):
+    clock.install(ratelimit)
+    session, torrent, peer = RateLimits(download=5000), RateLimits(download=1000, upload=300), RateLimits()
+    chain = [peer.download, torrent.download, session.download]
+    assert allowance(chain) == 1000
+    consume(chain, 800)
+    assert allowance(chain) == 200
+    assert session.download.available() == 4200
+    torrent.set(download=0)
+    assert allowance(chain) == 4200
+    assert torrent.upload.rate == 300  # None leaves a limit as it is
+
+def test_format_rate():
+    assert format_rate(0) == "unlimited"
+    assert format_rate(512 * 1024) == "512 KiB/s"
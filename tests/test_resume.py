@@ -0,0 +1,126 @@
+import contextlib
+import io
+import json
+import os
+import threading
+
+import pytest
+
+import peice
+from benchmarks.synthetic import make_torrent
+from peice import PieceManager
+from Torrent import Torrent
+
+PIECE = 16384
+
+@pytest.fixture
+def torrent(tmp_path):
+    # Three files that don't start on piece boundaries, so the pieces at their edges are shared.
+    path, payload = make_torrent(str(tmp_path), 10 * PIECE, PIECE, num_files=3)
+    torrent = Torrent(path)
+    download_dir = str(tmp_path / 'dl')
+    for name, start, length in zip(torrent.files.paths, torrent.files.offsets, torrent.files.lengths):
+        os.makedirs(os.path.dirname(os.path.join(download_dir, name)), exist_ok=True)
+        with open(os.path.join(download_dir, name), 'wb') as f:
+            f.write(payload[start:start + length])
+    torrent.download_dir = download_dir
+    return torrent
+
+@pytest.fixture
+def open_manager(torrent, monkeypatch):
+    """Opens PieceManagers on the download directory and records the pieces each one rechecks."""
+    managers, rechecked = [], []
+    real_recheck = peice.recheck
+
+    def spy(storage, piece_length, piece_hashes, indices, *args):
+        rechecked.append(list(indices))
+        return real_recheck(storage, piece_length, piece_hashes, indices, *args)
+
+    monkeypatch.setattr(peice, 'recheck', spy)
+
+    def open_one():
+        rechecked.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            pm = PieceManager(torrent, torrent.download_dir, threading.Lock())
+        managers.append(pm)
+        return pm
+
+    open_one.rechecked = rechecked
+    yield open_one
+    for pm in managers:
+        pm.disk.stop()
+        pm.close()
+
+def close(pm):
+    pm.disk.stop()
+    pm.close()
+
+def pieces_of_file(torrent, index):
+    start, length = torrent.files.offsets[index], torrent.files.lengths[index]
+    return list(range(start // PIECE, (start + length - 1) // PIECE + 1))
+
+def test_a_fresh_sidecar_is_trusted_without_a_recheck(torrent, open_manager):
+    first = open_manager()
+    assert open_manager.rechecked == [list(range(10))]
+    assert first.is_complete()
+    close(first)
+    second = open_manager()
+    assert open_manager.rechecked == []
+    assert second.bitfield == first.bitfield
+
+def test_only_the_pieces_of_a_changed_file_are_rechecked(torrent, open_manager):
+    close(open_manager())
+    path = os.path.join(torrent.download_dir, torrent.files.paths[1])
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    pm = open_manager()
+    assert open_manager.rechecked == [pieces_of_file(torrent, 1)]
+    assert pm.is_complete()  # the data itself is still good
+
+def test_corrupted_data_in_a_changed_file_is_not_trusted(torrent, open_manager):
+    close(open_manager())
+    path = os.path.join(torrent.download_dir, torrent.files.paths[2])
+    st = os.stat(path)
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)[0]
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last ^ 0xff]))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))  # in case the clock is coarser than the write
+    pm = open_manager()
+    assert open_manager.rechecked == [pieces_of_file(torrent, 2)]
+    assert [i for i in range(10) if not pm.has(i)] == [9]
+
+def test_the_sidecar_stores_the_bitfield_and_file_stats(torrent, open_manager):
+    pm = open_manager()
+    with open(pm.resume.path) as f:
+        state = json.load(f)
+    assert state['info_hash'] == torrent.info_hash.hex()
+    assert bytearray.fromhex(state['bitfield']) == pm.bitfield
+    assert state['files'] == pm.resume.file_stats()
+    assert pm.resume.load(10, PIECE) == (pm.bitfield, [])
+
+@pytest.mark.parametrize('edit', [
+    lambda state: state.update(info_hash='00' * 20),
+    lambda state: state.update(bitfield='ff'),
+    lambda state: state.update(files=state['files'][:-1]),
+    lambda state: state.pop('files'),
+])
+def test_a_sidecar_for_another_torrent_is_ignored(torrent, open_manager, edit):
+    pm = open_manager()
+    close(pm)  # saves the sidecar one last time
+    with open(pm.resume.path) as f:
+        state = json.load(f)
+    edit(state)
+    with open(pm.resume.path, 'w') as f:
+        json.dump(state, f)
+    assert pm.resume.load(10, PIECE) is None
+    open_manager()
+    assert open_manager.rechecked == [list(range(10))]
+
+@pytest.mark.parametrize('content', ['', '{"bitfield": ', '[]', '{"bitfield": "zz", "files": []}'])
+def test_a_corrupt_sidecar_means_a_full_recheck(torrent, open_manager, content):
+    pm = open_manager()
+    with open(pm.resume.path, 'w') as f:
+        f.write(content)
+    assert pm.resume.load(10, PIECE) is None
@@ -0,0 +1,143 @@
+import contextlib
+import io
+import json
+import os
+import stat
+import threading
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+
+import pipelining
+from benchmarks.synthetic import make_torrent
+from Downloader import Downloader
+from pipelining import BLOCK_SIZE, RequestPipeline
+from session import TOKEN_FILE, TOKEN_HEADER, Session, SessionTorrent
+
+@pytest.fixture
+def session(tmp_path):
+    session = Session(str(tmp_path / 'downloads'), listen_port=None, control_port=0, max_buffer_mb=8)
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.start()
+    yield session
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.stop()
+
+def call(session, method, path, body=None, token=None, content_type='application/json'):
+    """Returns (status, decoded reply) of a control API request."""
+    headers = {}
+    if token is not None:
+        headers[TOKEN_HEADER] = token
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode() if not isinstance(body, bytes) else body
+        if content_type:
+            headers['Content-Type'] = content_type
+    url = f'http://127.0.0.1:{session.control_server.server_address[1]}{path}'
+    request = urllib.request.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+def test_the_token_is_saved_for_the_user_only(session):
+    path = os.path.join(session.download_dir, TOKEN_FILE)
+    with open(path) as f:
+        assert f.read() == session.control_token
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+def test_requests_without_the_token_are_refused(session, tmp_path):
+    torrent_path, _ = make_torrent(str(tmp_path), 64 * 1024, 16 * 1024)
+    assert call(session, 'GET', '/torrents')[0] == 401
+    assert call(session, 'GET', '/torrents', token='wrong')[0] == 401
+    assert call(session, 'POST', '/torrents', {'path': torrent_path})[0] == 401
+    assert call(session, 'POST', '/torrents', {'path': torrent_path}, token=session.control_token[:-1])[0] == 401
+    assert call(session, 'POST', '/session/limits', {'download': 1}, token='é')[0] == 401
+    assert session.torrents == {} and session.limits.download.rate == 0
+
+@pytest.mark.parametrize('content_type', [None, 'text/plain', 'application/x-www-form-urlencoded', 'multipart/form-data'])
+def test_bodies_that_are_not_json_are_refused(session, tmp_path, content_type):
+    torrent_path, _ = make_torrent(str(tmp_path), 64 * 1024, 16 * 1024)
+    status, _ = call(session, 'POST', '/torrents', {'path': torrent_path}, token=session.control_token,
+                     content_type=content_type)
+    assert status == 415
+    assert session.torrents == {}
+
+def test_requests_with_the_token_are_served(session, tmp_path):
+    torrent_path, _ = make_torrent(str(tmp_path), 64 * 1024, 16 * 1024)
+    token = session.control_token
+    with contextlib.redirect_stdout(io.StringIO()):
+        status, torrent = call(session, 'POST', '/torrents', {'path': torrent_path}, token=token,
+                               content_type='application/json; charset=utf-8')
+        assert status == 201
+        assert call(session, 'POST', f"/torrents/{torrent['id']}/pause", token=token)[1]['state'] == 'paused'
+        assert [t['id'] for t in call(session, 'GET', '/torrents', token=token)[1]] == [torrent['id']]
+        assert call(session, 'DELETE', f"/torrents/{torrent['id']}", token=token)[0] == 200
+    assert call(session, 'GET', '/session', token=token)[1]['torrents'] == 0
+
+def test_a_given_token_is_used(tmp_path):
+    session = Session(str(tmp_path), listen_port=None, control_port=0, max_buffer_mb=8, control_token='secret')
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.start()
+    try:
+        assert call(session, 'GET', '/session', token='secret')[0] == 200
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            session.stop()
+
+def test_stopping_a_torrent_closes_it_on_the_loop_after_the_engine(session, tmp_path):
+    torrent_path, _ = make_torrent(str(tmp_path), 64 * 1024, 16 * 1024)
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = session.get(session.add(torrent_path))
+    d = t.downloader
+    closes = []
+    close = d.piece_manager.close
+
+    def record_close():
+        closes.append((threading.current_thread(), set(d.async_engine.tasks), t.engine_future.done()))
+        close()
+
+    d.piece_manager.close = record_close
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.pause(t.id)
+    assert len(closes) == 1
+    thread, tasks, done = closes[0]
+    assert thread is session.thread  # the loop's thread, not the caller's
+    assert tasks == set() and not done  # the engine's tasks are over; run() closes as its last step
+    assert t.engine_future.done() and d.closed.is_set()
+
+class FakePeer:
+    def __init__(self, name):
+        self.name = name
+        self.pipeline = RequestPipeline()
+        self.closed = False
+
+    def is_connected(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+def test_rebalance_drops_silent_peers_first(tmp_path, clock):
+    clock.install(pipelining)
+    torrent_path, _ = make_torrent(str(tmp_path), 64 * 1024, 16 * 1024)
+    with contextlib.redirect_stdout(io.StringIO()):
+        d = Downloader(torrent_path, str(tmp_path / 'downloads'), listen_port=None)
+    session = Session(str(tmp_path / 'downloads'), max_peers=2, listen_port=None, control_port=None, max_buffer_mb=8)
+    t = SessionTorrent(torrent_path, d.torrent)
+    t.downloader, t.buffers = d, SimpleNamespace(limit=0)
+    fast, silent, slow = d.peers = [FakePeer('fast'), FakePeer('silent'), FakePeer('slow')]
+    # 5 s with two peers at ~1 MB/s, then 10 s in which one of them sends nothing and a slow one joins.
+    for i in range(900):
+        senders = [fast, silent] if i < 300 else [fast] + ([slow] if i % 10 == 0 else [])
+        for peer in senders:
+            peer.pipeline.add(i, 0, BLOCK_SIZE)
+        clock.now += 1 / 60
+        for peer in senders:
+            peer.pipeline.complete(i, 0, BLOCK_SIZE)
+    session.rebalance([t])
+    assert [p.closed for p in d.peers] == [False, True, False]
+    session.disk.stop()
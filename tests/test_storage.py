@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from benchmarks.synthetic import make_torrent
+from storage import ReadCache, Storage
+from Torrent import Torrent
+
+@pytest.fixture
+def storage(tmp_path):
+    path, payload = make_torrent(str(tmp_path), 4 * 1000, 1024, num_files=4)
+    storage = Storage(Torrent(path), str(tmp_path / 'dl'), max_open_files=2)
+    storage.allocate()
+    storage.payload = payload
+    yield storage
+    storage.close()
+
+def open_fds(storage):
+    return {index: entry[0] for index, entry in storage.fds.items()}
+
+def test_writes_across_files_read_back(storage):
+    storage.write(0, storage.payload)
+    assert bytes(storage.read(0, len(storage.payload))) == storage.payload
+    assert bytes(storage.read(990, 20)) == storage.payload[990:1010]  # spans the first two files
+    with open(storage.paths[1], 'rb') as f:
+        assert f.read() == storage.payload[1000:2000]
+
+def test_the_least_recently_used_descriptor_is_closed(storage):
+    storage.read(0, 1)
+    storage.read(1000, 1)
+    storage.read(0, 1)  # file 0 is now the most recently used
+    storage.read(2000, 1)
+    assert list(storage.fds) == [0, 2]
+
+def test_a_descriptor_in_use_is_not_closed(storage):
+    storage._acquire(0)
+    storage._acquire(1)
+    # Every other descriptor is in use: the cache grows past its limit instead of closing one.
+    fd = storage._acquire(2)
+    assert open_fds(storage) == {0: storage.fds[0][0], 1: storage.fds[1][0], 2: fd}
+    os.fstat(fd)  # still open
+    storage._release(2)
+    storage._release(0)
+    storage._release(1)
+    storage.read(3000, 1)
+    assert len(storage.fds) == 2 and 3 in storage.fds
+
+def test_the_read_cache_keeps_recent_pieces(storage):
+    storage.write(0, storage.payload)
+    cache = ReadCache(storage, 1024, capacity=2048)
+    assert bytes(cache.read(0, 10, 5)) == storage.payload[10:15]
+    assert bytes(cache.read(0, 20, 5)) == storage.payload[20:25]
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.read(1, 0, 1)
+    cache.read(2, 0, 1)
+    assert list(cache.pieces) == [1, 2]
+    assert bytes(cache.read(3, 0, 1000)) == storage.payload[3072:4000]  # the short last piece
@@ -0,0 +1,107 @@
+import contextlib
+import io
+import threading
+
+import pytest
+
+from benchmarks.synthetic import make_torrent
+from Downloader import Downloader
+
+PIECE = 16384
+
+@pytest.fixture
+def dl(tmp_path):
+    # Three files of 54614, 54613 and 54613 bytes over ten pieces: the second file starts
+    # 54614 bytes in, inside piece 3, and ends inside piece 6.
+    path, payload = make_torrent(str(tmp_path), 10 * PIECE, PIECE, num_files=3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        dl = Downloader(path, str(tmp_path / 'downloads'), listen_port=None)
+    dl.payload = payload
+    yield dl
+    dl.is_running = False
+    with contextlib.redirect_stdout(io.StringIO()):
+        dl.stop()
+
+def verify(dl, *indices):
+    """Puts pieces on disk and marks them verified, as the disk pipeline would."""
+    pm = dl.piece_manager
+    for index in indices:
+        pm.storage.write(index * PIECE, dl.payload[index * PIECE:(index + 1) * PIECE])
+        with dl.data_lock:
+            pm.mark_piece_complete(index)
+    with pm.verified:
+        pm.verified.notify_all()
+
+def second_file(dl):
+    start, length = dl.torrent.files.offsets[1], dl.torrent.files.lengths[1]
+    return dl.payload[start:start + length]
+
+def test_a_read_blocks_until_its_piece_is_verified(dl):
+    f = dl.open_file(1)
+    result = []
+    reader = threading.Thread(target=lambda: result.append(f.read(100)))
+    reader.start()
+    reader.join(0.2)
+    assert reader.is_alive()
+    verify(dl, 4)  # not the piece the read is waiting for
+    reader.join(0.2)
+    assert reader.is_alive()
+    verify(dl, 3)
+    reader.join(5)
+    assert result == [second_file(dl)[:100]]
+
+def test_a_read_returns_what_is_verified_from_the_position_on(dl):
+    verify(dl, 3, 4, 6)
+    f = dl.open_file(1)
+    # Piece 5 is missing: the read stops at the end of piece 4.
+    assert f.read(3 * PIECE) == second_file(dl)[:5 * PIECE - dl.torrent.files.offsets[1]]
+
+def test_seek_and_read_across_piece_and_file_boundaries(dl):
+    verify(dl, *range(10))
+    data = second_file(dl)
+    f = dl.open_file(dl.torrent.files.paths[1])
+    assert f.seek(-10, io.SEEK_END) == len(data) - 10
+    assert f.read(100) == data[-10:]  # stops at the end of the file, not of the piece
+    assert f.read(100) == b''
+    f.seek(PIECE)
+    assert f.seek(-50, io.SEEK_CUR) == PIECE - 50
+    assert f.read(100) == data[PIECE - 50:PIECE + 50]
+    assert f.tell() == PIECE + 50
+    f.seek(0)
+    assert io.BufferedReader(f).read() == data
+    with pytest.raises(ValueError):
+        f.seek(-1)
+
+def test_files_are_opened_by_index_or_path(dl):
+    with pytest.raises(FileNotFoundError):
+        dl.open_file('nothing.bin')
+    with pytest.raises(IndexError):
+        dl.open_file(3)
+
+def test_deadlines_are_set_on_the_pieces_ahead_of_the_read(dl):
+    deadlines = dl.piece_manager.picker.deadlines
+    verify(dl, 4)
+    f = dl.open_file(1, readahead=3 * PIECE, timeout=0.05)
+    with pytest.raises(TimeoutError):
+        f.read(10)
+    # From piece 3, where the file starts, to 3 pieces past the position; piece 4 is already here.
+    assert sorted(deadlines) == [3, 5, 6]
+    assert deadlines[3] < deadlines[5] < deadlines[6]
+    f.seek(3 * PIECE)
+    with pytest.raises(TimeoutError):
+        f.read(10)
+    # The window moved on: pieces behind the position lose their deadlines.
+    assert sorted(deadlines) == [6]
+    f.close()
+    assert deadlines == {}
+
+def test_a_read_fails_once_the_download_stops(dl):
+    f = dl.open_file(0)
+    dl.is_running = False
+    with pytest.raises(OSError):
+        f.read(1)
+
+def test_completion_is_reported_under_the_torrent_name(dl, capsys):
+    verify(dl, *range(10))
+    assert not dl.check_complete()
+    assert "Download complete: synthetic." in capsys.readouterr().out
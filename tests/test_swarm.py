@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import struct
+import threading
+import time
+
+import pytest
+
+from benchmarks.seeder import Seeder
+from benchmarks.swarm import LockProbe, Swarm, loopback_peers, run_download
+from benchmarks.synthetic import info_hash, make_torrent
+from Torrent import Torrent
+
+def test_a_synthetic_torrent_describes_its_payload(tmp_path):
+    path, payload = make_torrent(str(tmp_path), 100000, 16384, num_files=3)
+    torrent = Torrent(path)
+    assert torrent.info_hash == info_hash(path)
+    assert sum(torrent.files.lengths) == len(payload) == 100000
+    for index in range(torrent.num_pieces):
+        piece = payload[index * 16384:(index + 1) * 16384]
+        assert hashlib.sha1(piece).digest() == torrent.piece_hash(index)
+    assert make_torrent(str(tmp_path), 100000, 16384)[1] == payload  # the same seed gives the same content
+
+def test_loopback_peers_are_distinct_addresses():
+    peers = loopback_peers(6881, 600)
+    assert len(set(peers)) == 600 and peers[0] == ('127.0.0.1', 6881) and peers[250] == ('127.0.1.1', 6881)
+
+async def fetch_block(seeder, index, offset, length):
+    """Handshakes with the seeder, asks for one block and returns (bitfield, block data)."""
+    server = await seeder.serve('127.0.0.1')
+    reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+    try:
+        writer.write(struct.pack('!B19s8s20s20s', 19, b'BitTorrent protocol', bytes(8), seeder.info_hash, bytes(20)))
+        await reader.readexactly(68)
+        bitfield_length = struct.unpack('!I', await reader.readexactly(4))[0]
+        bitfield = (await reader.readexactly(bitfield_length))[1:]
+        writer.write(struct.pack('!IB', 1, 2) + struct.pack('!IBIII', 13, 6, index, offset, length))
+        assert await reader.readexactly(5) == struct.pack('!IB', 1, 1)  # unchoke
+        header = await reader.readexactly(13)
+        assert struct.unpack('!IBII', header) == (9 + length, 7, index, offset)
+        return bitfield, await reader.readexactly(length)
+    finally:
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+@pytest.mark.parametrize('behavior', [None, 'corrupt'])
+def test_a_seeder_serves_blocks(behavior):
+    payload = bytes(range(256)) * 400  # 102400 bytes: 7 pieces of 16 KiB
+    seeder = Seeder(payload, bytes(20), 16384, behavior=behavior)
+    bitfield, data = asyncio.run(fetch_block(seeder, 2, 1000, 500))
+    assert bitfield == b'\xfe'
+    expected = payload[2 * 16384 + 1000:2 * 16384 + 1500]
+    if behavior == 'corrupt':
+        assert data != expected and data[1:] == expected[1:]
+    else:
+        assert data == expected
+
+def test_a_lock_probe_counts_contention():
+    probe = LockProbe(threading.Lock())
+    with probe:
+        pass
+    probe.acquire()
+    waiter = threading.Thread(target=lambda: (probe.acquire(), probe.release()))
+    waiter.start()
+    time.sleep(0.05)
+    probe.release()
+    waiter.join(5)
+    stats = probe.stats()
+    assert stats['acquisitions'] == 3 and stats['contended'] == 1 and stats['wait_ms'] > 0
+
+def test_a_download_from_the_swarm_is_measured():
+    swarm = Swarm(size=2 * 2**20, piece_length=64 * 1024, seeders=4).start()
+    try:
+        result = run_download(swarm, timeout=60)
+    finally:
+        swarm.close()
+    assert result['complete'] and result['connected'] > 0
+    assert result['mb_s'] > 0 and result['seconds'] > 0 and result['first_piece'] <= result['seconds']
+    assert set(result['locks']) == {'data', 'buffers', 'disk', 'connections', 'print'}
+    assert result['locks']['data']['acquisitions'] > 0
@@ -0,0 +1,144 @@
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import bencodepy
+import pytest
+
+from benchmarks.tracker import TrackerStandIn
+from Tracker import TrackerManager
+
+INFO_HASH = bytes(range(20))
+
+def make_manager(*urls):
+    torrent = SimpleNamespace(info_hash=INFO_HASH, total_size=1000, announce_list=[[url.encode() for url in urls]])
+    return TrackerManager(torrent, '-PY0001-abcdefghijkl', threading.Lock(), lambda peers: None, lambda: (0, 0, 1000),
+                          port=6881, stop_timeout=2)
+
+@pytest.fixture
+def stand_in():
+    tracker = TrackerStandIn(interval=100, min_interval=30)
+    yield tracker
+    tracker.close()
+
+def test_http_interval_and_min_interval(stand_in):
+    manager = make_manager(stand_in.start_http())
+    state = manager.states[0]
+    before = time.monotonic()
+    manager.announce(state)
+    assert state.failures == 0 and state.started
+    assert 100 <= state.next_announce - before < 102
+    assert 30 <= state.earliest_announce - before < 32
+
+def test_udp_interval_without_min_interval_uses_the_default(stand_in):
+    manager = make_manager(stand_in.start_udp())
+    state = manager.states[0]
+    before = time.monotonic()
+    manager.announce(state)
+    assert state.failures == 0
+    assert 100 <= state.next_announce - before < 102
+    assert manager.default_min_interval <= state.earliest_announce - before < manager.default_min_interval + 2
+
+def test_failures_back_off_exponentially():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]  # nothing listens on it once closed
+    manager = make_manager(f'http://127.0.0.1:{port}/announce')
+    state = manager.states[0]
+    for failures, retry in [(1, 30), (2, 60), (3, 120)]:
+        before = time.monotonic()
+        manager.announce(state)
+        assert state.failures == failures and not state.busy and not state.started
+        assert retry <= state.next_announce - before < retry + 2
+        assert state.earliest_announce == state.next_announce
+    manager.stop()
+
+@pytest.mark.parametrize('protocol', ['http', 'udp'])
+def test_started_completed_stopped_events(stand_in, protocol):
+    manager = make_manager(stand_in.start_http() if protocol == 'http' else stand_in.start_udp())
+    state = manager.states[0]
+    manager.announce(state)
+    manager.announce(state)
+    manager.completed()
+    assert state.pending_event == 'completed' and state.next_announce == 0.0
+    manager.announce(state)
+    manager.stop()
+    assert stand_in.events(protocol) == ['started', '', 'completed', 'stopped']
+
+def test_stop_without_a_started_announce_sends_nothing(stand_in):
+    manager = make_manager(stand_in.start_http())
+    manager.stop()
+    assert stand_in.events() == []
+
+def serve_http(body):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/announce'
+
+@pytest.mark.parametrize('body', [
+    b'not bencode',
+    b'li1ee',
+    bencodepy.encode({b'failure reason': b'unregistered torrent'}),
+    bencodepy.encode({b'interval': b'soon', b'peers': b''}),
+    bencodepy.encode({b'interval': 100, b'min interval': b'x', b'peers': b''}),
+    bencodepy.encode({b'interval': 100, b'peers': [{b'port': 1}]}),
+    bencodepy.encode({b'interval': 100, b'peers': [{b'ip': 5, b'port': 1}]}),
+])
+def test_malformed_http_responses_count_as_failures(body):
+    server, url = serve_http(body)
+    try:
+        manager = make_manager(url)
+        state = manager.states[0]
+        manager.announce(state)
+        assert state.failures == 1 and not state.busy and state.last_error
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_odd_compact_peers_are_tolerated():
+    peers = socket.inet_aton('10.0.0.1') + struct.pack('!H', 6881) + socket.inet_aton('10.0.0.2') + b'\x00\x00' + b'\x01'
+    server, url = serve_http(bencodepy.encode({b'interval': 100, b'peers': peers}))
+    try:
+        received = []
+        manager = make_manager(url)
+        manager.on_peers = received.extend
+        manager.announce(manager.states[0])
+        assert received == [('10.0.0.1', 6881)]  # port 0 and the trailing byte are dropped
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@pytest.mark.parametrize('reply', [b'', b'\x00\x00\x00\x00', b'\x00\x00\x00\x03\x00\x00\x00\x00error'])
+def test_malformed_udp_responses_count_as_failures(reply):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+
+    def answer():
+        try:
+            while True:
+                _, address = sock.recvfrom(2048)
+                sock.sendto(reply, address)
+        except OSError:
+            pass
+
+    threading.Thread(target=answer, daemon=True).start()
+    try:
+        manager = make_manager(f'udp://127.0.0.1:{sock.getsockname()[1]}/announce')
+        state = manager.states[0]
+        manager.announce(state)
+        assert state.failures == 1 and not state.busy
+    finally:
+        sock.close()